@@ -0,0 +1,519 @@
+"""asyncio implementations of the pose server and client.
+
+Both speak exactly the same protocol as BodyPoseTcpServer and
+BodyPoseTcpClient, so they can be mixed freely with the selector based
+implementations and the Unity client. If uvloop is installed, it is used as
+event loop.
+
+The server only implements plain, batched and encoded frames. It rejects
+frame profiles and closes the connection of clients that ask for UDP,
+subscriptions, histories, resampled frames or streams.
+"""
+import asyncio
+import os
+import time
+import numpy as np
+from pose_protocol import (POSE_FRAME_SIZE, BODY_FRAME_DTYPE,
+                           BODY_FRAME_SIZE, COUNT, FrameReassembler,
+                           MSG_FRAME, MSG_SET_BATCHED, MSG_SET_ENCODING,
+                           MSG_SET_UDP_ONLY, MSG_SET_RESAMPLED,
+                           MSG_SET_FRAME_PROFILE, MSG_SET_FRAMED,
+                           MSG_ENCODED_FRAME, MSG_SUBSCRIBE, MSG_UNSUBSCRIBE,
+                           MSG_STREAM_FRAMES, MSG_END_STREAMS,
+                           MSG_REQUEST_HISTORY, HISTORY_REQUEST,
+                           HISTORY_LAST, check_client_message,
+                           encode_body_ids, encode_message,
+                           encode_batch_header)
+from pose_codec import ENCODING_RAW, FORMAT_SIZES, PoseDecoder
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Requests AsyncBodyPoseTcpServer does not implement. Ignoring them would
+# leave the client with other frames than it asked for, so the connection is
+# closed instead.
+_UNSUPPORTED_MESSAGES = (MSG_SET_UDP_ONLY, MSG_SUBSCRIBE, MSG_UNSUBSCRIBE,
+                         MSG_REQUEST_HISTORY, MSG_SET_RESAMPLED)
+
+
+def run(main):
+    """Runs a coroutine to completion, on uvloop if it is installed"""
+    if uvloop is None:
+        return asyncio.run(main)
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(main)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class _ServerProtocol(asyncio.BufferedProtocol):
+    """A single client connection of AsyncBodyPoseTcpServer"""
+    def __init__(self, server):
+        self.server = server
+        self.frames = FrameReassembler(POSE_FRAME_SIZE)
+        self.transport = None
+        self.addr = None
+        self.producer = False
+        self.batched = False
+        self.body_id = 0
+        # PoseDecoder, if the client is a producer that sends encoded frames
+        self.decoder = None
+        # set while the write buffer of the transport is above the high
+        # water mark
+        self.paused = False
+        # body ID -> newest frame not yet handed to the transport
+        self.out_queue = {}
+        self.frames_dropped = 0
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        if not self.addr:
+            # clients of a unix domain socket are unnamed
+            self.addr = f"{transport.get_extra_info('sockname')}:{id(self)}"
+        transport.set_write_buffer_limits(high=self.server.write_buffer_high,
+                                          low=self.server.write_buffer_low)
+        self.server._connection_made(self)
+
+
+    def connection_lost(self, exc):
+        self.server._connection_lost(self)
+
+
+    def get_buffer(self, sizehint):
+        return self.frames.get_buffer()
+
+
+    def buffer_updated(self, nbytes):
+        try:
+            messages = self.frames.buffer_updated(nbytes)
+            for msg_type, payload in messages:
+                if msg_type != MSG_FRAME:
+                    check_client_message(msg_type, payload)
+        except ValueError as e:
+            if self.server.verbosity > 0:
+                print(f"Invalid message from {self.addr}: {e}")
+            self.transport.close()
+            return
+        self.server._messages_received(self, messages)
+
+
+    def pause_writing(self):
+        self.paused = True
+
+
+    def resume_writing(self):
+        self.paused = False
+        if self.out_queue:
+            messages = list(self.out_queue.values())
+            if self.batched:
+                messages.insert(0, encode_batch_header(len(messages)))
+            self.out_queue.clear()
+            self.transport.writelines(messages)
+
+
+    def send(self, buffers, records):
+        """Writes a message or, while paused, queues its frames.
+
+        Args:
+            buffers (list): Bytes objects that make up the message.
+            records (tuple): (body ID, body ID bytes, frame) for every frame
+                contained in the message.
+        """
+        if not self.paused:
+            self.transport.writelines(buffers)
+            return
+        for body_id, body_id_bytes, pose in records:
+            if self.out_queue.pop(body_id, None) is not None:
+                self.frames_dropped += 1
+            self.out_queue[body_id] = body_id_bytes + pose
+
+
+class AsyncBodyPoseTcpServer:
+    """asyncio counterpart of BodyPoseTcpServer.
+
+    Receives through asyncio.BufferedProtocol directly into the buffer of a
+    FrameReassembler. Backpressure is driven by the write buffer limits of
+    the transports: while the buffer of a consumer is above the high water
+    mark, only the newest frame of each body is kept for it.
+    """
+    def __init__(self, host, port, connections_to_accept,
+                 send_initial_transmissions, write_buffer_high=64 * 1024,
+                 write_buffer_low=None, unix_socket_path=None):
+        self.host = host
+        self.port = port
+        self.connections_to_accept = connections_to_accept
+        self.send_initial_transmissions = send_initial_transmissions
+        self.write_buffer_high = write_buffer_high
+        self.write_buffer_low = write_buffer_low
+        # Additional listening socket for clients on the same host
+        self.unix_socket_path = unix_socket_path
+        self.consumers = []
+        self.batched_consumers = []
+        self.body_poses = {}
+        self.batch_updates = {}
+        self.first_transmissions = {}
+        self.next_free_body_id = 1
+        self.verbosity = 1
+
+
+    def start_server(self, verbosity):
+        """Starts the server and blocks until it is interrupted
+
+        Args:
+            verbosity (int): Verbosity level. 0: No status messages.
+                1: Important status messages. 2: All messages.
+        """
+        try:
+            run(self.serve(verbosity))
+        except KeyboardInterrupt:
+            if verbosity > 0:
+                print("Stopping server...")
+
+
+    async def serve(self, verbosity):
+        """Serves clients until the task is cancelled. Can be used to embed
+        the server into an existing asyncio application."""
+        self.verbosity = verbosity
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: _ServerProtocol(self), self.host, self.port,
+            backlog=self.connections_to_accept, reuse_address=True
+        )
+        if verbosity > 0:
+            print(f"Listening on {(self.host, self.port)}")
+        servers = [server]
+        if self.unix_socket_path is not None:
+            if os.path.exists(self.unix_socket_path):
+                # left over from a server that did not shut down cleanly
+                os.unlink(self.unix_socket_path)
+            servers.append(await loop.create_unix_server(
+                lambda: _ServerProtocol(self), self.unix_socket_path,
+                backlog=self.connections_to_accept
+            ))
+            if verbosity > 0:
+                print(f"Listening on {self.unix_socket_path}")
+        try:
+            await asyncio.gather(
+                *(server.serve_forever() for server in servers)
+            )
+        finally:
+            for server in servers:
+                server.close()
+
+
+    def _connection_made(self, conn):
+        if self.verbosity > 0:
+            print(f"Accepted connection from {conn.addr}")
+        self.consumers.append(conn)
+        # Whenever a new client connects, we want to send the first transmissions
+        # of all active producers to this client, so that the client can correctly
+        # calculate the position difference that it has to apply to its base position
+        if self.send_initial_transmissions and self.first_transmissions:
+            conn.transport.writelines(
+                int(body_id).to_bytes(4, 'big') + msg
+                for body_id, msg in self.first_transmissions.items()
+            )
+
+
+    def _connection_lost(self, conn):
+        if self.verbosity > 0:
+            print(f"Client at {conn.addr} closed the connection.")
+        if conn.producer:
+            del self.first_transmissions[conn.body_id]
+        else:
+            consumers = self.batched_consumers if conn.batched \
+                else self.consumers
+            consumers.remove(conn)
+            if self.verbosity > 0 and conn.frames_dropped:
+                print(f"Dropped {conn.frames_dropped} frames for slow "
+                      f"client {conn.addr}")
+
+
+    def _messages_received(self, conn, messages):
+        frames = []
+        for msg_type, payload in messages:
+            if msg_type == MSG_FRAME:
+                frames.append(payload)
+            elif msg_type == MSG_ENCODED_FRAME:
+                if conn.decoder is None:
+                    conn.decoder = PoseDecoder()
+                try:
+                    frames.append(conn.decoder.decode(0, payload[4:]).tobytes())
+                except ValueError as e:
+                    if self.verbosity > 0:
+                        print(f"Invalid frame from {conn.addr}: {e}")
+                    conn.transport.close()
+                    return
+            elif msg_type == MSG_SET_ENCODING:
+                # Producers may use any encoding, their frames carry their
+                # format. Consumers always receive raw frames from this
+                # server.
+                encoding = COUNT.unpack(payload)[0]
+                if encoding not in FORMAT_SIZES:
+                    encoding = ENCODING_RAW
+                conn.transport.write(encode_message(
+                    MSG_SET_ENCODING, COUNT.pack(encoding)
+                ))
+            elif msg_type == MSG_SET_BATCHED:
+                if not conn.batched and not conn.producer:
+                    conn.batched = True
+                    self.consumers.remove(conn)
+                    self.batched_consumers.append(conn)
+            elif msg_type in (MSG_STREAM_FRAMES, MSG_END_STREAMS):
+                # the producer notices that none of its streams was
+                # confirmed with a MSG_STREAMS_STARTED
+                if self.verbosity > 0:
+                    print(f"Closing connection to {conn.addr}, streams are "
+                          "not supported")
+                conn.transport.close()
+                return
+            elif msg_type == MSG_SET_FRAME_PROFILE:
+                # frames are not converted by this server, the empty reply
+                # rejects the profile
+                if self.verbosity > 0:
+                    print(f"Rejecting frame profile of {conn.addr}")
+                conn.transport.write(encode_message(MSG_SET_FRAME_PROFILE))
+            elif msg_type in _UNSUPPORTED_MESSAGES:
+                if self.verbosity > 0:
+                    print(f"Closing connection to {conn.addr}, messages of "
+                          f"type {msg_type} are not supported")
+                conn.transport.close()
+                return
+            elif msg_type == MSG_SET_FRAMED:
+                # conn.frames already switched to framed mode
+                pass
+            elif self.verbosity > 0:
+                print(f"Ignoring message of unknown type {msg_type} from "
+                      f"{conn.addr}")
+        if not frames:
+            return
+        if not conn.producer:
+            # client is now a producer
+            conn.producer = True
+            consumers = self.batched_consumers if conn.batched \
+                else self.consumers
+            consumers.remove(conn)
+            conn.body_id = self.next_free_body_id
+            self.first_transmissions[conn.body_id] = bytes(frames[0])
+            if self.verbosity > 0:
+                print(f"Assigned body ID {conn.body_id} to {conn.addr}")
+            self.next_free_body_id += 1
+        body_id_bytes = int(conn.body_id).to_bytes(4, 'big')
+        for frame in frames:
+            # transports may keep a reference to the written data, so the
+            # frame must not point into the receive buffer anymore
+            pose = bytes(frame)
+            records = ((conn.body_id, body_id_bytes, pose),)
+            for consumer in self.consumers:
+                if self.verbosity > 1:
+                    print(f"Transmitting to {consumer.addr}")
+                consumer.send([body_id_bytes, pose], records)
+        self.body_poses[conn.body_id] = pose
+        if self.batched_consumers:
+            if not self.batch_updates:
+                # all updates received until the next loop iteration go into
+                # the same packet
+                asyncio.get_running_loop().call_soon(
+                    self._update_batched_consumers
+                )
+            self.batch_updates[conn.body_id] = pose
+
+
+    def _update_batched_consumers(self):
+        records = tuple(
+            (body_id, int(body_id).to_bytes(4, 'big'), pose)
+            for body_id, pose in self.batch_updates.items()
+        )
+        self.batch_updates = {}
+        buffers = [encode_batch_header(len(records))]
+        for _, body_id_bytes, pose in records:
+            buffers.append(body_id_bytes)
+            buffers.append(pose)
+        for consumer in self.batched_consumers:
+            consumer.send(buffers, records)
+
+
+class _ClientProtocol(asyncio.BufferedProtocol):
+    """Connection of AsyncBodyPoseTcpClient"""
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+        self.frames = FrameReassembler(BODY_FRAME_SIZE) if client.is_producer \
+            else FrameReassembler(BODY_FRAME_SIZE, client.buffer_frames,
+                                  BODY_FRAME_DTYPE)
+        self.closed = asyncio.get_running_loop().create_future()
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def connection_lost(self, exc):
+        self.can_write.set()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+    def get_buffer(self, sizehint):
+        return self.frames.get_buffer()
+
+
+    def buffer_updated(self, nbytes):
+        messages = self.frames.buffer_updated(nbytes)
+        if not self.client.is_producer:
+            try:
+                self.client._process_messages(messages)
+            except RuntimeError as e:
+                self.fail(e)
+
+
+    def check_frame_profile(self):
+        try:
+            self.client._check_frame_profile()
+        except RuntimeError as e:
+            self.fail(e)
+
+
+    def fail(self, exc):
+        """Closes the connection and makes run_async raise exc"""
+        if not self.closed.done():
+            self.closed.set_exception(exc)
+        self.transport.close()
+
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+
+    def resume_writing(self):
+        self.can_write.set()
+
+
+class AsyncBodyPoseTcpClient:
+    """Runs a configured BodyPoseTcpClient on asyncio.
+
+    Producers are paced by the FramePacer of the client, which sleeps with
+    asyncio.sleep, and wait for the transport to drain if the server does
+    not keep up. Many clients can be run concurrently in one process by
+    gathering their run_async coroutines.
+    """
+    def __init__(self, client):
+        """
+        Args:
+            client (BodyPoseTcpClient): Client that provides the
+                configuration, the poses to transmit and the recording.
+        """
+        self.client = client
+
+
+    def run(self):
+        """Connects to the server and blocks until the connection ends"""
+        client = self.client
+        if client.is_producer and client.verbosity > 0:
+            print("Transmitting data")
+        if client.record and client.verbosity > 0:
+            print("Recording data")
+        try:
+            run(self.run_async())
+        except KeyboardInterrupt:
+            if client.verbosity > 0:
+                print("Closing connection")
+        finally:
+            if client.is_producer and client.verbosity > 0:
+                client._print_pacing_stats()
+            if client.record:
+                client._save_recording()
+
+
+    async def run_async(self):
+        client = self.client
+        loop = asyncio.get_running_loop()
+        if client.unix_socket_path is not None:
+            server_addr = client.unix_socket_path
+            transport, protocol = await loop.create_unix_connection(
+                lambda: _ClientProtocol(client), server_addr
+            )
+        else:
+            server_addr = (client.host, client.port)
+            transport, protocol = await loop.create_connection(
+                lambda: _ClientProtocol(client), client.host, client.port
+            )
+        if client.verbosity > 0:
+            print(f"Connected to server at {server_addr}")
+        if client.encoding != ENCODING_RAW:
+            transport.write(encode_message(MSG_SET_ENCODING,
+                                           COUNT.pack(client.encoding)))
+        try:
+            if client.is_producer:
+                if client.framed:
+                    transport.write(encode_message(MSG_SET_FRAMED))
+                await self._produce(transport, protocol)
+            else:
+                if client.batched:
+                    transport.write(encode_message(MSG_SET_BATCHED))
+                if client.resampled:
+                    transport.write(encode_message(MSG_SET_RESAMPLED))
+                if client.frame_profile is not None:
+                    transport.write(encode_message(
+                        MSG_SET_FRAME_PROFILE, client.frame_profile.encode()
+                    ))
+                    client._frame_profile_sent()
+                    loop.call_later(client._select_timeout(),
+                                    protocol.check_frame_profile)
+                if client.subscriptions is not None:
+                    transport.write(encode_message(
+                        MSG_SUBSCRIBE, encode_body_ids(client.subscriptions)
+                    ))
+                if client.history_frames > 0:
+                    transport.write(encode_message(
+                        MSG_REQUEST_HISTORY,
+                        HISTORY_REQUEST.pack(0, HISTORY_LAST,
+                                             client.history_frames)
+                    ))
+                await protocol.closed
+                if client.verbosity > 0:
+                    print("Server closed the connection")
+        finally:
+            transport.close()
+
+
+    async def _produce(self, transport, protocol):
+        client = self.client
+        poses_idx = 0
+        client.pacer.reset()
+        while not protocol.closed.done():
+            frames_due = await client.pacer.wait_async()
+            poses_idx += (frames_due - 1) * client.frames_to_advance
+            if client.pose_frames is not None:
+                if poses_idx >= client.pose_frames.shape[0]:
+                    if not client.loop:
+                        if client.verbosity > 0:
+                            print("Transmitted all poses, closing connection")
+                        return
+                    poses_idx = 0
+                to_transmit = client.pose_frames[poses_idx]
+            else:
+                to_transmit = np.zeros((168,), dtype=np.float32)
+                if client.transmit_ones:
+                    to_transmit += 1
+                client.transmit_ones = not client.transmit_ones
+            await protocol.can_write.wait()
+            transport.writelines(client._encode_transmission(to_transmit))
+            time_now = time.perf_counter()
+            if client.time_last_transmission is not None \
+                    and client.verbosity > 0:
+                T = time_now - client.time_last_transmission
+                f = 1 / T if T > 0 else float('inf')
+                print(f"Sending data with {f:.0f} Hz     ", end="\r",
+                      flush=True)
+            client.time_last_transmission = time_now
+            poses_idx += client.frames_to_advance
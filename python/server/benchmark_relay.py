@@ -0,0 +1,472 @@
+"""Load generator and end-to-end latency benchmark for the pose server.
+
+Starts a server (as a subprocess or in a thread of this process), N synthetic
+producers in a separate process and M consumers in this process, all on
+localhost. Every frame carries the time it was sent, a sequence number and
+the index of its producer, and the rest of the frame is filled with a
+pattern derived from the sequence number. Consumers use this to measure the
+end-to-end latency and to count frames that were dropped by the server or
+arrived torn.
+
+Results are printed and can be written to a JSON file, so that runs of
+different commits can be compared:
+
+    python benchmark_relay.py --scenarios 1x1_30fps 10x20_60fps -o run.json
+
+Options for the server go last:
+
+    python benchmark_relay.py -o run.json --server-args --asyncio
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from frame_pacer import FramePacer
+from pose_protocol import (BODY_FRAME_SIZE, BODY_ID_SIZE, POSE_FRAME_SIZE,
+                           FrameReassembler, MSG_FRAME, MSG_BATCH,
+                           iter_batch_records)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+SCENARIOS = {
+    '1x1_30fps': {'producers': 1, 'consumers': 1, 'fps': 30},
+    '10x20_60fps': {'producers': 10, 'consumers': 20, 'fps': 60},
+    'slow_consumer': {'producers': 4, 'consumers': 4, 'fps': 60,
+                      'slow_consumers': 1},
+}
+
+# sequence number, producer index (uint32) and send time (int64 ns) at the
+# start of every frame, the rest holds the pattern. The sequence number comes
+# first, so a frame never starts with MESSAGE_MARKER.
+_HEADER_DTYPE = np.dtype([('seq', '<u4'), ('producer', '<u4'),
+                          ('time', '<i8')])
+_PATTERN_VALUES = (POSE_FRAME_SIZE - _HEADER_DTYPE.itemsize) // 4
+
+
+def _pattern(seq):
+    return np.full(_PATTERN_VALUES, (seq * 2654435761) & 0xffffffff,
+                   dtype=np.uint32)
+
+
+def _make_frame(producer, seq):
+    header = np.array([(seq, producer, time.perf_counter_ns())],
+                      dtype=_HEADER_DTYPE)
+    return header.tobytes() + _pattern(seq).tobytes()
+
+
+def _run_producers(port, num_producers, fps, duration, ready, results):
+    """Sends frames of num_producers producers at fps for duration seconds.
+
+    Runs in its own process, so that pacing and sending do not compete with
+    the consumers for the GIL.
+    """
+    socks = [socket.create_connection(('localhost', port))
+             for _ in range(num_producers)]
+    for sock in socks:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    ready.wait()
+    pacer = FramePacer(fps)
+    seq = 0
+    time_end = time.perf_counter() + duration
+    while time.perf_counter() < time_end:
+        pacer.wait()
+        for producer, sock in enumerate(socks):
+            sock.sendall(_make_frame(producer, seq))
+        seq += 1
+    stats = pacer.stats()
+    for sock in socks:
+        sock.close()
+    results.put({'frames_sent': seq * num_producers,
+                 'pacing_p99_ms': stats['p99_ms'],
+                 'pacing_max_ms': stats['max_ms']})
+
+
+class _Consumer:
+    def __init__(self, port, slow):
+        self.sock = socket.create_connection(('localhost', port))
+        if slow:
+            # keep the kernel from buffering on behalf of the consumer
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.sock.setblocking(False)
+        self.slow = slow
+        self.frames = FrameReassembler(BODY_FRAME_SIZE)
+        self.latencies = []
+        self.frames_received = 0
+        self.frames_torn = 0
+        self.frames_reordered = 0
+        # producer index -> last sequence number
+        self.last_seqs = {}
+        self.frames_missing = 0
+        # time.perf_counter_ns() at which the last frame arrived
+        self.time_last_frame = None
+
+
+    def handle_frame(self, frame, time_now, record_latency):
+        frame = frame[BODY_ID_SIZE:]
+        header = np.frombuffer(frame, dtype=_HEADER_DTYPE, count=1)[0]
+        seq = int(header['seq'])
+        producer = int(header['producer'])
+        self.frames_received += 1
+        self.time_last_frame = time_now
+        pattern = np.frombuffer(frame, dtype=np.uint32,
+                                offset=_HEADER_DTYPE.itemsize)
+        if not np.array_equal(pattern, _pattern(seq)):
+            self.frames_torn += 1
+            return
+        last_seq = self.last_seqs.get(producer)
+        if last_seq is not None:
+            if seq <= last_seq:
+                self.frames_reordered += 1
+                return
+            self.frames_missing += seq - last_seq - 1
+        self.last_seqs[producer] = seq
+        if record_latency:
+            self.latencies.append(time_now - int(header['time']))
+
+
+def _process_stats(pid):
+    """Returns the CPU time in seconds and the resident set size in bytes of
+    a process, or None if they can not be determined"""
+    if psutil is not None:
+        process = psutil.Process(pid)
+        times = process.cpu_times()
+        return times.user + times.system, process.memory_info().rss
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            # the process name may contain spaces, skip past it
+            fields = file.read().rpartition(')')[2].split()
+        with open(f'/proc/{pid}/statm') as file:
+            rss_pages = int(file.read().split()[1])
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return ((int(fields[11]) + int(fields[12])) / ticks,
+            rss_pages * os.sysconf('SC_PAGE_SIZE'))
+
+
+def _wait_for_port(port, timeout=10):
+    time_end = time.perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.perf_counter() > time_end:
+                raise
+            time.sleep(0.05)
+
+
+def _start_server(port, server_args, in_process):
+    """Returns the subprocess running the server, or None for a server that
+    runs in a thread of this process"""
+    if in_process:
+        from tcp_server import BodyPoseTcpServer
+        server = BodyPoseTcpServer('localhost', port, 128, True)
+        # The server runs until the benchmark exits
+        threading.Thread(target=server.start_server, args=(0,),
+                         daemon=True).start()
+        _wait_for_port(port)
+        return None
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'tcp_server.py')
+    process = subprocess.Popen(
+        [sys.executable, server_script, '-p', str(port), '-c', '128',
+         '-v', '0'] + shlex.split(server_args)
+    )
+    _wait_for_port(port)
+    return process
+
+
+def _stop_server(process):
+    if process is None:
+        return
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_scenario(name, producers, consumers, fps, duration=10.0,
+                 slow_consumers=0, slow_read_interval=0.1, warmup=1.0,
+                 port=7900, server_args='', in_process=False):
+    """Runs a benchmark scenario.
+
+    Args:
+        name (str): Name of the scenario, copied to the results.
+        producers (int): Number of producers.
+        consumers (int): Number of consumers, including slow ones.
+        fps (float): Frame rate of every producer.
+        duration (float): Time in seconds the producers send frames.
+        slow_consumers (int): Number of consumers that only read every
+            slow_read_interval seconds.
+        slow_read_interval (float): Time in seconds between two reads of a
+            slow consumer.
+        warmup (float): Latencies of frames received during the first
+            warmup seconds are not recorded.
+        port (int): Port of the server.
+        server_args (str): Additional command line arguments for
+            tcp_server.py, e.g. '--workers 4'.
+        in_process (bool): Whether to run the server in a thread of this
+            process instead of a subprocess. Server CPU usage is then
+            reported for the whole benchmark process.
+
+    Returns:
+        dict: Configuration and results of the scenario.
+    """
+    if slow_consumers > consumers:
+        raise ValueError("There can not be more slow consumers than "
+                         "consumers")
+    process = _start_server(port, server_args, in_process)
+    server_pid = process.pid if process is not None else os.getpid()
+    try:
+        results = _run_clients(
+            port, producers, consumers, fps, duration, slow_consumers,
+            slow_read_interval, warmup, server_pid
+        )
+    finally:
+        _stop_server(process)
+    results.update({
+        'scenario': name,
+        'config': {
+            'producers': producers, 'consumers': consumers, 'fps': fps,
+            'duration': duration, 'slow_consumers': slow_consumers,
+            'slow_read_interval': slow_read_interval, 'warmup': warmup,
+            'server_args': server_args, 'in_process': in_process,
+        },
+    })
+    return results
+
+
+def _run_clients(port, num_producers, num_consumers, fps, duration,
+                 num_slow_consumers, slow_read_interval, warmup, server_pid):
+    consumers = [_Consumer(port, slow=i < num_slow_consumers)
+                 for i in range(num_consumers)]
+    sel = selectors.DefaultSelector()
+    for consumer in consumers:
+        sel.register(consumer.sock, selectors.EVENT_READ, data=consumer)
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Event()
+    producer_results = ctx.Queue()
+    producer_process = ctx.Process(
+        target=_run_producers,
+        args=(port, num_producers, fps, duration, ready, producer_results)
+    )
+    producer_process.start()
+    # give the producers time to connect before the clock starts
+    time.sleep(0.5)
+    server_stats_start = _process_stats(server_pid)
+    max_rss = server_stats_start[1] if server_stats_start else None
+    ready.set()
+    time_start = time.perf_counter()
+    time_latency_start = time_start + warmup
+    # frames that are still in flight are collected after the producers stop
+    time_end = time_start + duration + 0.5
+    # slow consumers that are not registered, with the time they read next
+    slow_wakeups = {}
+    time_next_sample = time_start + 0.5
+    while True:
+        now = time.perf_counter()
+        if now >= time_end:
+            break
+        for consumer, wakeup in list(slow_wakeups.items()):
+            if wakeup <= now:
+                del slow_wakeups[consumer]
+                sel.register(consumer.sock, selectors.EVENT_READ,
+                             data=consumer)
+        timeout = min([time_end - now]
+                      + [wakeup - now for wakeup in slow_wakeups.values()])
+        for key, _ in sel.select(timeout=max(timeout, 0)):
+            consumer = key.data
+            try:
+                messages = consumer.frames.recv_messages(consumer.sock)
+            except BlockingIOError:
+                continue
+            if messages is None:
+                sel.unregister(consumer.sock)
+                continue
+            time_now = time.perf_counter_ns()
+            record_latency = time_now >= time_latency_start * 1e9
+            for msg_type, payload in messages:
+                if msg_type == MSG_FRAME:
+                    consumer.handle_frame(payload, time_now, record_latency)
+                elif msg_type == MSG_BATCH:
+                    for frame in iter_batch_records(payload):
+                        consumer.handle_frame(frame, time_now,
+                                              record_latency)
+            if consumer.slow:
+                sel.unregister(consumer.sock)
+                slow_wakeups[consumer] = time.perf_counter() \
+                    + slow_read_interval
+        if max_rss is not None and now >= time_next_sample:
+            stats = _process_stats(server_pid)
+            if stats is not None:
+                max_rss = max(max_rss, stats[1])
+            time_next_sample = now + 0.5
+    time_elapsed = time.perf_counter() - time_start
+    server_stats_end = _process_stats(server_pid)
+    producer_process.join(timeout=10)
+    sent = producer_results.get(timeout=10)
+    for consumer in consumers:
+        consumer.sock.close()
+    sel.close()
+
+    def summarize(group):
+        latencies = np.array(
+            [latency for consumer in group for latency in consumer.latencies],
+            dtype=np.float64
+        ) / 1e6
+        received = sum(consumer.frames_received for consumer in group)
+        # from the start of the producers to the last frame, without the
+        # time waited for frames in flight
+        times_last_frame = [c.time_last_frame for c in group
+                            if c.time_last_frame is not None]
+        receive_seconds = max(times_last_frame) / 1e9 - time_start \
+            if times_last_frame else 0.0
+        result = {
+            'consumers': len(group),
+            'frames_received': received,
+            'receive_seconds': receive_seconds,
+            'frames_per_second': received / receive_seconds
+            if receive_seconds > 0 else 0.0,
+            'frames_missing': sum(c.frames_missing for c in group),
+            'frames_torn': sum(c.frames_torn for c in group),
+            'frames_reordered': sum(c.frames_reordered for c in group),
+        }
+        if len(latencies):
+            result.update({
+                'latency_p50_ms': float(np.percentile(latencies, 50)),
+                'latency_p99_ms': float(np.percentile(latencies, 99)),
+                'latency_p999_ms': float(np.percentile(latencies, 99.9)),
+                'latency_max_ms': float(latencies.max()),
+            })
+        return result
+
+    results = {
+        'frames_sent': sent['frames_sent'],
+        'producer_pacing_p99_ms': sent['pacing_p99_ms'],
+        'producer_pacing_max_ms': sent['pacing_max_ms'],
+        'consumers': summarize(
+            [c for c in consumers if not c.slow]
+        ),
+    }
+    if num_slow_consumers:
+        results['slow_consumers'] = summarize(
+            [c for c in consumers if c.slow]
+        )
+    if server_stats_start is not None and server_stats_end is not None:
+        results['server_cpu_percent'] = 100 * (
+            server_stats_end[0] - server_stats_start[0]
+        ) / time_elapsed
+        results['server_rss_max_mb'] = max(max_rss, server_stats_end[1]) \
+            / 2 ** 20
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_results(results):
+    print(f"{results['scenario']}: {results['frames_sent']} frames sent")
+    groups = [('consumers', results['consumers'])]
+    if 'slow_consumers' in results:
+        groups.append(('slow consumers', results['slow_consumers']))
+    for label, group in groups:
+        line = (f"  {group['consumers']} {label}: "
+                f"{group['frames_per_second']:.0f} frames/s, "
+                f"{group['frames_missing']} missing, "
+                f"{group['frames_torn']} torn")
+        if 'latency_p50_ms' in group:
+            line += (f", latency p50 {group['latency_p50_ms']:.3f} ms, "
+                     f"p99 {group['latency_p99_ms']:.3f} ms, "
+                     f"p999 {group['latency_p999_ms']:.3f} ms")
+        print(line)
+    if 'server_cpu_percent' in results:
+        print(f"  server: {results['server_cpu_percent']:.1f} % CPU, "
+              f"{results['server_rss_max_mb']:.1f} MB RSS")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the pose server with synthetic producers and "
+                    "consumers on localhost."
+    )
+    parser.add_argument('--scenarios', nargs='+', default=['1x1_30fps'],
+                        choices=list(SCENARIOS) + ['custom'],
+                        help="Scenarios to run. 'custom' uses --producers, "
+                        "--consumers, --fps and --slow-consumers. Optional, "
+                        "defaults to 1x1_30fps")
+    parser.add_argument('--producers', type=int, default=1,
+                        help="Number of producers of the custom scenario. "
+                        "Optional, defaults to 1")
+    parser.add_argument('--consumers', type=int, default=1,
+                        help="Number of consumers of the custom scenario. "
+                        "Optional, defaults to 1")
+    parser.add_argument('--fps', type=float, default=30,
+                        help="Frame rate of the producers of the custom "
+                        "scenario. Optional, defaults to 30")
+    parser.add_argument('--slow-consumers', type=int, default=0,
+                        help="Number of slow consumers of the custom "
+                        "scenario. Optional, defaults to 0")
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help="Time in seconds the producers send frames. "
+                        "Optional, defaults to 10")
+    parser.add_argument('--warmup', type=float, default=1,
+                        help="Time in seconds at the start during which no "
+                        "latencies are recorded. Optional, defaults to 1")
+    parser.add_argument('-p', '--port', type=int, default=7900,
+                        help="Port of the server. Optional, defaults to 7900")
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER,
+                        default=[],
+                        help="Additional arguments for tcp_server.py. Has "
+                        "to be the last option, everything after it is "
+                        "passed on, e.g. --server-args --workers 4 "
+                        "--asyncio. Optional")
+    parser.add_argument('--in-process', action='store_true',
+                        help="If specified, the server runs in a thread of "
+                        "the benchmark instead of a subprocess. "
+                        "--server-args is ignored.")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="Path of a JSON file the results are written "
+                        "to. Optional, defaults to None")
+    args = parser.parse_args()
+    if args.in_process and len(args.scenarios) > 1:
+        parser.error("--in-process can only run a single scenario")
+    all_results = []
+    for name in args.scenarios:
+        scenario = SCENARIOS.get(name, {
+            'producers': args.producers, 'consumers': args.consumers,
+            'fps': args.fps, 'slow_consumers': args.slow_consumers,
+        })
+        results = run_scenario(name, duration=args.duration,
+                               warmup=args.warmup, port=args.port,
+                               server_args=shlex.join(args.server_args),
+                               in_process=args.in_process, **scenario)
+        _print_results(results)
+        all_results.append(results)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({'revision': _git_revision(),
+                       'python': sys.version.split()[0],
+                       'scenarios': all_results}, file, indent=2)
@@ -0,0 +1,193 @@
+"""Converts a directory of npz sequences to packed pose files.
+
+Every npz file below the input directory is transformed like
+BodyPoseTcpClient transforms the sequence it plays back (x-angle offset, yz
+swap and optionally dropping frames to a target frame rate) and written as a
+packed file (see pose_dataset) to the same relative path in the output
+directory. Producers play packed files back directly from the page cache:
+
+    python convert_dataset.py amass/ packed/ --fps 30
+    python tcp_client.py --producer -d packed/some/sequence.pose
+"""
+import argparse
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import path as osp
+from pose_dataset import (PACKED_EXTENSION, load_npz_attributes,
+                          transform_frames, write_packed)
+
+
+def convert_file(npz_file, output_file, pose_attribute, transl_attribute,
+                 capture_fps_attribute, angle, keep_yz_axes, target_fps=None,
+                 capture_fps=None):
+    """Converts an npz file to a packed pose file.
+
+    Args:
+        npz_file (str): Path of the npz file.
+        output_file (str): Path of the packed file.
+        pose_attribute (str): Name of the poses in the npz file.
+        transl_attribute (str): Name of the translations in the npz file.
+        capture_fps_attribute (str): Name of the capture frame rate in the npz
+            file.
+        angle (float): Angle in degrees by which the global orientation is
+            rotated around the x-axis.
+        keep_yz_axes (bool): If False, y and z axes of the translation are
+            swapped.
+        target_fps (float): Frame rate to drop frames to, like the
+            --drop-frames option of tcp_client.py. None keeps all frames.
+        capture_fps (float): Capture frame rate, overrides the value stored
+            in the npz file.
+
+    Raises:
+        ValueError: If the poses or translations are missing, or frames
+            should be dropped but the capture frame rate is unknown.
+
+    Returns:
+        tuple: Number of frames written and their frame rate.
+    """
+    poses, transl, file_fps = load_npz_attributes(
+        npz_file, pose_attribute, transl_attribute, capture_fps_attribute
+    )
+    if poses is None:
+        raise ValueError(f"No '{pose_attribute}' and '{transl_attribute}' "
+                         "fields")
+    if capture_fps is None:
+        capture_fps = file_fps
+    step = 1
+    fps = capture_fps
+    if target_fps is not None:
+        if capture_fps is None or capture_fps < 1:
+            raise ValueError(f"Unknown capture fps, no '{capture_fps_attribute}'"
+                             " field")
+        # same number of frames to advance as BodyPoseTcpClient
+        step = max(int(capture_fps / target_fps), 1)
+        fps = target_fps
+    frames = transform_frames(poses[::step], transl[::step], angle,
+                              keep_yz_axes)
+    os.makedirs(osp.dirname(output_file) or '.', exist_ok=True)
+    write_packed(output_file, frames, fps)
+    return len(frames), fps
+
+
+def find_npz_files(input_dir):
+    """Returns the paths of all npz files below input_dir, relative to it"""
+    npz_files = []
+    for root, _, files in os.walk(input_dir):
+        for name in files:
+            if name.endswith('.npz'):
+                npz_files.append(
+                    osp.relpath(osp.join(root, name), input_dir)
+                )
+    return sorted(npz_files)
+
+
+def convert_directory(input_dir, output_dir, workers=None, overwrite=False,
+                      verbosity=1, **kwargs):
+    """Converts all npz files below input_dir in parallel.
+
+    Args:
+        input_dir (str): Directory that is searched for npz files.
+        output_dir (str): Directory the packed files are written to, with
+            the same relative paths as the npz files.
+        workers (int): Number of processes. Defaults to the number of CPUs.
+        overwrite (bool): Whether to convert files whose packed file is newer
+            than the npz file again.
+        verbosity (int): Verbosity level.
+        **kwargs: Passed on to convert_file.
+
+    Returns:
+        int: Number of files that could not be converted.
+    """
+    jobs = {}
+    for rel_path in find_npz_files(input_dir):
+        npz_file = osp.join(input_dir, rel_path)
+        output_file = osp.join(output_dir, osp.splitext(rel_path)[0]
+                               + PACKED_EXTENSION)
+        if not overwrite and osp.isfile(output_file) \
+                and osp.getmtime(output_file) >= osp.getmtime(npz_file):
+            if verbosity > 1:
+                print(f"Skipping {rel_path}, already converted")
+            continue
+        jobs[rel_path] = (npz_file, output_file)
+    if verbosity > 0:
+        print(f"Converting {len(jobs)} files")
+    num_failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(convert_file, npz_file, output_file,
+                            **kwargs): rel_path
+            for rel_path, (npz_file, output_file) in jobs.items()
+        }
+        for future in as_completed(futures):
+            rel_path = futures[future]
+            try:
+                num_frames, fps = future.result()
+            except (ValueError, OSError, KeyError, zipfile.BadZipFile) as e:
+                # e.g. a truncated npz file or one without the fields
+                num_failed += 1
+                if verbosity > 0:
+                    print(f"Could not convert {rel_path}: {e}")
+                continue
+            if verbosity > 1:
+                print(f"Converted {rel_path}: {num_frames} frames at "
+                      f"{fps} fps")
+    if verbosity > 0:
+        print(f"Converted {len(jobs) - num_failed} of {len(jobs)} files")
+    return num_failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Converts npz sequences to packed pose files for "
+                    "producers"
+    )
+    parser.add_argument('input', type=str,
+                        help="Directory that is searched for npz files")
+    parser.add_argument('output', type=str,
+                        help="Directory the packed files are written to")
+    parser.add_argument('-a', '--angle', type=float, default=-90,
+                        help="<Optional> Angle (in deg) by which the global "
+                        "orientation should be rotated around the x-Axis in "
+                        "order to match Unity's default rotation. Defaults to "
+                        "-90°")
+    parser.add_argument('--keep-yz-axes', action='store_true', help="<Optional>"
+                        ". If specified, y and z Axes will not be swapped.")
+    parser.add_argument('--poses-field', type=str, default="poses",
+                        help="<Optional> Name of the npz field that contains "
+                        "the poses. Defaults to 'poses'.")
+    parser.add_argument('--transl-field', type=str, default="trans",
+                        help="<Optional> Name of the npz field that contains "
+                        "the translations. Defaults to 'trans'.")
+    parser.add_argument('--mocap-fps-field', type=str, default="mocap_frame_rate",
+                        help="<Optional> Name of the field that holds the "
+                        "capture frame rate value. Defaults to 'mocap_frame_rate'")
+    parser.add_argument('-f', '--fps', type=float, default=None,
+                        help="<Optional> Target frame rate. Frames are dropped "
+                        "to match it, which requires the capture frame rate. "
+                        "Defaults to None (keep all frames)")
+    parser.add_argument('--capture-fps', type=float, default=None,
+                        help="<Optional> Framerate with which the data was "
+                        "captured. Overwrites the value of the "
+                        "--mocap-fps-field. Defaults to None")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="<Optional> Number of processes. Defaults to the "
+                        "number of CPUs")
+    parser.add_argument('--overwrite', action='store_true', help="If "
+                        "specified, files that were already converted are "
+                        "converted again.")
+    parser.add_argument('-v', '--verbosity', type=int, default=1,
+                        help="<Optional> Verbosity setting. Defaults to 1")
+    args = parser.parse_args()
+    if args.fps is not None and args.fps <= 0:
+        parser.error(f"Invalid target fps: {args.fps}")
+    num_failed = convert_directory(
+        args.input, args.output, args.workers, args.overwrite,
+        args.verbosity, pose_attribute=args.poses_field,
+        transl_attribute=args.transl_field,
+        capture_fps_attribute=args.mocap_fps_field, angle=args.angle,
+        keep_yz_axes=args.keep_yz_axes, target_fps=args.fps,
+        capture_fps=args.capture_fps
+    )
+    if num_failed:
+        raise SystemExit(1)
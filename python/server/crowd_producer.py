@@ -0,0 +1,399 @@
+"""Replays many sequences at once from one process, as a crowd of bodies.
+
+Every stream plays a sequence (npz or packed file) from its own offset at its
+own frame rate. Streams of the same file share its frames, which are memory
+mapped if the file is packed or cached. On every tick, the frames of all
+streams that are due are gathered into one array and sent in a single
+MSG_STREAM_FRAMES message per connection. The server assigns a body ID to
+every stream of a connection:
+
+    python crowd_producer.py packed/a.pose packed/b.pose --repeat 50 \\
+        --offsets 0 2.5 --connections 2
+"""
+import argparse
+import selectors
+import socket
+import time
+import numpy as np
+from pose_dataset import (DEFAULT_CACHE_DIR, PACKED_EXTENSION, load_frames,
+                          open_packed)
+from pose_protocol import (BODY_FRAME_DTYPE, BODY_FRAME_SIZE, COUNT,
+                           MAX_MESSAGE_SIZE, FrameReassembler,
+                           MSG_END_STREAMS, MSG_SET_FRAMED,
+                           MSG_STREAMS_STARTED, decode_body_ids,
+                           encode_body_ids, encode_message,
+                           encode_stream_frames_header)
+
+# frames that fit into one MSG_STREAM_FRAMES message
+_MAX_MESSAGE_RECORDS = (MAX_MESSAGE_SIZE - COUNT.size) // BODY_FRAME_SIZE
+# seconds the server has to confirm a stream after its first frame
+STREAM_TIMEOUT = 2.0
+
+
+def load_sequences(fpaths, pose_attribute='poses', transl_attribute='trans',
+                   capture_fps_attribute='mocap_frame_rate', angle=-90,
+                   keep_yz_axes=False, cache_dir=DEFAULT_CACHE_DIR,
+                   verbosity=1):
+    """Loads every distinct file once, like BodyPoseTcpClient loads the
+    sequence of a producer.
+
+    Raises:
+        ValueError: If a file or its poses or translations do not exist.
+
+    Returns:
+        dict: Path -> float32 array of shape (N, 168) and capture fps (None
+            if unknown).
+    """
+    sequences = {}
+    for fpath in fpaths:
+        if fpath in sequences:
+            continue
+        if fpath.endswith(PACKED_EXTENSION):
+            sequences[fpath] = open_packed(fpath)
+            continue
+        frames, capture_fps = load_frames(
+            fpath, pose_attribute, transl_attribute, capture_fps_attribute,
+            angle, keep_yz_axes, cache_dir, verbosity
+        )
+        if frames is None:
+            raise ValueError(f"No '{pose_attribute}' and '{transl_attribute}' "
+                             f"fields in {fpath}")
+        sequences[fpath] = (frames, capture_fps)
+    return sequences
+
+
+class CrowdProducer:
+    def __init__(self, streams, host='localhost', port=7777,
+                 unix_socket_path=None, num_connections=1, loop=True,
+                 verbosity=1):
+        """
+        Args:
+            streams (list): Frames (array of shape (N, 168)), frame rate and
+                offset in seconds of every stream. Streams that play the
+                same sequence should share its array.
+            host (str): Host of the server.
+            port (int): Port of the server.
+            unix_socket_path (str): Path of a unix domain socket of the
+                server to connect to instead of host and port.
+            num_connections (int): Number of connections the streams are
+                distributed over.
+            loop (bool): Whether streams start over at the end of their
+                sequence, otherwise they end there.
+            verbosity (int): Verbosity level.
+        """
+        if not streams:
+            raise ValueError("No streams to replay")
+        if num_connections < 1 or num_connections > len(streams):
+            raise ValueError(f"Invalid number of connections: "
+                             f"{num_connections}")
+        self.host = host
+        self.port = port
+        self.unix_socket_path = unix_socket_path
+        self.num_connections = num_connections
+        self.loop = loop
+        self.verbosity = verbosity
+        sequences = []
+        # id of a frame array -> its index in sequences
+        sequence_indices = {}
+        stream_sequences = []
+        for frames, fps, offset in streams:
+            if fps is None or fps <= 0:
+                raise ValueError(f"Invalid stream fps: {fps}")
+            if len(frames) == 0:
+                raise ValueError("Can not replay an empty sequence")
+            if id(frames) not in sequence_indices:
+                sequence_indices[id(frames)] = len(sequences)
+                sequences.append(frames)
+            stream_sequences.append(sequence_indices[id(frames)])
+        stream_sequences = np.asarray(stream_sequences)
+        num_streams = len(streams)
+        self.fps = np.array([fps for _, fps, _ in streams], dtype=np.float64)
+        self.start_frames = np.array(
+            [int(offset * fps) for _, fps, offset in streams], dtype=np.int64
+        )
+        self.lengths = np.array([len(sequences[s]) for s in stream_sequences],
+                                dtype=np.int64)
+        # streams are distributed round robin, the stream index is sent in
+        # place of the body ID
+        stream_connections = np.arange(num_streams) % num_connections
+        # per connection, the sequences and the streams that play them, so
+        # the frames of a tick are gathered with one index per sequence
+        self.gather_plan = []
+        for c in range(num_connections):
+            plan = []
+            for s, frames in enumerate(sequences):
+                streams_of_sequence = np.flatnonzero(
+                    (stream_sequences == s) & (stream_connections == c)
+                )
+                if len(streams_of_sequence):
+                    plan.append((frames, streams_of_sequence))
+            self.gather_plan.append(plan)
+        self.stream_connections = stream_connections
+        # number of deadlines of every stream that have passed
+        self.frames_due = np.zeros(num_streams, dtype=np.int64)
+        self.active = np.ones(num_streams, dtype=bool)
+        # body ID the server assigned to every stream, 0 until it confirmed
+        # the stream
+        self.body_ids = np.zeros(num_streams, dtype=np.int64)
+        # time of the first frame of every stream the server did not
+        # confirm yet, inf if there was none
+        self.time_first_frames = np.full(num_streams, np.inf)
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.out = np.zeros(num_streams, dtype=BODY_FRAME_DTYPE)
+        # translation and pose of the records in self.out
+        self.out_values = self.out.view(np.float32) \
+            .reshape(num_streams, -1)[:, 1:]
+        self.socks = []
+        self.sel = None
+        self.time_start = None
+
+
+    def connect(self):
+        self.sel = selectors.DefaultSelector()
+        if self.unix_socket_path is not None:
+            server_addr = self.unix_socket_path
+        else:
+            server_addr = (self.host, self.port)
+        if self.verbosity > 0:
+            print(f'Connecting {self.num_connections} times to server at '
+                  f'{server_addr} ...', end=" ")
+        for _ in range(self.num_connections):
+            if self.unix_socket_path is not None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect(server_addr)
+            sock.sendall(encode_message(MSG_SET_FRAMED))
+            # sends block, reads only happen once select reports data
+            self.sel.register(sock, selectors.EVENT_READ,
+                              data=FrameReassembler(BODY_FRAME_SIZE))
+            self.socks.append(sock)
+        if self.verbosity > 0:
+            print("done")
+
+
+    def run(self):
+        if self.verbosity > 0:
+            print(f"Transmitting {len(self.active)} streams")
+        self.time_start = time.perf_counter()
+        try:
+            while self.active.any():
+                self._tick(time.perf_counter())
+                if not self.active.any():
+                    if self.verbosity > 0:
+                        print("Transmitted all poses, closing connections")
+                    break
+                next_due = self.frames_due[self.active] \
+                    / self.fps[self.active]
+                if not self._wait(self.time_start + next_due.min()):
+                    break
+                self._check_streams(time.perf_counter())
+        except KeyboardInterrupt:
+            if self.verbosity > 0:
+                print("Closing connections")
+        finally:
+            if self.verbosity > 0:
+                print(f"Sent {self.frames_sent} frames, skipped "
+                      f"{self.frames_skipped} frames that were late")
+            self.close()
+
+
+    def close(self):
+        for sock in self.socks:
+            self.sel.unregister(sock)
+            sock.close()
+        self.socks = []
+
+
+    def _tick(self, now):
+        """Sends the newest due frame of every stream"""
+        frames_due = np.floor((now - self.time_start) * self.fps) \
+            .astype(np.int64) + 1
+        due = self.active & (frames_due > self.frames_due)
+        # streams that fell behind skip to their newest frame
+        self.frames_skipped += int(
+            np.sum(frames_due[due] - self.frames_due[due] - 1)
+        )
+        positions = self.start_frames + frames_due - 1
+        if not self.loop:
+            ended = due & (positions >= self.lengths)
+            if ended.any():
+                self._end_streams(np.flatnonzero(ended))
+                due &= ~ended
+        self.time_first_frames[due & (self.frames_due == 0)] = now
+        self.frames_due[due] = frames_due[due]
+        positions %= self.lengths
+        for sock, plan in zip(self.socks, self.gather_plan):
+            num_records = 0
+            for frames, streams in plan:
+                streams = streams[due[streams]]
+                rows = slice(num_records, num_records + len(streams))
+                self.out['body_id'][rows] = streams
+                self.out_values[rows] = frames[positions[streams]]
+                num_records += len(streams)
+            for first in range(0, num_records, _MAX_MESSAGE_RECORDS):
+                records = self.out[first:min(first + _MAX_MESSAGE_RECORDS,
+                                             num_records)]
+                sock.sendall(encode_stream_frames_header(len(records))
+                             + records.tobytes())
+            self.frames_sent += num_records
+
+
+    def _end_streams(self, streams):
+        """Tells the server to release the bodies of streams that ended"""
+        self.active[streams] = False
+        for c, sock in enumerate(self.socks):
+            ended = streams[self.stream_connections[streams] == c]
+            if len(ended):
+                sock.sendall(encode_message(MSG_END_STREAMS,
+                                            encode_body_ids(ended)))
+        if self.verbosity > 1:
+            print(f"Streams {streams.tolist()} ended")
+
+
+    def _wait(self, deadline):
+        """Handles incoming data until the deadline.
+
+        Raises:
+            RuntimeError: If the server closed a connection before it
+                confirmed all of its streams.
+
+        Returns:
+            bool: False if the server closed a connection.
+        """
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return True
+            for key, _ in self.sel.select(timeout=remaining):
+                messages = key.data.recv_messages(key.fileobj)
+                if messages is None:
+                    if self.verbosity > 0:
+                        print("Server closed the connection")
+                    self._check_streams()
+                    return False
+                # servers send frames of other producers until the first
+                # frame of a connection arrives, they are skipped
+                for msg_type, payload in messages:
+                    if msg_type == MSG_STREAMS_STARTED:
+                        self._streams_started(payload)
+
+
+    def _streams_started(self, payload):
+        """Stores the body IDs of a MSG_STREAMS_STARTED message"""
+        values = decode_body_ids(payload)
+        streams = np.asarray(values[0::2], dtype=np.int64)
+        self.body_ids[streams] = values[1::2]
+        self.time_first_frames[streams] = np.inf
+        if self.verbosity > 1:
+            for stream, body_id in zip(values[0::2], values[1::2]):
+                print(f"Stream {stream} has body ID {body_id}")
+
+
+    def _check_streams(self, now=None):
+        """Raises a RuntimeError if the server did not confirm an active
+        stream within STREAM_TIMEOUT of its first frame, or at all if now is
+        None"""
+        late = self.active & np.isfinite(self.time_first_frames)
+        if now is not None:
+            late &= self.time_first_frames + STREAM_TIMEOUT <= now
+        late = np.flatnonzero(late)
+        if len(late):
+            raise RuntimeError(f"Server did not accept streams "
+                               f"{late.tolist()}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Producer that replays many sequences over few "
+                    "connections"
+    )
+    parser.add_argument('data', type=str, nargs='+',
+                        help="Paths of the .npz or packed .pose files to "
+                        "replay, one stream each")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="<Optional> Number of streams per file. Defaults "
+                        "to 1")
+    parser.add_argument('--offsets', type=float, nargs='+', default=[0.0],
+                        help="<Optional> Time in seconds into its sequence at "
+                        "which a stream starts, either one for all streams or "
+                        "one per stream (files times repeat, files first). "
+                        "Defaults to 0")
+    parser.add_argument('-f', '--fps', type=float, nargs='+', default=None,
+                        help="<Optional> Frame rate of the streams, either one "
+                        "for all streams or one per stream. Defaults to the "
+                        "capture frame rate of their file")
+    parser.add_argument('--connections', type=int, default=1,
+                        help="<Optional> Number of connections the streams "
+                        "are distributed over. Defaults to 1")
+    parser.add_argument('--noloop', action='store_true', help="If specified, "
+                        "every sequence is only replayed once and the server "
+                        "releases the body of a stream when it ends.")
+    parser.add_argument('--host', type=str, default="localhost",
+                        help="<Optional> Host of the server. Defaults to "
+                        "localhost")
+    parser.add_argument('-p', '--port', type=int, default=7777,
+                        help="<Optional> Port of the server. Defaults to 7777")
+    parser.add_argument('--unix-socket', type=str, default=None,
+                        help="<Optional> Path of a unix domain socket of the "
+                        "server to connect to instead of --host/--port. "
+                        "Defaults to None")
+    parser.add_argument('-a', '--angle', type=float, default=-90,
+                        help="<Optional> Angle (in deg) by which the global "
+                        "orientation should be rotated around the x-Axis in "
+                        "order to match Unity's default rotation. Defaults to "
+                        "-90°")
+    parser.add_argument('--keep-yz-axes', action='store_true', help="<Optional>"
+                        ". If specified, y and z Axes will not be swapped.")
+    parser.add_argument('--poses-field', type=str, default="poses",
+                        help="<Optional> Name of the npz field that contains "
+                        "the poses. Defaults to 'poses'.")
+    parser.add_argument('--transl-field', type=str, default="trans",
+                        help="<Optional> Name of the npz field that contains "
+                        "the translations. Defaults to 'trans'.")
+    parser.add_argument('--mocap-fps-field', type=str, default="mocap_frame_rate",
+                        help="<Optional> Name of the field that holds the "
+                        "capture frame rate value. Defaults to 'mocap_frame_rate'")
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help="<Optional> Directory in which the transformed "
+                        "poses of .npz files are cached. Defaults to "
+                        "~/.cache/body_pose_frames")
+    parser.add_argument('--no-cache', action='store_true', help="If "
+                        "specified, the transformed poses are not cached.")
+    parser.add_argument('-v', '--verbosity', type=int, default=1,
+                        help="<Optional> Verbosity setting. Defaults to 1")
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error(f"Invalid number of repetitions: {args.repeat}")
+    fpaths = args.data * args.repeat
+    for name in ('offsets', 'fps'):
+        values = getattr(args, name)
+        if values is not None and len(values) not in (1, len(fpaths)):
+            parser.error(f"Expected 1 or {len(fpaths)} values for --{name}, "
+                         f"got {len(values)}")
+    try:
+        sequences = load_sequences(
+            args.data, args.poses_field, args.transl_field,
+            args.mocap_fps_field, args.angle, args.keep_yz_axes,
+            None if args.no_cache else args.cache_dir, args.verbosity
+        )
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    streams = []
+    for i, fpath in enumerate(fpaths):
+        frames, capture_fps = sequences[fpath]
+        fps = capture_fps if args.fps is None \
+            else args.fps[i % len(args.fps)]
+        if fps is None:
+            parser.error(f"Unknown capture fps of {fpath}, set it with --fps")
+        streams.append((frames, fps, args.offsets[i % len(args.offsets)]))
+    try:
+        producer = CrowdProducer(streams, args.host, args.port,
+                                 args.unix_socket, args.connections,
+                                 not args.noloop, args.verbosity)
+    except ValueError as e:
+        parser.error(str(e))
+    producer.connect()
+    producer.run()
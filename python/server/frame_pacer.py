@@ -0,0 +1,127 @@
+"""Pacing of producers on a fixed schedule."""
+import asyncio
+import time
+import numpy as np
+
+
+class FramePacer:
+    """Releases frames at absolute deadlines start + n / fps.
+
+    Deadlines do not depend on when the previous frame was actually sent, so
+    delays do not add up over time. Waiting sleeps until shortly before the
+    deadline and spins for the rest, which keeps the CPU mostly idle while
+    still hitting the deadline precisely.
+
+    If the caller falls behind, frames are either sent back to back until the
+    schedule is met again or, with drop_frames, the frames whose deadlines
+    passed are skipped.
+    """
+    def __init__(self, fps, drop_frames=False, spin_time=0.002,
+                 max_catch_up=0.25, num_samples=4096):
+        """
+        Args:
+            fps (float): Target frame rate.
+            drop_frames (bool): Whether to skip frames whose deadline passed
+                instead of catching up.
+            spin_time (float): Time in seconds before a deadline from which on
+                the pacer spins instead of sleeping.
+            max_catch_up (float): Without drop_frames, the schedule is
+                restarted if the caller is more than this many seconds late,
+                instead of sending a long burst of frames.
+            num_samples (int): Number of recent frames the jitter statistics
+                are computed from.
+        """
+        if fps is None or fps <= 0:
+            raise ValueError(f"Invalid target fps: {fps}")
+        self.period = 1 / fps
+        self.drop_frames = drop_frames
+        self.spin_time = spin_time
+        self.max_catch_up = max_catch_up
+        # seconds between the deadline and the release of recent frames
+        self.lateness = np.zeros(num_samples)
+        self.reset()
+
+
+    def reset(self):
+        """Restarts the schedule, the first frame is due immediately"""
+        self.time_start = time.perf_counter()
+        self.next_frame = 0
+        self.frames_paced = 0
+        self.frames_skipped = 0
+        self.resyncs = 0
+        self.max_lateness = 0.0
+
+
+    def wait(self):
+        """Blocks until the deadline of the next frame.
+
+        Returns:
+            int: Number of frames the caller has to advance, larger than 1 if
+                frames were skipped.
+        """
+        deadline, num_frames = self._next_deadline()
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < deadline:
+            pass
+        self._record(deadline)
+        return num_frames
+
+
+    async def wait_async(self):
+        """Like wait, but sleeps on the event loop and does not spin"""
+        deadline, num_frames = self._next_deadline()
+        remaining = deadline - time.perf_counter()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        self._record(deadline)
+        return num_frames
+
+
+    def _next_deadline(self):
+        now = time.perf_counter()
+        deadline = self.time_start + self.next_frame * self.period
+        num_frames = 1
+        if now - deadline >= self.period:
+            if self.drop_frames:
+                num_skipped = int((now - deadline) / self.period)
+                self.next_frame += num_skipped
+                self.frames_skipped += num_skipped
+                num_frames += num_skipped
+                deadline = self.time_start + self.next_frame * self.period
+            elif now - deadline > self.max_catch_up:
+                self.time_start = now - self.next_frame * self.period
+                self.resyncs += 1
+                deadline = now
+        self.next_frame += 1
+        return deadline, num_frames
+
+
+    def _record(self, deadline):
+        lateness = time.perf_counter() - deadline
+        self.lateness[self.frames_paced % len(self.lateness)] = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.frames_paced += 1
+
+
+    def stats(self):
+        """Returns jitter statistics.
+
+        Returns:
+            dict: Number of paced, skipped frames and restarts of the
+                schedule, as well as mean, median, 99th percentile (of the
+                recent frames) and maximum lateness in milliseconds.
+        """
+        samples = self.lateness[:min(self.frames_paced, len(self.lateness))]
+        if len(samples) == 0:
+            samples = np.zeros(1)
+        return {
+            'frames': self.frames_paced,
+            'frames_skipped': self.frames_skipped,
+            'resyncs': self.resyncs,
+            'mean_ms': 1000 * float(np.mean(samples)),
+            'p50_ms': 1000 * float(np.percentile(samples, 50)),
+            'p99_ms': 1000 * float(np.percentile(samples, 99)),
+            'max_ms': 1000 * self.max_lateness,
+        }
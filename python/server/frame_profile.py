@@ -0,0 +1,115 @@
+"""Coordinate frames consumers can receive frames in.
+
+Producers send frames in one coordinate frame, e.g. as converted by
+pose_dataset.transform_frames. A consumer that needs another one declares a
+FrameProfile when it connects. The server converts every frame once per
+distinct profile of its consumers and sends the converted frame to all
+consumers with that profile, so consumers do not convert frames themselves.
+
+A profile rotates the global orientation around the x-axis, optionally swaps
+the y and z axes of the translation and then adds an offset to it.
+"""
+import numpy as np
+from pose_math import quat_multiply, quat_to_rotvec, rotvec_to_quat
+from pose_protocol import (FRAME_PROFILE, FRAME_PROFILE_SWAP_YZ,
+                           POSE_FRAME_VALUES)
+
+
+class FrameProfile:
+    def __init__(self, angle=0.0, swap_yz=False, offset=(0.0, 0.0, 0.0)):
+        """
+        Args:
+            angle (float): Angle in degrees by which the global orientation
+                is rotated around the x-axis.
+            swap_yz (bool): Whether the y and z axes of the translation are
+                swapped.
+            offset (tuple): Offset that is added to the translation, after
+                swapping its axes.
+        """
+        # profiles are sent as float32, rounding the values here makes a
+        # profile equal to itself after a round trip
+        values = np.asarray([angle, *offset], dtype=np.float32)
+        if values.shape != (4,) or not np.all(np.isfinite(values)):
+            raise ValueError(f"Invalid frame profile: angle {angle}, offset "
+                             f"{offset}")
+        self.angle = float(values[0])
+        self.swap_yz = bool(swap_yz)
+        self.offset = tuple(float(value) for value in values[1:])
+        self.rotation = rotvec_to_quat([np.deg2rad(self.angle), 0.0, 0.0])
+
+
+    @classmethod
+    def decode(cls, payload):
+        """Returns the profile of a MSG_SET_FRAME_PROFILE message"""
+        if len(payload) != FRAME_PROFILE.size:
+            raise ValueError(f"Invalid frame profile of {len(payload)} bytes")
+        angle, flags, *offset = FRAME_PROFILE.unpack(payload)
+        return cls(angle, flags & FRAME_PROFILE_SWAP_YZ, offset)
+
+
+    def encode(self):
+        """Returns the payload of a MSG_SET_FRAME_PROFILE message"""
+        flags = FRAME_PROFILE_SWAP_YZ if self.swap_yz else 0
+        return FRAME_PROFILE.pack(self.angle, flags, *self.offset)
+
+
+    @property
+    def is_identity(self):
+        return self.angle == 0 and not self.swap_yz \
+            and self.offset == (0.0, 0.0, 0.0)
+
+
+    def __eq__(self, other):
+        return isinstance(other, FrameProfile) and self._key() == other._key()
+
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+    def __repr__(self):
+        return (f"FrameProfile(angle={self.angle}, swap_yz={self.swap_yz}, "
+                f"offset={self.offset})")
+
+
+    def _key(self):
+        return self.angle, self.swap_yz, self.offset
+
+
+    def apply(self, frames):
+        """Converts frames to the profile.
+
+        Args:
+            frames (np.ndarray): Array of shape (N, 168).
+
+        Returns:
+            np.ndarray: Converted float32 array of shape (N, 168).
+        """
+        frames = np.asarray(frames, dtype=np.float32)
+        converted = frames.copy()
+        if self.angle:
+            # same as pose_dataset.rotate_global_orientation
+            converted[:, 3:6] = quat_to_rotvec(quat_multiply(
+                self.rotation, rotvec_to_quat(frames[:, 3:6])
+            ))
+        if self.swap_yz:
+            converted[:, 1] = frames[:, 2]
+            converted[:, 2] = frames[:, 1]
+        converted[:, :3] += self.offset
+        return converted
+
+
+    def apply_frame(self, pose):
+        """Returns a frame of 168 float32 values converted to the profile"""
+        return self.apply(
+            np.frombuffer(pose, dtype=np.float32).reshape(1, -1)
+        ).tobytes()
+
+
+    def apply_body_frames(self, body_frames):
+        """Returns consecutive body frames with their frames converted to the
+        profile and their body IDs unchanged"""
+        values = np.frombuffer(body_frames, dtype=np.float32) \
+            .reshape(-1, 1 + POSE_FRAME_VALUES).copy()
+        values[:, 1:] = self.apply(values[:, 1:])
+        return values.tobytes()
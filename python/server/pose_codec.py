@@ -0,0 +1,228 @@
+"""Compact encodings of pose frames.
+
+A frame of 168 float32 values (672 bytes) can be encoded as
+
+- ENCODING_FLOAT16: 168 float16 values (336 bytes).
+- ENCODING_QUANTIZED: the translation as float32 and the axis-angle values as
+  int16 fixed point numbers with a step of 2^-12 rad (342 bytes).
+- ENCODING_DELTA: the difference to the previous frame of the same body, the
+  translation as int16 with a step of 2^-12 m and the axis-angle values as
+  int8 with a step of 2^-9 rad (171 bytes). A raw keyframe is sent whenever a
+  difference does not fit, and periodically, so that a receiver can start
+  decoding at any time.
+
+Encoded frames start with a byte that names their format, so a decoder does
+not need to know which encoding the sender chose. Delta frames are computed
+against the frame the decoder reconstructs, not against the original frame,
+so quantization errors do not accumulate.
+"""
+import numpy as np
+from pose_protocol import POSE_FRAME_VALUES
+
+ENCODING_RAW = 0
+ENCODING_FLOAT16 = 1
+ENCODING_QUANTIZED = 2
+ENCODING_DELTA = 3
+
+ENCODINGS = {
+    'raw': ENCODING_RAW,
+    'float16': ENCODING_FLOAT16,
+    'quantized': ENCODING_QUANTIZED,
+    'delta': ENCODING_DELTA,
+}
+
+_NUM_TRANSL = 3
+_NUM_POSE = POSE_FRAME_VALUES - _NUM_TRANSL
+
+_QUANTIZED_STEP = np.float32(2 ** -12)
+_QUANTIZED_POSE_SIZE = 2 * _NUM_POSE
+_DELTA_STEPS = np.concatenate((
+    np.full(_NUM_TRANSL, 2 ** -12, dtype=np.float32),
+    np.full(_NUM_POSE, 2 ** -9, dtype=np.float32)
+))
+_DELTA_LIMITS = np.concatenate((
+    np.full(_NUM_TRANSL, np.iinfo(np.int16).max, dtype=np.float32),
+    np.full(_NUM_POSE, np.iinfo(np.int8).max, dtype=np.float32)
+))
+
+# size in bytes of the data following the format byte
+FORMAT_SIZES = {
+    ENCODING_RAW: 4 * POSE_FRAME_VALUES,
+    ENCODING_FLOAT16: 2 * POSE_FRAME_VALUES,
+    ENCODING_QUANTIZED: 4 * _NUM_TRANSL + _QUANTIZED_POSE_SIZE,
+    ENCODING_DELTA: 2 * _NUM_TRANSL + _NUM_POSE,
+}
+
+
+def encode_frames(frames, encoding):
+    """Encodes frames with a stateless encoding.
+
+    Args:
+        frames (np.ndarray): float32 array of shape (N, 168).
+        encoding (int): ENCODING_RAW, ENCODING_FLOAT16 or ENCODING_QUANTIZED.
+
+    Returns:
+        np.ndarray: uint8 array of shape (N, FORMAT_SIZES[encoding]), without
+            the format byte.
+    """
+    frames = np.asarray(frames, dtype=np.float32).reshape(-1, POSE_FRAME_VALUES)
+    if encoding == ENCODING_RAW:
+        encoded = frames
+    elif encoding == ENCODING_FLOAT16:
+        encoded = frames.astype(np.float16)
+    elif encoding == ENCODING_QUANTIZED:
+        quantized = np.clip(np.rint(frames[:, _NUM_TRANSL:] / _QUANTIZED_STEP),
+                            np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+        encoded = np.concatenate(
+            (frames[:, :_NUM_TRANSL].view(np.uint8),
+             quantized.astype(np.int16).view(np.uint8)),
+            axis=1
+        )
+    else:
+        raise ValueError(f"Encoding {encoding} is not stateless")
+    return np.ascontiguousarray(encoded).view(np.uint8).reshape(
+        len(frames), FORMAT_SIZES[encoding]
+    )
+
+
+def decode_frames(data, encoding):
+    """Decodes frames of a stateless encoding.
+
+    Args:
+        data (np.ndarray): uint8 array of shape (N, FORMAT_SIZES[encoding]).
+        encoding (int): ENCODING_RAW, ENCODING_FLOAT16 or ENCODING_QUANTIZED.
+
+    Returns:
+        np.ndarray: float32 array of shape (N, 168).
+    """
+    data = np.ascontiguousarray(data, dtype=np.uint8).reshape(
+        -1, FORMAT_SIZES[encoding]
+    )
+    if encoding == ENCODING_RAW:
+        return data.view(np.float32).copy()
+    if encoding == ENCODING_FLOAT16:
+        return data.view(np.float16).astype(np.float32)
+    if encoding == ENCODING_QUANTIZED:
+        frames = np.empty((len(data), POSE_FRAME_VALUES), dtype=np.float32)
+        transl_size = 4 * _NUM_TRANSL
+        frames[:, :_NUM_TRANSL] = \
+            np.ascontiguousarray(data[:, :transl_size]).view(np.float32)
+        frames[:, _NUM_TRANSL:] = np.ascontiguousarray(
+            data[:, transl_size:]
+        ).view(np.int16) * _QUANTIZED_STEP
+        return frames
+    raise ValueError(f"Encoding {encoding} is not stateless")
+
+
+def _delta_values(data):
+    transl = np.frombuffer(data, dtype=np.int16, count=_NUM_TRANSL)
+    pose = np.frombuffer(data, dtype=np.int8, offset=2 * _NUM_TRANSL)
+    return np.concatenate((transl, pose)).astype(np.float32)
+
+
+class PoseEncoder:
+    def __init__(self, encoding, keyframe_interval=30):
+        """
+        Args:
+            encoding (int): One of the ENCODING_* values.
+            keyframe_interval (int): With ENCODING_DELTA, every
+                keyframe_interval-th frame of a body is a keyframe.
+        """
+        if encoding not in FORMAT_SIZES:
+            raise ValueError(f"Unknown encoding {encoding}")
+        if keyframe_interval < 1:
+            raise ValueError(f"Invalid keyframe interval: {keyframe_interval}")
+        self.encoding = encoding
+        self.keyframe_interval = keyframe_interval
+        # body ID -> (frame reconstructed by the decoder, frames since the
+        # last keyframe), for ENCODING_DELTA
+        self.references = {}
+
+
+    @property
+    def stateless(self):
+        return self.encoding != ENCODING_DELTA
+
+
+    def encode(self, body_id, frame):
+        """Encodes a frame.
+
+        Args:
+            body_id (int): Body the frame belongs to.
+            frame (bytes-like | np.ndarray): 168 float32 values.
+
+        Returns:
+            bytes: The format byte followed by the encoded frame.
+        """
+        if isinstance(frame, np.ndarray):
+            values = frame.astype(np.float32, copy=False).reshape(-1)
+        else:
+            values = np.frombuffer(frame, dtype=np.float32)
+        if self.stateless:
+            return bytes((self.encoding,)) \
+                + encode_frames(values, self.encoding).tobytes()
+        reference, num_frames = self.references.get(body_id, (None, 0))
+        if reference is not None and num_frames < self.keyframe_interval:
+            steps = np.rint((values - reference) / _DELTA_STEPS)
+            if np.all(np.abs(steps) <= _DELTA_LIMITS):
+                # Same operations as in PoseDecoder, so that both sides
+                # end up with exactly the same reference
+                self.references[body_id] = (
+                    reference + steps * _DELTA_STEPS, num_frames + 1
+                )
+                return (bytes((ENCODING_DELTA,))
+                        + steps[:_NUM_TRANSL].astype(np.int16).tobytes()
+                        + steps[_NUM_TRANSL:].astype(np.int8).tobytes())
+        self.references[body_id] = (values.copy(), 1)
+        return bytes((ENCODING_RAW,)) + values.tobytes()
+
+
+    def forget(self, body_id):
+        """Drops the reference frame of a body that left"""
+        self.references.pop(body_id, None)
+
+
+class PoseDecoder:
+    def __init__(self):
+        # body ID -> last decoded frame, reference for delta frames
+        self.references = {}
+
+
+    def decode(self, body_id, data):
+        """Decodes an encoded frame.
+
+        Args:
+            body_id (int): Body the frame belongs to.
+            data (bytes-like): Format byte followed by the encoded frame.
+
+        Raises:
+            ValueError: If the frame is malformed or is a delta frame without
+                a preceding keyframe.
+
+        Returns:
+            np.ndarray: The 168 float32 values of the frame.
+        """
+        if len(data) == 0:
+            raise ValueError("Empty frame")
+        fmt = data[0]
+        size = FORMAT_SIZES.get(fmt)
+        if size is None:
+            raise ValueError(f"Unknown frame format {fmt}")
+        if len(data) != size + 1:
+            raise ValueError(f"Frame of format {fmt} has {len(data) - 1} "
+                             f"bytes, expected {size}")
+        if fmt == ENCODING_DELTA:
+            reference = self.references.get(body_id)
+            if reference is None:
+                raise ValueError(f"Delta frame of body {body_id} without "
+                                 "keyframe")
+            values = reference + _delta_values(data[1:]) * _DELTA_STEPS
+        else:
+            values = decode_frames(np.frombuffer(data, dtype=np.uint8,
+                                                 offset=1), fmt)[0]
+        self.references[body_id] = values
+        return values
+
+
+    def forget(self, body_id):
+        self.references.pop(body_id, None)
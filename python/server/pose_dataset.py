@@ -0,0 +1,264 @@
+"""Loading of motion sequences for producers.
+
+Sequences are stored in npz files (e.g. from AMASS) with separate pose and
+translation arrays in another coordinate system. Producers send frames of the
+translation followed by the pose, transformed to the coordinate system of
+SMPL-X. Doing this for a long sequence takes a while and holds several copies
+of it in memory, so the transformed frames are cached in packed files:
+
+    PACKED_HEADER (padded to PACKED_HEADER_SIZE bytes), followed by
+    frame_count frames of 168 little endian float32 values
+
+The frames of a packed file are exactly what producers send, so they are
+memory mapped and sent without conversion. Processes that play back the
+same sequence share its pages in the page cache.
+"""
+import hashlib
+import json
+import os
+import struct
+from os import path as osp
+import numpy as np
+import quaternion
+from pose_protocol import POSE_FRAME_SIZE, POSE_FRAME_VALUES
+
+PACKED_MAGIC = b'POSEPACK'
+PACKED_VERSION = 1
+# magic, version, capture fps (NaN if unknown), number of frames
+PACKED_HEADER = struct.Struct('<8sIdQ')
+# frames start at a multiple of their size in float32 values
+PACKED_HEADER_SIZE = 64
+PACKED_EXTENSION = '.pose'
+
+DEFAULT_CACHE_DIR = osp.join(osp.expanduser('~'), '.cache', 'body_pose_frames')
+
+
+def rotate_global_orientation(poses, angle):
+    """Rotates the global orientation of the poses around the x-axis, in place.
+
+    Alternatively, see
+    https://math.stackexchange.com/questions/382760/composition-of-two-axis-angle-rotations
+
+    Args:
+        poses (np.ndarray): Axis-angle poses of shape (N, 3 * joints), the
+            first three values are the global orientation.
+        angle (float): Angle in degrees.
+    """
+    quats = quaternion.from_rotation_vector(poses[:, :3])
+    rotX = quaternion.from_rotation_vector(
+        np.asarray([1, 0, 0]) * np.deg2rad(angle)
+    )
+    poses[:, :3] = quaternion.as_rotation_vector(rotX * quats)
+
+
+def swap_translation_yz_axes(arr):
+    if len(arr.shape) == 1:
+        arr = arr[np.newaxis, ...]
+    return arr[:, [0,2,1]]
+    # Deprecated
+    # swap_yz_mat = np.asarray(
+    #             [
+    #                 [1,0,0],
+    #                 [0,0,1],
+    #                 [0,1,0]
+    #             ],
+    #             dtype=np.float32
+    #         )
+    # # swap y and z Axis to conform to Unity's coordinate system
+    # return np.einsum('ij,kj->ki', swap_yz_mat, arr)
+
+
+def load_npz_attributes(npz_file, pose_attribute, transl_attribute,
+                        capture_fps_attribute):
+    """Returns the poses, translations and capture fps of an npz file.
+
+    Poses and translations are None if the file or one of them does not
+    exist, the capture fps is None if it is not stored in the file.
+    """
+    if not osp.isfile(npz_file):
+        return None, None, None
+    with np.load(npz_file) as content:
+        if pose_attribute not in content.files \
+                or transl_attribute not in content.files:
+            return None, None, None
+        capture_fps = None
+        if capture_fps_attribute in content.files:
+            capture_fps = float(content[capture_fps_attribute])
+        return content[pose_attribute], content[transl_attribute], capture_fps
+
+
+def transform_frames(poses, transl, angle, keep_yz_axes):
+    """Converts poses and translations to frames as sent by producers.
+
+    Args:
+        poses (np.ndarray): Axis-angle poses of shape (N, 165).
+        transl (np.ndarray): Translations of shape (N, 3).
+        angle (float): Angle in degrees by which the global orientation is
+            rotated around the x-axis.
+        keep_yz_axes (bool): If False, y and z axes of the translation are
+            swapped.
+
+    Returns:
+        np.ndarray: float32 array of shape (N, 168).
+    """
+    frames = np.empty((len(poses), POSE_FRAME_VALUES), dtype=np.float32)
+    frames[:, 3:] = poses
+    # in float64, like the rest of the quaternion math
+    orientation = poses[:, :3].astype(np.float64)
+    rotate_global_orientation(orientation, angle)
+    frames[:, 3:6] = orientation
+    frames[:, :3] = transl if keep_yz_axes \
+        else swap_translation_yz_axes(transl)
+    return frames
+
+
+def write_packed(fpath, frames, capture_fps=None):
+    """Writes frames to a packed file.
+
+    The file is written under a temporary name and renamed, so that other
+    processes never see a partial file.
+
+    Args:
+        fpath (str): Path of the file.
+        frames (np.ndarray): Array of shape (N, 168).
+        capture_fps (float): Frame rate of the sequence, None if unknown.
+    """
+    header = PACKED_HEADER.pack(
+        PACKED_MAGIC, PACKED_VERSION,
+        capture_fps if capture_fps is not None else float('nan'), len(frames)
+    )
+    tmp_path = f'{fpath}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(header.ljust(PACKED_HEADER_SIZE, b'\0'))
+        np.ascontiguousarray(frames, dtype='<f4').tofile(file)
+    os.replace(tmp_path, fpath)
+
+
+def read_packed_header(file):
+    """Returns the capture fps (None if unknown) and the number of frames of
+    an open packed file"""
+    header = file.read(PACKED_HEADER_SIZE)
+    if len(header) < PACKED_HEADER_SIZE:
+        raise ValueError("Truncated header of packed pose file")
+    magic, version, capture_fps, num_frames = PACKED_HEADER.unpack_from(header)
+    if magic != PACKED_MAGIC:
+        raise ValueError("Not a packed pose file")
+    if version != PACKED_VERSION:
+        raise ValueError(f"Unsupported version {version} of packed pose file")
+    return None if np.isnan(capture_fps) else capture_fps, num_frames
+
+
+def open_packed(fpath):
+    """Memory maps the frames of a packed file.
+
+    Returns:
+        tuple: Read-only float32 array of shape (N, 168) and the capture fps
+            (None if unknown).
+    """
+    with open(fpath, 'rb') as file:
+        capture_fps, num_frames = read_packed_header(file)
+        file_size = os.fstat(file.fileno()).st_size
+    if file_size != PACKED_HEADER_SIZE + num_frames * POSE_FRAME_SIZE:
+        raise ValueError(f"Packed pose file {fpath} has {file_size} bytes, "
+                         f"expected {num_frames} frames")
+    if num_frames == 0:
+        # np.memmap can not map empty files
+        return np.empty((0, POSE_FRAME_VALUES), dtype='<f4'), capture_fps
+    frames = np.memmap(fpath, dtype='<f4', mode='r',
+                       offset=PACKED_HEADER_SIZE,
+                       shape=(num_frames, POSE_FRAME_VALUES))
+    return frames, capture_fps
+
+
+def _hash_file(fpath, cache_dir):
+    """Returns the SHA-256 of a file's content.
+
+    Hashing a large file takes longer than mapping its cached frames, so the
+    hash is remembered in the cache directory for the file's path, size and
+    modification time.
+    """
+    stat = os.stat(fpath)
+    stat_key = hashlib.sha256(json.dumps(
+        [osp.abspath(fpath), stat.st_size, stat.st_mtime_ns]
+    ).encode()).hexdigest()
+    hash_path = osp.join(cache_dir, stat_key + '.sha256')
+    try:
+        with open(hash_path) as file:
+            return file.read()
+    except OSError:
+        pass
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as file:
+        while True:
+            chunk = file.read(1 << 20)
+            if not chunk:
+                break
+            digest.update(chunk)
+    tmp_path = f'{hash_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(digest.hexdigest())
+    os.replace(tmp_path, hash_path)
+    return digest.hexdigest()
+
+
+def cache_key(npz_file, pose_attribute, transl_attribute,
+              capture_fps_attribute, angle, keep_yz_axes, cache_dir):
+    """Returns the name of the cache file of a transformed sequence"""
+    file_hash = _hash_file(npz_file, cache_dir)
+    params = json.dumps([PACKED_VERSION, file_hash, pose_attribute,
+                         transl_attribute, capture_fps_attribute, float(angle),
+                         bool(keep_yz_axes)])
+    return hashlib.sha256(params.encode()).hexdigest() + PACKED_EXTENSION
+
+
+def load_frames(npz_file, pose_attribute, transl_attribute,
+                capture_fps_attribute, angle, keep_yz_axes,
+                cache_dir=DEFAULT_CACHE_DIR, verbosity=1):
+    """Loads a sequence from an npz file as frames ready to send.
+
+    Args:
+        npz_file (str): Path to the npz file.
+        pose_attribute (str): Name of the poses in the npz file.
+        transl_attribute (str): Name of the translations in the npz file.
+        capture_fps_attribute (str): Name of the capture frame rate in the
+            npz file.
+        angle (float): Angle in degrees by which the global orientation is
+            rotated around the x-axis.
+        keep_yz_axes (bool): If False, y and z axes of the translation are
+            swapped.
+        cache_dir (str): Directory of the cache of transformed sequences.
+            None disables the cache.
+        verbosity (int): Verbosity level.
+
+    Returns:
+        tuple: float32 array of shape (N, 168), memory mapped if it comes from
+            the cache, and the capture fps. The frames are None if the file
+            or its poses or translations do not exist, the capture fps is
+            None if it is unknown.
+    """
+    if not osp.isfile(npz_file):
+        return None, None
+    cache_path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = osp.join(cache_dir, cache_key(
+            npz_file, pose_attribute, transl_attribute, capture_fps_attribute,
+            angle, keep_yz_axes, cache_dir
+        ))
+        if osp.isfile(cache_path):
+            if verbosity > 1:
+                print(f"Using cached frames {cache_path}")
+            return open_packed(cache_path)
+    poses, transl, capture_fps = load_npz_attributes(
+        npz_file, pose_attribute, transl_attribute, capture_fps_attribute
+    )
+    if poses is None:
+        return None, capture_fps
+    frames = transform_frames(poses, transl, angle, keep_yz_axes)
+    if cache_path is None:
+        return frames, capture_fps
+    del poses, transl
+    write_packed(cache_path, frames, capture_fps)
+    if verbosity > 1:
+        print(f"Cached frames in {cache_path}")
+    return open_packed(cache_path)
@@ -0,0 +1,93 @@
+"""Recent frames of every body, kept by the server for late joining
+consumers.
+
+Every body gets a preallocated ring of the last N body frames and the times
+they were received. Frames are numbered per body from 0 in the order the
+server received them, so a consumer that got frames up to a sequence number
+can ask for the ones that followed. Consecutive frames are stored next to
+each other, so a range of frames is at most two slices of the ring and is
+sent without copying frames individually.
+"""
+import numpy as np
+from pose_protocol import BODY_FRAME_SIZE
+
+# receive times are sent as they are stored
+TIME_DTYPE = np.dtype('>f8')
+
+
+class _BodyRing:
+    def __init__(self, capacity):
+        self.frames = np.empty((capacity, BODY_FRAME_SIZE), dtype=np.uint8)
+        self.times = np.empty(capacity, dtype=TIME_DTYPE)
+        # sequence number of the next frame
+        self.next_seq = 0
+
+
+class PoseHistory:
+    def __init__(self, capacity):
+        """
+        Args:
+            capacity (int): Number of frames that are kept per body.
+        """
+        if capacity < 1:
+            raise ValueError(f"Invalid history capacity: {capacity}")
+        self.capacity = capacity
+        # body ID -> _BodyRing
+        self.rings = {}
+
+
+    def append(self, body_id, body_id_bytes, pose, time_received):
+        """Stores a frame, overwriting the oldest one of the body if its ring
+        is full"""
+        ring = self.rings.get(body_id)
+        if ring is None:
+            ring = self.rings[body_id] = _BodyRing(self.capacity)
+        slot = ring.next_seq % self.capacity
+        frame = ring.frames[slot]
+        frame[:4] = np.frombuffer(body_id_bytes, dtype=np.uint8)
+        frame[4:] = np.frombuffer(pose, dtype=np.uint8)
+        ring.times[slot] = time_received
+        ring.next_seq += 1
+
+
+    def forget(self, body_id):
+        self.rings.pop(body_id, None)
+
+
+    def body_ids(self):
+        return list(self.rings)
+
+
+    def last(self, body_id, num_frames):
+        """Returns the newest num_frames frames of a body, see frames_since"""
+        ring = self.rings.get(body_id)
+        next_seq = ring.next_seq if ring is not None else 0
+        return self.frames_since(body_id, next_seq - num_frames)
+
+
+    def frames_since(self, body_id, seq):
+        """Returns the frames of a body from sequence number seq on.
+
+        Frames that were already overwritten are left out.
+
+        Returns:
+            tuple: Sequence number of the first frame, number of frames, and
+                lists of the slices of the receive times and of the body
+                frames as flat uint8 arrays, in the order they were received.
+        """
+        ring = self.rings.get(body_id)
+        if ring is None:
+            return 0, 0, [], []
+        first_seq = max(seq, ring.next_seq - self.capacity, 0)
+        num_frames = max(ring.next_seq - first_seq, 0)
+        if num_frames == 0:
+            return ring.next_seq, 0, [], []
+        start = first_seq % self.capacity
+        end = start + num_frames
+        if end <= self.capacity:
+            ranges = [(start, end)]
+        else:
+            ranges = [(start, self.capacity), (0, end - self.capacity)]
+        times = [ring.times[a:b].view(np.uint8) for a, b in ranges]
+        frames = [ring.frames[a:b].reshape(-1) for a, b in ranges]
+        return first_seq, num_frames, times, frames
@@ -0,0 +1,79 @@
+"""Vectorized rotation math on axis-angle poses.
+
+Quaternions are float arrays whose last axis holds (w, x, y, z). All
+functions work on arrays of any leading shape, e.g. (bodies, joints, 3)
+rotation vectors, so the joints of many bodies are processed in one call.
+"""
+import numpy as np
+
+# below this angle (in radians) between two quaternions, slerp falls back to
+# linear interpolation
+_SLERP_EPSILON = 1e-6
+
+
+def rotvec_to_quat(rotvecs):
+    """Converts rotation vectors of shape (..., 3) to unit quaternions of
+    shape (..., 4)"""
+    rotvecs = np.asarray(rotvecs, dtype=np.float64)
+    angles = np.linalg.norm(rotvecs, axis=-1, keepdims=True)
+    quats = np.empty(rotvecs.shape[:-1] + (4,))
+    quats[..., :1] = np.cos(angles / 2)
+    # sin(angle / 2) / angle without dividing by zero
+    quats[..., 1:] = rotvecs * (0.5 * np.sinc(angles / (2 * np.pi)))
+    return quats
+
+
+def quat_to_rotvec(quats):
+    """Converts unit quaternions of shape (..., 4) to rotation vectors of
+    shape (..., 3) with angles in [0, pi]"""
+    quats = np.asarray(quats, dtype=np.float64)
+    # q and -q are the same rotation, the one with w >= 0 has the smaller
+    # angle
+    quats = np.where(quats[..., :1] < 0, -quats, quats)
+    sin_half = np.linalg.norm(quats[..., 1:], axis=-1, keepdims=True)
+    angles = 2 * np.arctan2(sin_half, quats[..., :1])
+    # angle / sin(angle / 2) tends to 2 for small angles
+    scale = np.divide(angles, sin_half, out=np.full_like(angles, 2.0),
+                      where=sin_half > _SLERP_EPSILON)
+    return quats[..., 1:] * scale
+
+
+def quat_multiply(q1, q2):
+    """Returns the Hamilton products q1 * q2 of two quaternion arrays"""
+    w1, x1, y1, z1 = np.moveaxis(np.asarray(q1), -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(np.asarray(q2), -1, 0)
+    return np.stack([
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+    ], axis=-1)
+
+
+def slerp(q0, q1, t):
+    """Spherical linear interpolation between unit quaternions along the
+    shorter arc.
+
+    Args:
+        q0 (np.ndarray): Quaternions of shape (..., 4) at t = 0.
+        q1 (np.ndarray): Quaternions of the same shape at t = 1.
+        t (np.ndarray): Interpolation parameters that broadcast against
+            q0[..., 0]. Values above 1 extrapolate the rotation.
+
+    Returns:
+        np.ndarray: Unit quaternions of the shape of q0.
+    """
+    t = np.asarray(t, dtype=np.float64)[..., np.newaxis]
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.minimum(np.abs(dot), 1.0)
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+    small = sin_theta < _SLERP_EPSILON
+    # weights of linear interpolation where the quaternions are too close
+    # for the sine ratio
+    sin_theta = np.where(small, 1.0, sin_theta)
+    w0 = np.where(small, 1 - t, np.sin((1 - t) * theta) / sin_theta)
+    w1 = np.where(small, t, np.sin(t * theta) / sin_theta)
+    quats = w0 * q0 + w1 * q1
+    return quats / np.linalg.norm(quats, axis=-1, keepdims=True)
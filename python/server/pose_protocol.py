@@ -0,0 +1,418 @@
+"""Wire format shared by the pose server and its clients.
+
+Producers send frames of 168 float32 values (3 translation values followed by
+the 165 SMPL-X pose values). The server prepends the 4 byte big endian body
+ID of the producer before it forwards a frame to its consumers.
+
+Everything else travels as a message: a header of MESSAGE_MARKER, the message
+type and the payload length (both big endian uint32), followed by the
+payload. The marker is never assigned as a body ID, so messages can be told
+apart from the body frames the server sends.
+
+The marker is a NaN when read as float32, but a plain frame of a producer may
+still start with it, e.g. a frame with a NaN translation. A producer that can
+not rule this out sends MSG_SET_FRAMED first and then only messages, frames
+as MSG_ENCODED_FRAME (tcp_client.py --framed). Plain frames are accepted from
+all other producers, which must never send a frame that starts with the
+marker.
+
+A server that does not implement a request closes the connection instead of
+ignoring it, unless the request is answered with a reply that can reject it
+(MSG_SET_ENCODING, MSG_SET_FRAME_PROFILE).
+"""
+import struct
+import numpy as np
+
+POSE_FRAME_VALUES = 168
+# translation + pose
+POSE_FRAME_SIZE = POSE_FRAME_VALUES * 4
+BODY_ID_SIZE = 4
+# body ID + translation + pose
+BODY_FRAME_SIZE = BODY_ID_SIZE + POSE_FRAME_SIZE
+# body frames as sent by the server, e.g. to decode many of them at once with
+# np.frombuffer
+BODY_FRAME_DTYPE = np.dtype([
+    ('body_id', '>u4'),
+    ('transl', '<f4', (3,)),
+    ('pose', '<f4', (POSE_FRAME_VALUES - 3,)),
+])
+
+MESSAGE_MARKER = b'\xff\xff\xff\xff'
+# the marker where a body frame has its body ID
+_MARKER_ID = int.from_bytes(MESSAGE_MARKER, 'big')
+MESSAGE_HEADER = struct.Struct('>4sII')
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+COUNT = struct.Struct('>I')
+
+# Type reported by FrameReassembler for plain frames
+MSG_FRAME = 0
+# consumer -> server: receive all updates of a loop iteration as one MSG_BATCH
+MSG_SET_BATCHED = 1
+# server -> consumer: number of records followed by that many body frames
+MSG_BATCH = 2
+# consumer -> server: frames arrive over UDP, the connection only carries
+# initial transmissions
+MSG_SET_UDP_ONLY = 3
+# client -> server: uint32 ENCODING_* value (see pose_codec) the client
+# wants to use. server -> client: the encoding the server agreed to, frames
+# to consumers that did not ask for an encoding stay raw.
+MSG_SET_ENCODING = 4
+# body ID (ignored for frames of producers) followed by a frame encoded by
+# pose_codec.PoseEncoder
+MSG_ENCODED_FRAME = 5
+# consumer -> server: big endian uint32 body IDs. A consumer receives the
+# frames of all bodies until it subscribes to the first one, unsubscribing
+# before that has no effect.
+MSG_SUBSCRIBE = 6
+MSG_UNSUBSCRIBE = 7
+# consumer -> server: HISTORY_REQUEST for recent frames of a body, body ID 0
+# asks for all bodies the consumer is subscribed to
+MSG_REQUEST_HISTORY = 8
+# server -> consumer: HISTORY_HEADER, the receive times of the frames as big
+# endian float64 (seconds since the epoch) and the body frames. Frames of a
+# body are numbered from 0 in the order the server received them.
+MSG_HISTORY = 9
+# consumer -> server: receive the frames of the server's resampler at its
+# fixed output rate instead of the frames of the producers
+MSG_SET_RESAMPLED = 10
+# producer -> server: number of records followed by that many records of a
+# big endian uint32 stream index and a frame. Each stream of a connection is
+# a body of its own, so one connection can carry many bodies.
+MSG_STREAM_FRAMES = 11
+# producer -> server: big endian uint32 indices of streams that ended, their
+# bodies are released
+MSG_END_STREAMS = 12
+# consumer -> server: FRAME_PROFILE, the coordinate frame (see frame_profile)
+# the consumer wants to receive frames in. The server sends the first
+# transmissions the consumer already received again, converted. Frames over
+# UDP stay unchanged. server -> consumer: the FRAME_PROFILE the server uses
+# from now on, or an empty payload if it rejected the request (e.g. for UDP
+# consumers or on a server that does not convert frames).
+MSG_SET_FRAME_PROFILE = 13
+# client -> server: every following byte of the client belongs to a message,
+# plain frames are sent as MSG_ENCODED_FRAME (format ENCODING_RAW if they are
+# not encoded). Anything else closes the connection.
+MSG_SET_FRAMED = 14
+# server -> producer: pairs of big endian uint32 stream index and the body ID
+# the server assigned to the stream, for the new streams of a
+# MSG_STREAM_FRAMES message. A server that does not support streams closes
+# the connection instead.
+MSG_STREAMS_STARTED = 15
+
+# body ID, HISTORY_LAST or HISTORY_SINCE, number of frames or first sequence
+# number
+HISTORY_REQUEST = struct.Struct('>III')
+HISTORY_LAST = 0
+HISTORY_SINCE = 1
+# body ID, sequence number of the first frame, number of frames
+HISTORY_HEADER = struct.Struct('>III')
+# rotation of the global orientation around the x-axis in degrees,
+# FRAME_PROFILE_* flags, offset of the translation
+FRAME_PROFILE = struct.Struct('>fI3f')
+FRAME_PROFILE_SWAP_YZ = 1
+
+# UDP datagrams hold a big endian uint32 sequence number, counted per body,
+# followed by a body frame
+DATAGRAM_HEADER = struct.Struct('>I')
+DATAGRAM_SIZE = DATAGRAM_HEADER.size + BODY_FRAME_SIZE
+
+
+# payload size of client messages with a fixed size
+_PAYLOAD_SIZES = {
+    MSG_SET_BATCHED: 0,
+    MSG_SET_UDP_ONLY: 0,
+    MSG_SET_ENCODING: COUNT.size,
+    MSG_REQUEST_HISTORY: HISTORY_REQUEST.size,
+    MSG_SET_RESAMPLED: 0,
+    MSG_SET_FRAME_PROFILE: FRAME_PROFILE.size,
+    MSG_SET_FRAMED: 0,
+}
+# client messages holding a list of big endian uint32 values
+_LIST_MESSAGES = (MSG_SUBSCRIBE, MSG_UNSUBSCRIBE, MSG_END_STREAMS)
+
+
+def check_client_message(msg_type, payload):
+    """Checks the payload size of a message a client sent to the server.
+
+    Messages of unknown types are not checked.
+
+    Raises:
+        ValueError: If the payload does not have the size its type requires.
+    """
+    length = len(payload)
+    if msg_type in _PAYLOAD_SIZES:
+        valid = length == _PAYLOAD_SIZES[msg_type]
+    elif msg_type in _LIST_MESSAGES:
+        valid = length % COUNT.size == 0
+    elif msg_type == MSG_ENCODED_FRAME:
+        # body ID and format byte, PoseDecoder checks the rest
+        valid = length > BODY_ID_SIZE
+    elif msg_type == MSG_STREAM_FRAMES:
+        valid = length >= COUNT.size and length == COUNT.size \
+            + COUNT.unpack_from(payload)[0] * BODY_FRAME_SIZE
+    else:
+        return
+    if not valid:
+        raise ValueError(f"Invalid payload of {length} bytes for a message of "
+                         f"type {msg_type}")
+
+
+def encode_message(msg_type, payload=b''):
+    """Returns the header and payload of a message as bytes"""
+    return MESSAGE_HEADER.pack(MESSAGE_MARKER, msg_type, len(payload)) + payload
+
+
+def encode_batch_header(num_records):
+    """Returns the header of a MSG_BATCH message holding num_records frames.
+
+    The body frames themselves have to follow directly after the header.
+    """
+    return MESSAGE_HEADER.pack(
+        MESSAGE_MARKER, MSG_BATCH, COUNT.size + num_records * BODY_FRAME_SIZE
+    ) + COUNT.pack(num_records)
+
+
+def encode_stream_frames_header(num_records):
+    """Returns the header of a MSG_STREAM_FRAMES message holding num_records
+    frames, which are laid out like body frames with the stream index in
+    place of the body ID"""
+    return MESSAGE_HEADER.pack(
+        MESSAGE_MARKER, MSG_STREAM_FRAMES,
+        COUNT.size + num_records * BODY_FRAME_SIZE
+    ) + COUNT.pack(num_records)
+
+
+def encode_body_ids(body_ids):
+    """Returns the payload of a MSG_SUBSCRIBE, MSG_UNSUBSCRIBE or
+    MSG_END_STREAMS message"""
+    body_ids = list(body_ids)
+    return struct.pack(f'>{len(body_ids)}I', *body_ids)
+
+
+def decode_body_ids(payload):
+    """Returns the body IDs of a MSG_SUBSCRIBE or MSG_UNSUBSCRIBE message, or
+    the stream indices of a MSG_END_STREAMS message"""
+    if len(payload) % COUNT.size != 0:
+        raise ValueError(f"Invalid list of body IDs of {len(payload)} bytes")
+    return struct.unpack(f'>{len(payload) // COUNT.size}I', payload)
+
+
+def encode_history_header(body_id, first_seq, num_frames):
+    """Returns the header of a MSG_HISTORY message holding num_frames frames.
+
+    The receive times and the body frames have to follow directly after the
+    header.
+    """
+    return MESSAGE_HEADER.pack(
+        MESSAGE_MARKER, MSG_HISTORY,
+        HISTORY_HEADER.size + num_frames * (8 + BODY_FRAME_SIZE)
+    ) + HISTORY_HEADER.pack(body_id, first_seq, num_frames)
+
+
+def decode_history(payload):
+    """Splits the payload of a MSG_HISTORY message.
+
+    Returns:
+        tuple: Body ID, sequence number of the first frame, receive times and
+            body frames.
+    """
+    body_id, first_seq, num_frames = HISTORY_HEADER.unpack_from(payload)
+    if len(payload) != HISTORY_HEADER.size + num_frames * (8 + BODY_FRAME_SIZE):
+        raise ValueError(f"History of {num_frames} frames has "
+                         f"{len(payload)} bytes")
+    times = struct.unpack_from(f'>{num_frames}d', payload, HISTORY_HEADER.size)
+    offset = HISTORY_HEADER.size + 8 * num_frames
+    frames = [payload[offset + i * BODY_FRAME_SIZE:
+                      offset + (i + 1) * BODY_FRAME_SIZE]
+              for i in range(num_frames)]
+    return body_id, first_seq, times, frames
+
+
+def iter_batch_records(payload):
+    """Yields the body frames contained in the payload of a MSG_BATCH message"""
+    num_records = COUNT.unpack_from(payload)[0]
+    offset = COUNT.size
+    for _ in range(num_records):
+        yield payload[offset:offset + BODY_FRAME_SIZE]
+        offset += BODY_FRAME_SIZE
+
+
+class FrameReassembler:
+    """Cuts a TCP byte stream into fixed-size frames and messages.
+
+    TCP does not preserve message boundaries, so a single read may contain
+    several frames or only parts of one. Data is received with ``recv_into``
+    into a preallocated buffer and complete frames are handed out as
+    memoryviews into that buffer, without copying them. A trailing partial
+    frame is kept and completed by the next read.
+
+    Given a frame_dtype, consecutive frames are instead reported together as
+    a single structured array of that dtype, which is a view into the buffer
+    as well. Frames are then told apart from messages for a whole read at
+    once instead of one by one.
+
+    Once ``framed`` is set, which a MSG_SET_FRAMED message in the stream
+    does, the stream only holds messages and data that does not start with
+    MESSAGE_MARKER raises a ValueError instead of being cut into frames.
+
+    The returned memoryviews and arrays are only valid until the next call to
+    ``recv_messages``. Copy a frame (e.g. via ``bytes(frame)``) if it has to
+    outlive that.
+    """
+    def __init__(self, frame_size, max_frames=64, frame_dtype=None):
+        if max_frames < 2:
+            raise ValueError(f"max_frames has to be at least 2, got {max_frames}")
+        if frame_dtype is not None and np.dtype(frame_dtype).itemsize \
+                != frame_size:
+            raise ValueError(f"Frame dtype has {np.dtype(frame_dtype).itemsize}"
+                             f" bytes, expected {frame_size}")
+        self.frame_size = frame_size
+        self.frame_dtype = frame_dtype
+        self.buffer = bytearray(frame_size * max_frames)
+        self.view = memoryview(self.buffer)
+        # self.view[start:end] holds received data that was not handed out yet
+        self.start = 0
+        self.end = 0
+        self.bytes_received = 0
+        self.framed = False
+
+
+    def recv_messages(self, sock):
+        """Reads the available data from the given socket.
+
+        Args:
+            sock (socket.socket): Socket that is ready for reading.
+
+        Raises:
+            ValueError: If the peer announced a message of type MSG_FRAME or
+                one that exceeds MAX_MESSAGE_SIZE, or sent a plain frame
+                while ``framed`` is set.
+
+        Returns:
+            list | None: (message type, memoryview) tuples of all frames and
+                messages that were completed by this read (may be empty) or
+                None if the peer closed or reset the connection. Frames are
+                reported with type MSG_FRAME, or runs of them as one array
+                if a frame_dtype is set, messages with their payload.
+        """
+        try:
+            num_bytes = sock.recv_into(self.get_buffer())
+        except ConnectionResetError:
+            return None
+        if num_bytes == 0:
+            return None
+        return self.buffer_updated(num_bytes)
+
+
+    def get_buffer(self):
+        """Returns the free part of the receive buffer.
+
+        Together with buffer_updated, this allows other receive mechanisms
+        (e.g. asyncio.BufferedProtocol) to fill the buffer.
+        """
+        self._compact()
+        return self.view[self.end:]
+
+
+    def buffer_updated(self, num_bytes):
+        """Announces that num_bytes were written to the buffer returned by
+        get_buffer.
+
+        Returns:
+            list: (message type, memoryview) tuples like recv_messages.
+        """
+        self.end += num_bytes
+        self.bytes_received += num_bytes
+        return self._split_messages()
+
+
+    def _split_messages(self):
+        view = self.view
+        frame_size = self.frame_size
+        header_size = MESSAGE_HEADER.size
+        messages = []
+        offset = self.start
+        while True:
+            available = self.end - offset
+            if self.frame_dtype is not None and available >= frame_size \
+                    and not self.framed:
+                num_frames = self._count_frames(offset,
+                                                available // frame_size)
+                if num_frames:
+                    messages.append((MSG_FRAME, np.frombuffer(
+                        self.buffer, dtype=self.frame_dtype,
+                        count=num_frames, offset=offset
+                    )))
+                    offset += num_frames * frame_size
+                    continue
+            if available < frame_size and available < header_size:
+                break
+            if view[offset:offset + 4] != MESSAGE_MARKER:
+                if self.framed:
+                    raise ValueError("Expected a message on a framed "
+                                     "connection")
+                if available < frame_size:
+                    break
+                messages.append((MSG_FRAME, view[offset:offset + frame_size]))
+                offset += frame_size
+                continue
+            if available < header_size:
+                break
+            _, msg_type, length = MESSAGE_HEADER.unpack_from(view, offset)
+            if msg_type == MSG_FRAME:
+                # would be indistinguishable from a plain frame
+                raise ValueError("Message of type MSG_FRAME")
+            if length > MAX_MESSAGE_SIZE:
+                raise ValueError(f"Message of {length} bytes exceeds the "
+                                 f"maximum of {MAX_MESSAGE_SIZE} bytes")
+            if available < header_size + length:
+                self.start = offset
+                self._reserve(header_size + length)
+                return messages
+            if msg_type == MSG_SET_FRAMED:
+                # applies to the data following in the same read as well
+                self.framed = True
+            payload_start = offset + header_size
+            messages.append(
+                (msg_type, view[payload_start:payload_start + length])
+            )
+            offset = payload_start + length
+        self.start = offset
+        return messages
+
+
+    def _count_frames(self, offset, max_frames):
+        """Returns the number of consecutive frames at offset, up to the
+        first message"""
+        # the first 4 bytes of each of the next max_frames frames
+        ids = np.ndarray((max_frames,), dtype='>u4', buffer=self.buffer,
+                         offset=offset, strides=(self.frame_size,))
+        markers = np.flatnonzero(ids == _MARKER_ID)
+        return int(markers[0]) if len(markers) else max_frames
+
+
+    def _reserve(self, num_bytes):
+        """Makes sure that a message of num_bytes fits into the buffer"""
+        if num_bytes <= len(self.buffer):
+            return
+        # Views that were handed out keep referencing the old buffer
+        pending = self.view[self.start:self.end]
+        self.buffer = bytearray(2 * num_bytes)
+        self.view = memoryview(self.buffer)
+        self.view[:len(pending)] = pending
+        self.end = len(pending)
+        self.start = 0
+
+
+    def _compact(self):
+        """Moves a pending partial frame to the front of the buffer"""
+        if self.start == 0:
+            return
+        remaining = self.end - self.start
+        if remaining <= self.start:
+            self.view[:remaining] = self.view[self.start:self.end]
+        else:
+            # source and destination overlap
+            self.view[:remaining] = self.view[self.start:self.end].tobytes()
+        self.start = 0
+        self.end = remaining
@@ -0,0 +1,310 @@
+"""Streaming recording of body frames to disk.
+
+Frames are written into fixed-size chunk files, one series per body, that are
+memory mapped .npy files of RECORD_DTYPE rows (receive time, translation and
+pose). A new chunk is preallocated whenever the previous one is full, so the
+memory used by a recording does not grow with its length, and the operating
+system writes the pages back to disk in the background. A row counts as
+written once its receive time is set, which happens after the frame was
+copied, so a recording that was interrupted by a crash is readable up to the
+last complete frame.
+
+A recording is a directory of segments:
+
+    <directory>/<segment:04d>/<body_id>_<chunk:06d>.npy
+
+A new segment is started once the current one exceeds a size or duration
+limit, so that finished segments can be moved away while recording
+continues. export_npz converts a recording to the npz layout that
+tcp_client.py produces and plays back, with {id}_poses, {id}_transl and
+{id}_frame_rate entries.
+"""
+import argparse
+import os
+import time
+import zipfile
+from os import path as osp
+import numpy as np
+from pose_protocol import POSE_FRAME_SIZE, POSE_FRAME_VALUES
+
+# wall clock time the frame was received, translation and pose
+RECORD_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('transl', '<f4', (3,)),
+    ('pose', '<f4', (POSE_FRAME_VALUES - 3,)),
+])
+_TIME_SIZE = RECORD_DTYPE.fields['transl'][1]
+
+
+class _ChunkWriter:
+    """Preallocated, memory mapped chunk file of one body"""
+    def __init__(self, fpath, num_rows):
+        self.fpath = fpath
+        self.rows = np.lib.format.open_memmap(fpath, mode='w+',
+                                              dtype=RECORD_DTYPE,
+                                              shape=(num_rows,))
+        self.frames = self.rows.view(np.uint8).reshape(
+            num_rows, RECORD_DTYPE.itemsize
+        )[:, _TIME_SIZE:]
+        self.num_rows = 0
+
+
+    @property
+    def full(self):
+        return self.num_rows == len(self.rows)
+
+
+    def append(self, frame, time_received):
+        self.frames[self.num_rows] = np.frombuffer(frame, dtype=np.uint8)
+        # marks the row as written, after the frame is complete
+        self.rows['time'][self.num_rows] = time_received
+        self.num_rows += 1
+
+
+    def flush(self):
+        self.rows.flush()
+
+
+    def close(self):
+        """Flushes the chunk and cuts off the rows that were not written"""
+        self.rows.flush()
+        rows = self.rows
+        del self.rows, self.frames
+        if self.num_rows < len(rows):
+            tmp_path = self.fpath + '.tmp'
+            with open(tmp_path, 'wb') as file:
+                np.lib.format.write_array(file, rows[:self.num_rows])
+            del rows
+            os.replace(tmp_path, self.fpath)
+
+
+class PoseRecorder:
+    def __init__(self, directory, chunk_frames=1024, flush_interval=1.0,
+                 rotate_bytes=None, rotate_seconds=None):
+        """Creates the directory of the recording.
+
+        Args:
+            directory (str): Directory the recording is written to. Must not
+                exist yet or be empty.
+            chunk_frames (int): Number of frames per chunk file.
+            flush_interval (float): Time in seconds after which written
+                frames are flushed to disk.
+            rotate_bytes (int): Size in bytes of the frames after which a new
+                segment is started. None for no limit.
+            rotate_seconds (float): Time in seconds after which a new segment
+                is started. None for no limit.
+        """
+        if chunk_frames < 1:
+            raise ValueError(f"Invalid number of frames per chunk: "
+                             f"{chunk_frames}")
+        if osp.isdir(directory) and os.listdir(directory):
+            raise ValueError(f"Recording directory {directory} is not empty")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunk_frames = chunk_frames
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.segment = -1
+        # body ID -> _ChunkWriter of the current segment
+        self.chunks = {}
+        # body ID -> number of the next chunk in the current segment
+        self.chunk_counts = {}
+        self.frames_recorded = 0
+        self._start_segment(time.monotonic())
+
+
+    def _start_segment(self, now):
+        self._close_chunks()
+        self.segment += 1
+        os.makedirs(self._segment_dir(), exist_ok=True)
+        self.chunk_counts = {}
+        self.segment_bytes = 0
+        self.time_segment_start = now
+        self.time_last_flush = now
+
+
+    def _segment_dir(self):
+        return osp.join(self.directory, f'{self.segment:04d}')
+
+
+    def append(self, body_id, frame, time_received=None):
+        """Records a frame.
+
+        Args:
+            body_id (int): Body the frame belongs to.
+            frame (bytes-like): Translation and pose, 168 float32 values.
+            time_received (float): Wall clock time at which the frame was
+                received. Defaults to now.
+        """
+        if len(frame) != POSE_FRAME_SIZE:
+            raise ValueError(f"Frame has {len(frame)} bytes, expected "
+                             f"{POSE_FRAME_SIZE}")
+        if time_received is None:
+            time_received = time.time()
+        now = time.monotonic()
+        if (self.rotate_bytes is not None
+                and self.segment_bytes >= self.rotate_bytes) \
+                or (self.rotate_seconds is not None
+                    and now - self.time_segment_start >= self.rotate_seconds):
+            self._start_segment(now)
+        chunk = self.chunks.get(body_id)
+        if chunk is None or chunk.full:
+            if chunk is not None:
+                chunk.close()
+            chunk = self._open_chunk(body_id)
+        chunk.append(frame, time_received)
+        self.segment_bytes += RECORD_DTYPE.itemsize
+        self.frames_recorded += 1
+        if now - self.time_last_flush >= self.flush_interval:
+            self.flush()
+            self.time_last_flush = now
+
+
+    def _open_chunk(self, body_id):
+        chunk_idx = self.chunk_counts.get(body_id, 0)
+        self.chunk_counts[body_id] = chunk_idx + 1
+        fpath = osp.join(self._segment_dir(),
+                         f'{body_id}_{chunk_idx:06d}.npy')
+        chunk = _ChunkWriter(fpath, self.chunk_frames)
+        self.chunks[body_id] = chunk
+        return chunk
+
+
+    def flush(self):
+        """Writes all recorded frames to disk"""
+        for chunk in self.chunks.values():
+            chunk.flush()
+
+
+    def _close_chunks(self):
+        for chunk in self.chunks.values():
+            chunk.close()
+        self.chunks = {}
+
+
+    def close(self):
+        """Flushes all frames and trims the last chunk of every body"""
+        self._close_chunks()
+
+
+def create_unique_directory(parent, name):
+    """Creates a new directory for a recording.
+
+    Creating the directory is atomic, so recorders that start at the same
+    time never share one.
+
+    Args:
+        parent (str): Directory in which the directory is created.
+        name (str): Name of the directory. If it exists already, "_1", "_2",
+            ... is appended until the name is free.
+
+    Returns:
+        str: Path of the created directory.
+    """
+    os.makedirs(parent, exist_ok=True)
+    path = osp.join(parent, name)
+    suffix = 0
+    while True:
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            suffix += 1
+            path = osp.join(parent, f'{name}_{suffix}')
+
+
+def load_recording(directory, segments=None):
+    """Reads the frames of a recording.
+
+    Args:
+        directory (str): Directory of the recording.
+        segments (list): Numbers of the segments to read. None for all.
+
+    Returns:
+        dict: Body ID -> RECORD_DTYPE array of all frames of the body, in the
+            order they were received. Rows that were not written before a
+            crash are left out.
+    """
+    recording = {}
+    for body_id, fpaths in _chunk_files(directory, segments).items():
+        recording[body_id] = np.concatenate(
+            [_load_chunk(fpath) for fpath in fpaths]
+        )
+    return recording
+
+
+def _chunk_files(directory, segments):
+    """Returns a dict body ID -> paths of its chunk files, in order"""
+    if segments is None:
+        segments = sorted(int(name) for name in os.listdir(directory)
+                          if name.isdigit())
+    chunk_files = {}
+    for segment in segments:
+        segment_dir = osp.join(directory, f'{segment:04d}')
+        for name in sorted(os.listdir(segment_dir)):
+            if not name.endswith('.npy'):
+                continue
+            body_id = int(name.partition('_')[0])
+            chunk_files.setdefault(body_id, []).append(
+                osp.join(segment_dir, name)
+            )
+    return chunk_files
+
+
+def _load_chunk(fpath):
+    rows = np.load(fpath, mmap_mode='r')
+    return np.array(rows[rows['time'] > 0])
+
+
+def export_npz(directory, fpath, segments=None, include_times=False):
+    """Converts a recording to an npz file.
+
+    The bodies are written one after another, so only the frames of a single
+    body are held in memory.
+
+    Args:
+        directory (str): Directory of the recording.
+        fpath (str): Path of the npz file.
+        segments (list): Numbers of the segments to export. None for all.
+        include_times (bool): Whether to add the receive times of the frames
+            as {id}_times.
+    """
+    with zipfile.ZipFile(fpath, 'w', zipfile.ZIP_STORED,
+                         allowZip64=True) as npz:
+        for body_id, fpaths in _chunk_files(directory, segments).items():
+            rows = np.concatenate([_load_chunk(path) for path in fpaths])
+            if len(rows) == 0:
+                continue
+            time_elapsed = rows['time'][-1] - rows['time'][0]
+            arrays = {
+                'poses': rows['pose'],
+                'transl': rows['transl'],
+                'frame_rate': np.array(
+                    int(len(rows) / time_elapsed) if time_elapsed > 0 else -1
+                ),
+            }
+            if include_times:
+                arrays['times'] = rows['time']
+            for key, array in arrays.items():
+                with npz.open(f'{body_id}_{key}.npy', 'w',
+                              force_zip64=True) as file:
+                    np.lib.format.write_array(file, array)
+            del rows, arrays
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Converts a recording of tcp_client.py to an npz file"
+    )
+    parser.add_argument('recording', type=str,
+                        help="Directory of the recording")
+    parser.add_argument('output', type=str, help="Path of the npz file")
+    parser.add_argument('--segments', nargs='+', type=int, default=None,
+                        help="Segments to export. Optional, defaults to all")
+    parser.add_argument('--include-times', action='store_true',
+                        help="If specified, the receive times of the frames "
+                        "are exported as {id}_times.")
+    args = parser.parse_args()
+    export_npz(args.recording, args.output, args.segments,
+               args.include_times)
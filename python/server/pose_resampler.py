@@ -0,0 +1,136 @@
+"""Resampling of body frames to a fixed output rate.
+
+Producers like pose estimators send frames at a low and irregular rate. The
+resampler keeps the last two frames of every body and, on every tick,
+interpolates all bodies at once: the joint rotations by slerp of their
+quaternions and the translation linearly. The output of a body lags one
+input interval behind its newest frame, so it moves from the previous to the
+newest frame while the next one is on its way. If the next frame is late,
+the motion is extrapolated for up to the extrapolation window and then held.
+"""
+import numpy as np
+from pose_math import quat_to_rotvec, rotvec_to_quat, slerp
+from pose_protocol import POSE_FRAME_VALUES
+
+NUM_JOINTS = (POSE_FRAME_VALUES - 3) // 3
+# weight of the newest interval in the estimated input interval of a body
+_INTERVAL_SMOOTHING = 0.25
+# frames that arrive together (e.g. in one read) count as this far apart, in
+# seconds
+_MIN_INTERVAL = 0.001
+_SLOT_ARRAYS = ('prev_transl', 'transl', 'prev_quats', 'quats', 'times',
+                'intervals')
+
+
+class PoseResampler:
+    def __init__(self, extrapolation=0.0, capacity=16):
+        """
+        Args:
+            extrapolation (float): Time in seconds for which the motion of a
+                body is extrapolated when its next frame is late.
+            capacity (int): Number of bodies to allocate space for, grows
+                when needed.
+        """
+        if extrapolation < 0:
+            raise ValueError(f"Invalid extrapolation window: {extrapolation}")
+        self.extrapolation = extrapolation
+        # The bodies occupy the first num_bodies slots of the arrays
+        self.num_bodies = 0
+        self.body_ids = []
+        # body ID -> slot
+        self.slots = {}
+        self.prev_transl = np.zeros((capacity, 3))
+        self.transl = np.zeros((capacity, 3))
+        self.prev_quats = np.zeros((capacity, NUM_JOINTS, 4))
+        self.quats = np.zeros((capacity, NUM_JOINTS, 4))
+        # receive time of the newest frame
+        self.times = np.zeros(capacity)
+        # estimated time between two frames, infinite until the second frame
+        self.intervals = np.full(capacity, np.inf)
+
+
+    def _grow(self):
+        capacity = 2 * len(self.times)
+        for name in _SLOT_ARRAYS:
+            array = getattr(self, name)
+            grown = np.empty((capacity,) + array.shape[1:])
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+
+    def add_frame(self, body_id, frame, time_received):
+        """Makes a frame the newest of its body.
+
+        Args:
+            body_id (int): Body the frame belongs to.
+            frame (bytes-like): Translation and pose, 168 float32 values.
+            time_received (float): Monotonic time the frame was received.
+        """
+        values = np.frombuffer(frame, dtype=np.float32)
+        quats = rotvec_to_quat(values[3:].reshape(NUM_JOINTS, 3))
+        slot = self.slots.get(body_id)
+        if slot is None:
+            if self.num_bodies == len(self.times):
+                self._grow()
+            slot = self.slots[body_id] = self.num_bodies
+            self.body_ids.append(body_id)
+            self.num_bodies += 1
+            # a single frame is held until the next one arrives
+            self.prev_transl[slot] = values[:3]
+            self.prev_quats[slot] = quats
+            self.intervals[slot] = np.inf
+        else:
+            interval = max(time_received - self.times[slot], _MIN_INTERVAL)
+            if np.isinf(self.intervals[slot]):
+                self.intervals[slot] = interval
+            else:
+                self.intervals[slot] += _INTERVAL_SMOOTHING \
+                    * (interval - self.intervals[slot])
+            self.prev_transl[slot] = self.transl[slot]
+            self.prev_quats[slot] = self.quats[slot]
+        self.transl[slot] = values[:3]
+        self.quats[slot] = quats
+        self.times[slot] = time_received
+
+
+    def forget(self, body_id):
+        """Removes a body, moving the last one into its slot"""
+        slot = self.slots.pop(body_id, None)
+        if slot is None:
+            return
+        last = self.num_bodies - 1
+        if slot != last:
+            moved_id = self.body_ids[last]
+            for name in _SLOT_ARRAYS:
+                array = getattr(self, name)
+                array[slot] = array[last]
+            self.body_ids[slot] = moved_id
+            self.slots[moved_id] = slot
+        self.body_ids.pop()
+        self.num_bodies = last
+
+
+    def resample(self, now):
+        """Interpolates the frames of all bodies at a point in time.
+
+        Args:
+            now (float): Monotonic time of the output frames.
+
+        Returns:
+            tuple: List of the body IDs and float32 array of shape
+                (bodies, 168) with their frames, in the same order.
+        """
+        n = self.num_bodies
+        frames = np.empty((n, POSE_FRAME_VALUES), dtype=np.float32)
+        if n == 0:
+            return [], frames
+        intervals = self.intervals[:n]
+        # bodies with a single frame have an infinite interval and hold it
+        t = np.clip((now - self.times[:n]) / intervals, 0.0,
+                    1.0 + self.extrapolation / intervals)
+        prev_transl = self.prev_transl[:n]
+        frames[:, :3] = prev_transl \
+            + (self.transl[:n] - prev_transl) * t[:, np.newaxis]
+        quats = slerp(self.prev_quats[:n], self.quats[:n], t[:, np.newaxis])
+        frames[:, 3:] = quat_to_rotvec(quats).reshape(n, -1)
+        return list(self.body_ids), frames
@@ -0,0 +1,329 @@
+"""Metrics of the pose server in the Prometheus text format.
+
+The server counts the frames and bytes of every connection in its state and
+records the duration of every fan-out of a frame to the consumers and of every
+select loop iteration in histograms. A MetricsEndpoint serves them over HTTP,
+on a local TCP port or a unix domain socket. It runs in the select loop of the
+server, so no state is shared between threads:
+
+    curl http://localhost:9100/metrics
+    curl --unix-socket /tmp/pose_stats.sock http://localhost/metrics
+
+The endpoint also controls a sampling profiler, which can be started and
+stopped while the server is running and returns the sampled stacks in the
+collapsed format of flame graph tools:
+
+    curl http://localhost:9100/profiler/start
+    curl http://localhost:9100/profiler/stop > stacks.txt
+"""
+import bisect
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+
+# seconds
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+_MAX_REQUEST_SIZE = 8192
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def render(self, name, lines):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum}')
+        lines.append(f'{name}_count {self.count}')
+
+
+class RelayMetrics:
+    """Histograms of a server, the counters are kept in the state of its
+    connections"""
+    def __init__(self):
+        # duration of forwarding a frame to all consumers
+        self.fanout_seconds = Histogram()
+        # time spent handling the events of one select loop iteration
+        self.loop_seconds = Histogram()
+        self.time_start = time.time()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+# metric name -> value of a connection
+_CONNECTION_METRICS = {
+    'pose_server_connection_frames_in_total': lambda data: data.frames_in,
+    'pose_server_connection_bytes_in_total':
+        lambda data: data.frames.bytes_received,
+    'pose_server_connection_frames_out_total': lambda data: data.frames_out,
+    'pose_server_connection_bytes_out_total': lambda data: data.bytes_out,
+    'pose_server_connection_frames_dropped_total':
+        lambda data: data.frames_dropped,
+    'pose_server_connection_queue_depth': lambda data: len(data.out_queue),
+    'pose_server_connection_pending_bytes':
+        lambda data: len(data.out_pending),
+}
+
+
+def render_metrics(server):
+    """Returns the metrics of a BodyPoseTcpServer in the Prometheus text
+    format"""
+    metrics = server.metrics
+    lines = [
+        '# TYPE pose_server_start_time_seconds gauge',
+        f'pose_server_start_time_seconds {metrics.time_start}',
+        '# TYPE pose_server_connections gauge',
+        f'pose_server_connections {len(server.clients)}',
+        '# TYPE pose_server_bodies gauge',
+        f'pose_server_bodies {len(server.first_transmissions)}',
+    ]
+    connections = []
+    for sock, client in server.clients.items():
+        data = server.sel.get_key(sock).data
+        role = 'producer' if data.producer else 'consumer'
+        connections.append((f'addr="{_escape(data.addr)}",role="{role}"',
+                            data, client['body_id']))
+    for name, value in _CONNECTION_METRICS.items():
+        metric_type = 'counter' if name.endswith('_total') else 'gauge'
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, data, _ in connections:
+            lines.append(f'{name}{{{labels}}} {value(data)}')
+    # the rate of a body is the rate of the frames of its producer, or of its
+    # stream if the producer sends several
+    lines.append('# TYPE pose_server_body_frames_in_total counter')
+    for _, data, body_id in connections:
+        if not data.producer:
+            continue
+        if body_id:
+            frames_in = data.frames_in - sum(data.stream_frames_in.values())
+            lines.append(f'pose_server_body_frames_in_total{{body="{body_id}"}}'
+                         f' {frames_in}')
+        for stream_body_id, frames_in in data.stream_frames_in.items():
+            lines.append('pose_server_body_frames_in_total'
+                         f'{{body="{stream_body_id}"}} {frames_in}')
+    lines.append('# TYPE pose_server_fanout_seconds histogram')
+    metrics.fanout_seconds.render('pose_server_fanout_seconds', lines)
+    lines.append('# TYPE pose_server_loop_seconds histogram')
+    metrics.loop_seconds.render('pose_server_loop_seconds', lines)
+    return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Samples the stack of a thread at a fixed interval from a background
+    thread.
+
+    Sampling only reads the frames of the profiled thread, so its overhead
+    for that thread is limited to the GIL switches.
+    """
+    def __init__(self, thread_id, interval=0.005):
+        """
+        Args:
+            thread_id (int): Identifier of the thread to profile.
+            interval (float): Time in seconds between two samples.
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        # collapsed stack -> number of samples
+        self.stacks = Counter()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks = Counter()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """Stops sampling.
+
+        Returns:
+            str: One line per sampled stack, outermost function first,
+                followed by the number of samples.
+        """
+        if self.running:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{code.co_name} '
+                             f'({os.path.basename(code.co_filename)}:'
+                             f'{code.co_firstlineno})')
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+
+class MetricsEndpoint:
+    """Minimal HTTP server for the metrics and the profiler, driven by the
+    selector of the server"""
+    def __init__(self, server, host='127.0.0.1', port=None,
+                 unix_socket_path=None, profile_interval=0.005):
+        """
+        Args:
+            server (BodyPoseTcpServer): Server whose metrics are served.
+            host (str): Address of the TCP listening socket.
+            port (int): Port of the TCP listening socket, None for none.
+            unix_socket_path (str): Path of the unix domain socket, None for
+                none.
+            profile_interval (float): Time in seconds between two samples
+                of the profiler.
+        """
+        self.server = server
+        self.listening_sockets = []
+        if port is not None:
+            lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            lsock.bind((host, port))
+            self.listening_sockets.append(lsock)
+        if unix_socket_path is not None:
+            if os.path.exists(unix_socket_path):
+                os.unlink(unix_socket_path)
+            lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            lsock.bind(unix_socket_path)
+            self.listening_sockets.append(lsock)
+        self.unix_socket_path = unix_socket_path
+        # the server handles its events in the thread that creates it
+        self.profiler = SamplingProfiler(threading.get_ident(),
+                                         profile_interval)
+        # socket -> received part of the request
+        self.requests = {}
+        # socket -> part of the response that was not sent yet
+        self.responses = {}
+
+
+    def addresses(self):
+        return [lsock.getsockname() for lsock in self.listening_sockets]
+
+
+    def register(self, sel):
+        for lsock in self.listening_sockets:
+            lsock.listen(8)
+            lsock.setblocking(False)
+            sel.register(lsock, selectors.EVENT_READ, data=self)
+
+
+    def handle(self, sock, mask, sel):
+        """Handles a ready socket of the endpoint without blocking"""
+        if sock in self.listening_sockets:
+            try:
+                conn, _ = sock.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(False)
+            self.requests[conn] = b''
+            sel.register(conn, selectors.EVENT_READ, data=self)
+            return
+        if mask & selectors.EVENT_WRITE:
+            self._send(sock, sel)
+            return
+        try:
+            chunk = sock.recv(_MAX_REQUEST_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b''
+        request = self.requests[sock] + chunk
+        if chunk and b'\r\n\r\n' not in request \
+                and len(request) < _MAX_REQUEST_SIZE:
+            self.requests[sock] = request
+            return
+        del self.requests[sock]
+        if not chunk:
+            sel.unregister(sock)
+            sock.close()
+            return
+        self.responses[sock] = memoryview(self._response(request))
+        # whatever does not fit into the send buffer now is sent once the
+        # socket is writable again
+        sel.modify(sock, selectors.EVENT_WRITE, data=self)
+        self._send(sock, sel)
+
+
+    def _send(self, sock, sel):
+        """Sends as much of a pending response as possible and closes the
+        connection once all of it was sent"""
+        response = self.responses[sock]
+        try:
+            num_sent = sock.send(response)
+        except BlockingIOError:
+            return
+        except OSError:
+            # the client went away
+            num_sent = len(response)
+        if num_sent < len(response):
+            self.responses[sock] = response[num_sent:]
+            return
+        del self.responses[sock]
+        sel.unregister(sock)
+        sock.close()
+
+
+    def _response(self, request):
+        """Returns the HTTP response to a request"""
+        path = request.split(b' ', 2)[1].decode(errors='replace') \
+            if request.count(b' ') >= 2 else ''
+        status = '200 OK'
+        if path == '/metrics':
+            body = render_metrics(self.server)
+        elif path == '/profiler/start':
+            self.profiler.start()
+            body = 'Profiler started\n'
+        elif path == '/profiler/stop':
+            body = self.profiler.stop()
+        else:
+            status = '404 Not Found'
+            body = 'Use /metrics, /profiler/start or /profiler/stop\n'
+        body = body.encode()
+        return (f'HTTP/1.0 {status}\r\n'
+                'Content-Type: text/plain; version=0.0.4\r\n'
+                f'Content-Length: {len(body)}\r\n\r\n').encode() + body
+
+
+    def close(self):
+        self.profiler.stop()
+        for sock in list(self.requests) + list(self.responses):
+            sock.close()
+        for lsock in self.listening_sockets:
+            lsock.close()
+        if self.unix_socket_path is not None:
+            os.unlink(self.unix_socket_path)
@@ -0,0 +1,167 @@
+"""Pose table in shared memory for servers that run in several processes."""
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from pose_protocol import POSE_FRAME_SIZE
+
+
+class SharedPoseTable:
+    """Latest and first frame of every active body, shared between processes.
+
+    Every body occupies one slot of the table. A slot is only ever written by
+    the worker that owns the producer of the body, readers detect new frames
+    through the per slot sequence counter. The counter is odd while a frame is
+    written, so readers can retry instead of returning torn frames.
+
+    Body IDs are handed out from a counter in the shared memory block, which
+    keeps them unique across all workers.
+    """
+    # next free body ID, generation (changes whenever a slot is (de)allocated)
+    _HEADER_FIELDS = 2
+
+    def __init__(self, capacity=256, lock=None, name=None):
+        """Creates a new table or attaches to an existing one.
+
+        Args:
+            capacity (int): Maximum number of bodies that can be active at the
+                same time.
+            lock (multiprocessing.Lock): Lock that guards the allocation of
+                slots. Has to be the same object for all processes.
+            name (str): Name of the shared memory block of an existing table.
+                If None, a new block is created.
+        """
+        self.capacity = capacity
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        create = name is None
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=create, size=self._size(capacity)
+        )
+        self._map_arrays()
+        if create:
+            self.header[:] = (1, 0)
+            self.body_ids[:] = 0
+            self.owners[:] = -1
+            self.seqs[:] = 0
+
+
+    def __getstate__(self):
+        return {'capacity': self.capacity, 'lock': self.lock,
+                'name': self.shm.name}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['capacity'], state['lock'], state['name'])
+
+
+    @staticmethod
+    def _size(capacity):
+        return (8 * SharedPoseTable._HEADER_FIELDS
+                + capacity * (8 + 4 + 4 + 2 * POSE_FRAME_SIZE))
+
+
+    def _map_arrays(self):
+        buf = self.shm.buf
+        offset = 0
+        def view(dtype, shape):
+            nonlocal offset
+            arr = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+            offset += arr.nbytes
+            return arr
+        self.header = view(np.int64, (self._HEADER_FIELDS,))
+        self.seqs = view(np.uint64, (self.capacity,))
+        # 0 marks a free slot
+        self.body_ids = view(np.uint32, (self.capacity,))
+        # index of the worker that owns the producer, -1 for free slots
+        self.owners = view(np.int32, (self.capacity,))
+        self.first_frames = view(np.uint8, (self.capacity, POSE_FRAME_SIZE))
+        self.latest_frames = view(np.uint8, (self.capacity, POSE_FRAME_SIZE))
+
+
+    @property
+    def generation(self):
+        return int(self.header[1])
+
+
+    def allocate(self, owner, first_frame):
+        """Assigns the next free body ID to a new producer.
+
+        Args:
+            owner (int): Index of the worker that serves the producer.
+            first_frame (bytes-like): First frame sent by the producer.
+
+        Raises:
+            RuntimeError: If all slots are in use.
+
+        Returns:
+            tuple: The body ID and the slot of the body.
+        """
+        with self.lock:
+            free_slots = np.flatnonzero(self.body_ids == 0)
+            if len(free_slots) == 0:
+                raise RuntimeError(
+                    f"All {self.capacity} slots of the pose table are in use"
+                )
+            body_id = int(self.header[0])
+            # keep the slot of a body ID predictable if possible
+            slot = body_id % self.capacity
+            if self.body_ids[slot] != 0:
+                slot = int(free_slots[0])
+            frame = np.frombuffer(first_frame, dtype=np.uint8)
+            self.first_frames[slot] = frame
+            self.write_frame(slot, first_frame)
+            self.owners[slot] = owner
+            self.body_ids[slot] = body_id
+            self.header[0] = body_id + 1
+            self.header[1] += 1
+        return body_id, slot
+
+
+    def release(self, slot):
+        """Frees the slot of a body whose producer disconnected"""
+        with self.lock:
+            self.body_ids[slot] = 0
+            self.owners[slot] = -1
+            self.header[1] += 1
+
+
+    def write_frame(self, slot, frame):
+        """Stores a new frame. Must only be called by the owner of the slot"""
+        self.seqs[slot] += 1
+        self.latest_frames[slot] = np.frombuffer(frame, dtype=np.uint8)
+        self.seqs[slot] += 1
+
+
+    def read_frame(self, slot):
+        """Returns the sequence number and the latest frame of a slot"""
+        while True:
+            seq = int(self.seqs[slot])
+            if seq & 1:
+                continue
+            frame = self.latest_frames[slot].tobytes()
+            if int(self.seqs[slot]) == seq:
+                return seq, frame
+
+
+    def active_slots(self):
+        """Returns a dict that maps the body IDs of all active bodies to
+        their slots"""
+        with self.lock:
+            slots = np.flatnonzero(self.body_ids)
+            return {int(self.body_ids[slot]): int(slot) for slot in slots}
+
+
+    def first_frame(self, slot):
+        return self.first_frames[slot].tobytes()
+
+
+    def close(self):
+        # the numpy views have to be released before the block is closed
+        del (self.header, self.seqs, self.body_ids, self.owners,
+             self.first_frames, self.latest_frames)
+        self.shm.close()
+
+
+    def unlink(self):
+        """Removes the shared memory block. Call once, from the process that
+        created the table"""
+        self.shm.unlink()
@@ -0,0 +1,149 @@
+"""Shared memory ring buffer of body frames for consumers on the same host.
+
+The server is the only writer. It stores every body frame (body ID,
+translation and pose, exactly as sent to TCP consumers) in the next slot of
+the ring. Readers poll the write counter and copy new slots without any
+system calls. Every slot carries a sequence counter, so readers notice if a
+slot was overwritten while they were copying it or because they fell more
+than a full ring behind.
+"""
+import os
+from multiprocessing import shared_memory
+import numpy as np
+from pose_protocol import BODY_FRAME_SIZE
+
+# num_slots, slot_size, write_count
+_HEADER_FIELDS = 3
+
+
+def _layout(num_slots):
+    header_size = 8 * _HEADER_FIELDS
+    seqs_size = 8 * num_slots
+    return header_size, seqs_size, header_size + seqs_size \
+        + num_slots * BODY_FRAME_SIZE
+
+
+def _attach(name):
+    """Attaches to an existing block without handing it to the resource
+    tracker, which would remove it once this process exits"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class PoseRingWriter:
+    def __init__(self, name, num_slots=1024):
+        """Creates the ring buffer.
+
+        Args:
+            name (str): Name of the shared memory block that readers attach
+                to.
+            num_slots (int): Number of frames the ring can hold.
+        """
+        self.num_slots = num_slots
+        header_size, seqs_size, total_size = _layout(num_slots)
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=total_size)
+        self.header = np.ndarray((_HEADER_FIELDS,), dtype=np.uint64,
+                                 buffer=self.shm.buf)
+        self.seqs = np.ndarray((num_slots,), dtype=np.uint64,
+                               buffer=self.shm.buf, offset=header_size)
+        self.slots_offset = header_size + seqs_size
+        self.seqs[:] = 0
+        self.header[:] = (num_slots, BODY_FRAME_SIZE, 0)
+        self.write_count = 0
+
+
+    def write(self, body_id_bytes, pose):
+        """Publishes a body frame"""
+        n = self.write_count
+        slot = n % self.num_slots
+        offset = self.slots_offset + slot * BODY_FRAME_SIZE
+        # an odd sequence number marks a slot that is being written
+        self.seqs[slot] = 2 * n + 1
+        self.shm.buf[offset:offset + 4] = body_id_bytes
+        self.shm.buf[offset + 4:offset + BODY_FRAME_SIZE] = pose
+        self.seqs[slot] = 2 * n + 2
+        self.write_count = n + 1
+        self.header[2] = self.write_count
+
+
+    def close(self):
+        del self.header, self.seqs
+        self.shm.close()
+        self.shm.unlink()
+
+
+class PoseRingReader:
+    def __init__(self, name):
+        """Attaches to the ring buffer of a PoseRingWriter.
+
+        Reading starts with the next frame that is written after attaching.
+
+        Args:
+            name (str): Name of the shared memory block.
+        """
+        self.shm = _attach(name)
+        header = np.ndarray((_HEADER_FIELDS,), dtype=np.uint64,
+                            buffer=self.shm.buf)
+        self.num_slots = int(header[0])
+        if int(header[1]) != BODY_FRAME_SIZE:
+            frame_size = int(header[1])
+            del header
+            self.shm.close()
+            raise ValueError(f"Ring buffer {name} holds frames of "
+                             f"{frame_size} bytes, expected "
+                             f"{BODY_FRAME_SIZE} bytes")
+        header_size, seqs_size, _ = _layout(self.num_slots)
+        self.header = header
+        self.seqs = np.ndarray((self.num_slots,), dtype=np.uint64,
+                               buffer=self.shm.buf, offset=header_size)
+        self.slots_offset = header_size + seqs_size
+        self.next_index = int(header[2])
+        # frames that were overwritten before they could be read
+        self.frames_lost = 0
+
+
+    def read_frames(self, max_frames=256):
+        """Returns the frames that were written since the last call.
+
+        Args:
+            max_frames (int): Maximum number of frames to return.
+
+        Returns:
+            list: Body frames as bytes, oldest first.
+        """
+        write_count = int(self.header[2])
+        oldest_available = write_count - self.num_slots
+        if self.next_index < oldest_available:
+            self.frames_lost += oldest_available - self.next_index
+            self.next_index = oldest_available
+        frames = []
+        buf = self.shm.buf
+        while self.next_index < write_count and len(frames) < max_frames:
+            n = self.next_index
+            slot = n % self.num_slots
+            expected_seq = 2 * n + 2
+            offset = self.slots_offset + slot * BODY_FRAME_SIZE
+            if self.seqs[slot] == expected_seq:
+                frame = bytes(buf[offset:offset + BODY_FRAME_SIZE])
+                if self.seqs[slot] == expected_seq:
+                    frames.append(frame)
+                else:
+                    self.frames_lost += 1
+            else:
+                # the writer already lapped this slot
+                self.frames_lost += 1
+            self.next_index = n + 1
+        return frames
+
+
+    def close(self):
+        del self.header, self.seqs
+        self.shm.close()
@@ -4,11 +4,36 @@ from datetime import datetime
 from os import path as osp
 import os
 import numpy as np
-import quaternion
 import argparse
 import selectors
 import types
+import struct
 import sys
+from shm_ring import PoseRingReader
+from pose_recorder import PoseRecorder, create_unique_directory, export_npz
+from pose_dataset import (DEFAULT_CACHE_DIR, PACKED_EXTENSION, load_frames,
+                          open_packed)
+from frame_pacer import FramePacer
+from udp_broadcast import PoseDatagramReceiver, parse_address
+from pose_protocol import (BODY_FRAME_DTYPE, BODY_FRAME_SIZE, BODY_ID_SIZE,
+                           COUNT, MESSAGE_HEADER, MESSAGE_MARKER,
+                           POSE_FRAME_SIZE, FrameReassembler,
+                           MSG_FRAME, MSG_BATCH, MSG_SET_BATCHED,
+                           MSG_SET_UDP_ONLY, MSG_SET_ENCODING,
+                           MSG_SET_RESAMPLED, MSG_SET_FRAME_PROFILE,
+                           MSG_SET_FRAMED, MSG_ENCODED_FRAME, MSG_SUBSCRIBE,
+                           MSG_UNSUBSCRIBE,
+                           MSG_REQUEST_HISTORY, MSG_HISTORY, HISTORY_REQUEST,
+                           HISTORY_LAST, HISTORY_SINCE, decode_history,
+                           encode_body_ids, encode_message)
+from pose_codec import ENCODING_RAW, ENCODINGS, PoseDecoder, PoseEncoder
+from frame_profile import FrameProfile
+
+# Scatter-gather sends are not available on every platform (e.g. Windows)
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# seconds a consumer waits for the server to confirm its frame profile
+FRAME_PROFILE_TIMEOUT = 2.0
 
 class BodyPoseTcpClient:
     """Loosely based on this article: https://realpython.com/python-sockets/"""
@@ -17,9 +42,55 @@ class BodyPoseTcpClient:
                  poses_attribute = None, transl_attribute = None,
                  capture_fps_attribute = None, target_fps = -1,
                  capture_fps = -1, drop_frames = False, loop = True,
-                 verbosity = 1):
+                 verbosity = 1, *, batched = False, unix_socket_path = None,
+                 shm_ring_name = None, shm_poll_interval = 0.001,
+                 udp_address = None, udp_interface = '0.0.0.0',
+                 encoding = ENCODING_RAW, keyframe_interval = 30,
+                 subscriptions = None, record_chunk_frames = 1024,
+                 record_flush_interval = 1.0, record_rotate_bytes = None,
+                 record_rotate_seconds = None, export_recording = True,
+                 cache_dir = DEFAULT_CACHE_DIR, history_frames = 0,
+                 resampled = False, frame_callback = None,
+                 buffer_frames = 1024, frame_profile = None,
+                 framed = False):
         self.host = host
         self.port = port
+        # connect through a unix domain socket instead of host and port
+        self.unix_socket_path = unix_socket_path
+        # consume frames from the server's shared memory ring instead of a
+        # socket
+        self.shm_ring_name = shm_ring_name
+        self.shm_poll_interval = shm_poll_interval
+        self.pose_ring = None
+        # (host, port) of a multicast group or local address on which the
+        # frames are received over UDP. The TCP connection then only carries
+        # the initial transmissions.
+        self.udp_address = udp_address
+        self.udp_interface = udp_interface
+        self.udp_receiver = None
+        # one of the ENCODING_* values of pose_codec. Producers encode their
+        # frames with it, consumers ask the server to use it.
+        self.encoding = encoding
+        self.encoder = PoseEncoder(encoding, keyframe_interval) \
+            if is_producer and encoding != ENCODING_RAW else None
+        # Framed producers send raw frames as MSG_ENCODED_FRAME in format
+        # ENCODING_RAW, so that no frame can be taken for a message. Servers
+        # that do not know MSG_SET_FRAMED only accept plain frames.
+        self.framed = framed
+        self.raw_frame_header = MESSAGE_HEADER.pack(
+            MESSAGE_MARKER, MSG_ENCODED_FRAME,
+            BODY_ID_SIZE + 1 + POSE_FRAME_SIZE
+        ) + bytes(BODY_ID_SIZE) + bytes((ENCODING_RAW,))
+        self.decoder = PoseDecoder()
+        # body IDs whose frames the server should send, None for all bodies
+        self.subscriptions = set(subscriptions) \
+            if subscriptions is not None else None
+        # number of recent frames of every body that consumers request when
+        # they connect
+        self.history_frames = history_frames
+        # body ID -> sequence number of the first frame, receive times and
+        # frames of the last history received from the server
+        self.histories = {}
         self.is_producer = is_producer
         # to transform from given coordinate system to unity
         self.x_rot_angle = angle
@@ -27,30 +98,68 @@ class BodyPoseTcpClient:
         self.record = record
         self.record_dir = record_dir if record_dir != None else os.getcwd()
         self.bodies_to_record = bodies_to_record
-        self.poses = None
-        self.transl = None
+        # frames to transmit, translation followed by pose, memory mapped
+        # from the cache of transformed sequences if it is used
+        self.pose_frames = None
         self.verbosity = verbosity
-        self.recordings = {}
-        self.recording_time_start = -1
-        self.time_last_frame = 0
+        # frames are streamed to a directory named after the start of the
+        # recording, which is converted to an npz file of the same name at
+        # the end if export_recording is set
+        self.recorder = None
+        self.export_recording = export_recording
+        # request all updates of a server loop iteration as one packet
+        self.batched = batched
+        # request the frames of the server's resampler instead of the
+        # frames of the producers
+        self.resampled = resampled
+        # FrameProfile of the coordinate frame the server should convert the
+        # frames to, None for the frames as sent by the producers
+        self.frame_profile = frame_profile
+        # time.monotonic() until which the server has to confirm the frame
+        # profile, None once it did
+        self.frame_profile_deadline = None
+        # called with every batch of received frames, a BODY_FRAME_DTYPE
+        # array that is only valid during the call
+        self.frame_callback = frame_callback
+        # number of frames that fit into the receive buffer of consumers
+        self.buffer_frames = buffer_frames
         mocap_fps = None
         if self.is_producer and self.record:
             raise ValueError(
                 "The client cannot record and be a producer at the same time!"
             )
-        if self.is_producer and npz_file:
-            self.poses, self.transl, mocap_fps = self._load_npz_attributes(
+        if self.record:
+            self.recorder = PoseRecorder(
+                create_unique_directory(
+                    self.record_dir,
+                    datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+                ),
+                record_chunk_frames, record_flush_interval,
+                record_rotate_bytes, record_rotate_seconds
+            )
+        if self.is_producer and self.shm_ring_name is not None:
+            raise ValueError(
+                "Producers can not transmit through the shared memory ring!"
+            )
+        if self.is_producer and self.udp_address is not None:
+            raise ValueError("Producers can not transmit over UDP!")
+        if self.is_producer and npz_file \
+                and npz_file.endswith(PACKED_EXTENSION):
+            # already transformed by convert_dataset.py
+            self.pose_frames, mocap_fps = open_packed(npz_file)
+        elif self.is_producer and npz_file:
+            # Transform poses and translation to SMPL-X's coordinate system
+            self.pose_frames, mocap_fps = load_frames(
                 npz_file,
                 poses_attribute,
                 transl_attribute,
-                capture_fps_attribute
+                capture_fps_attribute,
+                self.x_rot_angle,
+                self.keep_yz_axes,
+                cache_dir,
+                verbosity
             )
-            # Transform poses and translation to SMPL-X's coordinate system
-            if self.poses is not None:
-                self._add_x_angle_offset_to_poses()
-            if self.transl is not None and not self.keep_yz_axes:
-                self.transl = self._swap_translation_yz_axes(self.transl)
-            if self.poses is None or self.transl is None:
+            if self.pose_frames is None:
                 if self.verbosity > 0:
                     print("Defaulting to sending 1 and 0 poses.")
         self.transmit_ones = True
@@ -68,46 +177,146 @@ class BodyPoseTcpClient:
         self.target_fps = target_fps if target_fps != -1 else self.capture_fps
         if self.target_fps == 0:
             raise ValueError(f"Invalid target fps: {self.target_fps}")
-        if self.is_producer:
-            self.time_to_sleep = 1 / self.target_fps
-        else:
-            self.time_to_sleep = 0
         self.frames_to_advance = int(self.capture_fps / self.target_fps) \
             if drop_frames else 1
+        # Producers send on a fixed schedule. If they fall behind, frames are
+        # skipped with drop_frames, otherwise they catch up.
+        self.pacer = FramePacer(self.target_fps, drop_frames) \
+            if self.is_producer else None
         self.loop = loop
         self.sock = None
         self.sel = None
+        self.frames = None
+        # control messages that still have to be sent to the server
+        self.control_out = bytearray()
         self.time_last_transmission = None
 
 
     def connect(self):
+        if self.shm_ring_name is not None:
+            if self.verbosity > 0:
+                print(f'Attaching to shared memory ring {self.shm_ring_name}')
+            self.pose_ring = PoseRingReader(self.shm_ring_name)
+            return
         self.sel = selectors.DefaultSelector()
-        server_addr = (self.host, self.port)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.unix_socket_path is not None:
+            server_addr = self.unix_socket_path
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            server_addr = (self.host, self.port)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setblocking(False)
+        # consumers decode all frames of a read at once
+        self.frames = FrameReassembler(BODY_FRAME_SIZE) if self.is_producer \
+            else FrameReassembler(BODY_FRAME_SIZE, self.buffer_frames,
+                                  BODY_FRAME_DTYPE)
         if self.verbosity > 0:
             print(f'Connecting to server at {server_addr} ...', end=" ")
         self.sock.connect_ex(server_addr)
         events = selectors.EVENT_READ | selectors.EVENT_WRITE
         data = None
         self.sel.register(self.sock, events, data=data)
+        if self.is_producer and self.framed:
+            self.send_message(MSG_SET_FRAMED)
+        if self.batched and not self.is_producer:
+            self.send_message(MSG_SET_BATCHED)
+        if self.resampled and not self.is_producer:
+            self.send_message(MSG_SET_RESAMPLED)
+        if self.frame_profile is not None and not self.is_producer:
+            self.send_message(MSG_SET_FRAME_PROFILE,
+                              self.frame_profile.encode())
+            self._frame_profile_sent()
+        if self.encoding != ENCODING_RAW:
+            self.send_message(MSG_SET_ENCODING, COUNT.pack(self.encoding))
+        if self.subscriptions is not None and not self.is_producer:
+            self.send_message(MSG_SUBSCRIBE,
+                              encode_body_ids(self.subscriptions))
+        if self.history_frames > 0 and not self.is_producer:
+            self.request_history(last=self.history_frames)
+        if self.udp_address is not None:
+            self.udp_receiver = PoseDatagramReceiver(*self.udp_address,
+                                                     self.udp_interface)
+            self.sel.register(self.udp_receiver, selectors.EVENT_READ)
+            self.send_message(MSG_SET_UDP_ONLY)
         if self.verbosity > 0:
             print("done")
 
 
+    def send_message(self, msg_type, payload=b''):
+        """Queues a control message that is sent as soon as the socket is
+        writable.
+
+        Args:
+            msg_type (int): One of the MSG_* message types of pose_protocol.
+            payload (bytes): Payload of the message.
+        """
+        self.control_out += encode_message(msg_type, payload)
+        self.sel.modify(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+
+    def subscribe(self, body_ids):
+        """Asks the server to also send the frames of the given bodies"""
+        if self.subscriptions is None:
+            self.subscriptions = set()
+        self.subscriptions.update(body_ids)
+        self.send_message(MSG_SUBSCRIBE, encode_body_ids(body_ids))
+
+
+    def unsubscribe(self, body_ids):
+        """Asks the server to stop sending the frames of the given
+        bodies. Does nothing before the first subscription, the client keeps
+        receiving all bodies."""
+        if self.subscriptions is None:
+            return
+        self.subscriptions.difference_update(body_ids)
+        self.send_message(MSG_UNSUBSCRIBE, encode_body_ids(body_ids))
+
+
+    def request_history(self, body_id=0, last=None, since=None):
+        """Asks the server for recent frames of a body.
+
+        The answer is stored in self.histories.
+
+        Args:
+            body_id (int): Body whose frames are requested, 0 for all bodies
+                the client is subscribed to.
+            last (int): Number of the most recent frames to request.
+            since (int): Sequence number of the first frame to request, e.g.
+                to resume after the last frame of an earlier history.
+        """
+        if (last is None) == (since is None):
+            raise ValueError("Either last or since has to be given")
+        if last is not None:
+            payload = HISTORY_REQUEST.pack(body_id, HISTORY_LAST, last)
+        else:
+            payload = HISTORY_REQUEST.pack(body_id, HISTORY_SINCE, since)
+        self.send_message(MSG_REQUEST_HISTORY, payload)
+
+
     def run(self):
         if self.is_producer and self.verbosity > 0:
             print("Transmitting data")
         if self.record and self.verbosity > 0:
             print("Recording data")
+        if self.pose_ring is not None:
+            self._run_shm_ring()
+            return
         try:
             continue_connection = True
             poses_idx = 0
-            time_last_transmission = time.perf_counter()
+            frame_sent = True
+            if self.is_producer:
+                self.pacer.reset()
             while continue_connection:
+                if self.is_producer and frame_sent:
+                    # wait for the deadline before the frame is chosen, so
+                    # that skipped frames can be accounted for
+                    frames_due = self.pacer.wait()
+                    poses_idx += (frames_due - 1) * self.frames_to_advance
+                    frame_sent = False
                 data_to_transmit = None
-                if isinstance(self.poses, np.ndarray) and isinstance(self.transl, np.ndarray):
-                    if poses_idx >= self.poses.shape[0]:
+                if self.pose_frames is not None:
+                    if poses_idx >= self.pose_frames.shape[0]:
                         if not self.loop:
                             if self.verbosity > 0:
                                 print(
@@ -115,74 +324,148 @@ class BodyPoseTcpClient:
                                 )
                             break
                         poses_idx = 0
-                    current_pose = self.poses[poses_idx]
-                    current_transl = self.transl[poses_idx]
-                    data_to_transmit = np.concatenate(
-                        (current_transl, current_pose),
-                        axis=None
-                    )
-                events = self.sel.select(timeout=None)
+                    data_to_transmit = self.pose_frames[poses_idx]
+                events = self.sel.select(timeout=self._select_timeout())
+                self._check_frame_profile()
                 for key, mask in events:
                     status = self.service_connection(key, mask,
-                                                     data_to_transmit,
-                                                     time_last_transmission
-                    )
+                                                     data_to_transmit)
                     if not status:
                         continue_connection = False
                         break
                     if isinstance(status, float):
-                        time_last_transmission = status
-                poses_idx += self.frames_to_advance
+                        # the time at which the frame was sent
+                        frame_sent = True
+                if frame_sent or not self.is_producer:
+                    poses_idx += self.frames_to_advance
         except KeyboardInterrupt:
             if self.verbosity > 0:
                 print("Closing connection")
         finally:
+            if self.is_producer and self.verbosity > 0:
+                self._print_pacing_stats()
+            self.close()
+
+
+    def frame_batches(self):
+        """Receives frames and yields them in batches, e.g. for analytics
+        pipelines that use the client as a library:
+
+            client.connect()
+            for frames in client.frame_batches():
+                process(frames['body_id'], frames['transl'], frames['pose'])
+
+        The connection is closed when the iteration stops.
+
+        Yields:
+            np.ndarray: BODY_FRAME_DTYPE array of frames that arrived
+                together. Only valid until the next batch is requested.
+        """
+        if self.is_producer:
+            raise ValueError("Producers do not receive frames")
+        batches = []
+        frame_callback = self.frame_callback
+        def collect(frames):
+            if frame_callback is not None:
+                frame_callback(frames)
+            batches.append(frames)
+        self.frame_callback = collect
+        try:
+            while True:
+                if self.pose_ring is not None:
+                    if not self._read_shm_ring() \
+                            and self.shm_poll_interval > 0:
+                        time.sleep(self.shm_poll_interval)
+                else:
+                    events = self.sel.select(timeout=self._select_timeout())
+                    self._check_frame_profile()
+                    for key, mask in events:
+                        if not self.service_connection(key, mask, None):
+                            return
+                yield from batches
+                batches.clear()
+        finally:
+            self.frame_callback = frame_callback
+            self.close()
+
+
+    def close(self):
+        """Closes the connection and saves the recording"""
+        if self.pose_ring is not None:
+            self.pose_ring.close()
+        else:
             self.sel.unregister(self.sock)
             self.sock.close()
+            if self.udp_receiver is not None:
+                self._close_udp_receiver()
             self.sel.close()
-            if self.record:
-                self._save_recording()
+        if self.record:
+            self._save_recording()
+
+
+    def _run_shm_ring(self):
+        try:
+            while True:
+                if not self._read_shm_ring() and self.shm_poll_interval > 0:
+                    time.sleep(self.shm_poll_interval)
+        except KeyboardInterrupt:
+            if self.verbosity > 0:
+                print("Detaching from shared memory ring")
+                if self.pose_ring.frames_lost:
+                    print(f"Lost {self.pose_ring.frames_lost} frames that "
+                          "were overwritten before they could be read")
+        finally:
+            self.close()
+
+
+    def _read_shm_ring(self):
+        """Processes the frames written to the shared memory ring since the
+        last call and returns whether there were any"""
+        frames = self.pose_ring.read_frames()
+        if frames:
+            self._process_frames(np.frombuffer(b''.join(frames),
+                                               dtype=BODY_FRAME_DTYPE))
+        return bool(frames)
+
+
+    def _close_udp_receiver(self):
+        receiver = self.udp_receiver
+        if self.verbosity > 0 and (receiver.frames_lost
+                                   or receiver.frames_stale):
+            print(f"Lost {receiver.frames_lost} and dropped "
+                  f"{receiver.frames_stale} stale frames received over UDP")
+        self.sel.unregister(receiver)
+        receiver.close()
 
 
-    def service_connection(self, key, mask, data_to_transmit,
-                           time_last_transmission) -> bool:
+    def service_connection(self, key, mask, data_to_transmit) -> bool:
+        if key.fileobj is self.udp_receiver:
+            frames = self.udp_receiver.read_frames()
+            if frames:
+                self._process_frames(np.frombuffer(b''.join(frames),
+                                                   dtype=BODY_FRAME_DTYPE))
+            return True
         if mask & selectors.EVENT_READ:
-            recv_data = self.sock.recv(676)
-            if not recv_data:
+            messages = self.frames.recv_messages(self.sock)
+            if messages is None:
                 if self.verbosity > 0:
                     print("Server closed the connection")
                 return False
-            if self.is_producer:
-                return True
-            time_now = time.perf_counter()
-            if self.time_last_transmission is not None and self.verbosity > 0:
-                T = time_now - self.time_last_transmission
-                f = 1 / T
-                print(f"Receiving data with {f:.0f} Hz     ", end="\r", flush=True)
-            self.time_last_transmission = time_now
-            body_id = int.from_bytes(recv_data[:4], 'big')
-            transl = np.frombuffer(recv_data[4:16], dtype=np.float32)
-            pose = np.frombuffer(recv_data[16:], dtype=np.float32)
-            if self.verbosity > 1:
-                print(f"Body index {body_id} | Translation: {transl} | "
-                      f"Pose shape: {pose.shape} | First 6 elements: {pose[:6]}")
-            if self.record:
-                if self.bodies_to_record is None or body_id in self.bodies_to_record:
-                    curr_time = time.perf_counter()
-                    if body_id not in list(self.recordings.keys()):
-                        self.recordings[body_id] = {
-                            'poses': [pose],
-                            'transl': [transl],
-                            'time_first_frame': curr_time,
-                            'time_last_frame': curr_time
-                        }
-                    else:
-                        self.recordings[body_id]['poses'].append(pose)
-                        self.recordings[body_id]['transl'].append(transl)
-                        self.recordings[body_id]['time_last_frame'] = curr_time
+            if not self.is_producer:
+                self._process_messages(messages)
             return True
         if mask & selectors.EVENT_WRITE:
+            if self.control_out:
+                try:
+                    num_sent = self.sock.send(self.control_out)
+                except BlockingIOError:
+                    num_sent = 0
+                del self.control_out[:num_sent]
+                if self.control_out:
+                    return True
             if not self.is_producer:
+                # from now on, consumers only wait for incoming data
+                self.sel.modify(self.sock, selectors.EVENT_READ)
                 return True
             to_transmit = data_to_transmit
             if not isinstance(to_transmit, np.ndarray):
@@ -190,20 +473,10 @@ class BodyPoseTcpClient:
                 if self.transmit_ones:
                     to_transmit += 1
                 self.transmit_ones = not self.transmit_ones
-            # to_sleep = self.time_to_sleep - (time.perf_counter() - time_last_transmission)
-            # if to_sleep > 0:
-            #     #print(f"Sleeping for {to_sleep} seconds")
-            #     time.sleep(to_sleep)
             if self.verbosity > 1:
                 print(f"Sending {to_transmit.shape} of size {len(to_transmit.tobytes())}")
-            if self.time_last_transmission is not None:
-                while True:
-                    time_now = time.perf_counter()
-                    if (time_now - self.time_last_transmission) >= self.time_to_sleep:
-                        break
-            else:
-                time_now = time.perf_counter()
-            self.sock.sendall(to_transmit.tobytes())
+            time_now = time.perf_counter()
+            self._send_buffers(self._encode_transmission(to_transmit))
             if self.time_last_transmission is not None and self.verbosity > 0:
                 T = time_now - self.time_last_transmission
                 f = 1 / T
@@ -212,69 +485,176 @@ class BodyPoseTcpClient:
             return time.perf_counter()
 
 
-    def _load_npz_attributes(self, npz_file, pose_attribute, transl_attribute,
-                             capture_fps_attribute):
-        if not osp.isfile(npz_file):
-            return None, None, None
-        content = np.load(npz_file)
-        if not pose_attribute in list(content.keys()):
-            return None, None, None
-        if not transl_attribute in list(content.keys()):
-            return None, None, None
-        return (
-            content[pose_attribute].astype(np.float32),
-            content[transl_attribute].astype(np.float32),
-            content.get(capture_fps_attribute, default=None)
-        )
+    def _print_pacing_stats(self):
+        stats = self.pacer.stats()
+        print(f"\nSent {stats['frames']} frames, lateness mean "
+              f"{stats['mean_ms']:.3f} ms, p50 {stats['p50_ms']:.3f} ms, p99 "
+              f"{stats['p99_ms']:.3f} ms, max {stats['max_ms']:.3f} ms")
+        if stats['frames_skipped'] or stats['resyncs']:
+            print(f"Skipped {stats['frames_skipped']} frames, restarted the "
+                  f"schedule {stats['resyncs']} times")
 
 
-    def _add_x_angle_offset_to_poses(self):
-        """alternatively, see https://math.stackexchange.com/questions/382760/composition-of-two-axis-angle-rotations"""
-        quats = quaternion.from_rotation_vector(self.poses[:, :3])
-        rotX = quaternion.from_rotation_vector(np.asarray([1,0,0]) * np.deg2rad(self.x_rot_angle))
-        self.poses[:, :3] = quaternion.as_rotation_vector(rotX * quats)
+    def _encode_transmission(self, to_transmit):
+        """Returns the buffers to send for a frame of 168 float32 values"""
+        if self.encoder is not None:
+            # the server assigns the body ID
+            return [encode_message(MSG_ENCODED_FRAME, bytes(4)
+                                   + self.encoder.encode(0, to_transmit))]
+        # raw frames are sent from the pose array without copying
+        frame = memoryview(to_transmit).cast('B')
+        if self.framed:
+            return [self.raw_frame_header, frame]
+        return [frame]
+
+
+    def _send_buffers(self, buffers):
+        if HAS_SENDMSG:
+            num_sent = self.sock.sendmsg(buffers)
+        else:
+            num_sent = 0
+        if num_sent < sum(len(buffer) for buffer in buffers):
+            self.sock.sendall(b''.join(buffers)[num_sent:])
+
+
+    def _process_messages(self, messages):
+        """Handles the frames and messages of a read from the server"""
+        for msg_type, payload in messages:
+            if msg_type == MSG_FRAME:
+                # consecutive frames, decoded by the FrameReassembler
+                self._process_frames(payload)
+            elif msg_type == MSG_ENCODED_FRAME:
+                self._process_encoded_frame(payload)
+            elif msg_type == MSG_BATCH:
+                self._process_frames(np.frombuffer(
+                    payload, dtype=BODY_FRAME_DTYPE,
+                    count=COUNT.unpack_from(payload)[0], offset=COUNT.size
+                ))
+            elif msg_type == MSG_SET_ENCODING:
+                self._encoding_confirmed(COUNT.unpack_from(payload)[0])
+            elif msg_type == MSG_SET_FRAME_PROFILE:
+                self._frame_profile_confirmed(payload)
+            elif msg_type == MSG_HISTORY:
+                self._process_history(payload)
+            elif self.verbosity > 1:
+                print(f"Ignoring message of unknown type {msg_type}")
+
+
+    def _encoding_confirmed(self, encoding):
+        if encoding != self.encoding and self.verbosity > 0:
+            print(f"Server does not support encoding {self.encoding}, "
+                  "receiving raw frames")
+
+
+    def _frame_profile_sent(self):
+        self.frame_profile_deadline = time.monotonic() + FRAME_PROFILE_TIMEOUT
+
+
+    def _frame_profile_confirmed(self, payload):
+        if len(payload) == 0:
+            raise RuntimeError(f"Server rejected {self.frame_profile}")
+        self.frame_profile_deadline = None
+        if self.verbosity > 0:
+            print(f"Server uses {FrameProfile.decode(payload)}")
+
+
+    def _check_frame_profile(self):
+        """Raises a RuntimeError if the server did not confirm the frame
+        profile in time"""
+        if self.frame_profile_deadline is not None \
+                and time.monotonic() >= self.frame_profile_deadline:
+            raise RuntimeError(f"Server did not confirm {self.frame_profile} "
+                               f"within {FRAME_PROFILE_TIMEOUT} s")
+
+
+    def _select_timeout(self):
+        if self.frame_profile_deadline is None:
+            return None
+        return max(self.frame_profile_deadline - time.monotonic(), 0)
+
+
+    def _process_history(self, payload):
+        """Stores the frames of a MSG_HISTORY message"""
+        try:
+            body_id, first_seq, times, frames = decode_history(payload)
+        except (ValueError, struct.error) as e:
+            if self.verbosity > 0:
+                print(f"Dropping invalid history: {e}")
+            return
+        values = np.frombuffer(b''.join(frame[4:] for frame in frames),
+                               dtype=np.float32).reshape(len(frames), -1)
+        self.histories[body_id] = (first_seq, np.array(times), values)
+        if self.verbosity > 0:
+            print(f"Received {len(frames)} frames of the history of body "
+                  f"{body_id}, starting at frame {first_seq}")
+
+
+    def _process_encoded_frame(self, payload):
+        """Decodes a MSG_ENCODED_FRAME and handles it like a body frame"""
+        body_id_bytes = bytes(payload[:4])
+        try:
+            values = self.decoder.decode(int.from_bytes(body_id_bytes, 'big'),
+                                         payload[4:])
+        except ValueError as e:
+            if self.verbosity > 0:
+                print(f"Dropping invalid frame: {e}")
+            return
+        self._process_frames(np.frombuffer(body_id_bytes + values.tobytes(),
+                                           dtype=BODY_FRAME_DTYPE))
+
+
+    def _process_frames(self, frames):
+        """Handles body frames received from the server.
+
+        Args:
+            frames (np.ndarray): BODY_FRAME_DTYPE array. Only valid until the
+                next read from the socket.
+        """
+        time_now = time.perf_counter()
+        if self.time_last_transmission is not None and self.verbosity > 0:
+            T = time_now - self.time_last_transmission
+            f = len(frames) / T if T > 0 else float('inf')
+            print(f"Receiving data with {f:.0f} Hz     ", end="\r", flush=True)
+        self.time_last_transmission = time_now
+        if self.subscriptions is not None:
+            # e.g. initial transmissions sent before the subscription
+            # reached the server, or frames received over UDP
+            frames = frames[np.isin(frames['body_id'],
+                                    list(self.subscriptions))]
+        if self.verbosity > 1:
+            for frame in frames:
+                print(f"Body index {frame['body_id']} | Translation: "
+                      f"{frame['transl']} | Pose shape: {frame['pose'].shape} "
+                      f"| First 6 elements: {frame['pose'][:6]}")
+        if self.record:
+            recorded = frames if self.bodies_to_record is None \
+                else frames[np.isin(frames['body_id'], self.bodies_to_record)]
+            # translation and pose of every frame
+            poses = recorded.view(np.uint8).reshape(
+                len(recorded), BODY_FRAME_SIZE
+            )[:, BODY_FRAME_SIZE - POSE_FRAME_SIZE:]
+            time_received = time.time()
+            for body_id, pose in zip(recorded['body_id'].tolist(), poses):
+                self.recorder.append(body_id, pose, time_received)
+        if self.frame_callback is not None and len(frames):
+            self.frame_callback(frames)
 
 
     def _save_recording(self):
-        fname = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        fpath = osp.join(self.record_dir, fname) + '.npz'
+        self.recorder.close()
+        if self.verbosity > 0:
+            print(f"Recorded {self.recorder.frames_recorded} frames to "
+                  f"{self.recorder.directory}")
+        if not self.export_recording:
+            return
+        fpath = self.recorder.directory + '.npz'
         if self.verbosity > 0:
             print(f"Saving recordings to {fpath}...", end=' ')
-        rec_dir = {}
-        for body_id in list(self.recordings.keys()):
-            rec_dir[f'{body_id}_poses'] = np.stack(self.recordings[body_id]['poses'])
-            rec_dir[f'{body_id}_transl'] = np.stack(self.recordings[body_id]['transl'])
-            time_elapsed = self.recordings[body_id]['time_last_frame'] - self.recordings[body_id]['time_first_frame']
-            if time_elapsed <= 0:
-                rec_dir[f'{body_id}_frame_rate'] = -1
-            else:
-                rec_dir[f'{body_id}_frame_rate'] = int(
-                    rec_dir[f'{body_id}_poses'].shape[0] / time_elapsed
-                )
-            del self.recordings[body_id]
-        with open(fpath, 'wb') as file:
-            np.savez(file, **rec_dir)
+        export_npz(self.recorder.directory, fpath)
         if self.verbosity > 0:
             print('done')
 
 
-    def _swap_translation_yz_axes(self, arr):
-        if len(arr.shape) == 1:
-            arr = arr[np.newaxis, ...]
-        return arr[:, [0,2,1]]
-        # Deprecated
-        # swap_yz_mat = np.asarray(
-        #             [
-        #                 [1,0,0],
-        #                 [0,0,1],
-        #                 [0,1,0]
-        #             ],
-        #             dtype=np.float32
-        #         )
-        # # swap y and z Axis to conform to Unity's coordinate system
-        # return np.einsum('ij,kj->ki', swap_yz_mat, arr)
-        
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="TCP Client")
     parser.add_argument('--host', type=str, default="localhost",
@@ -288,13 +668,31 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', type=str, default=None,
                         help="<Optional> Directory to where the recording "
                         "should be saved to. Defaults to None (cwd)")
+    parser.add_argument('--chunk-frames', type=int, default=1024,
+                        help="<Optional> Number of frames per body in each "
+                        "chunk file of a recording. Defaults to 1024")
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help="<Optional> Time in seconds after which "
+                        "recorded frames are flushed to disk. Defaults to 1")
+    parser.add_argument('--rotate-size', type=float, default=None,
+                        help="<Optional> Size in MB after which a recording "
+                        "starts a new segment. Defaults to None (no limit)")
+    parser.add_argument('--rotate-time', type=float, default=None,
+                        help="<Optional> Time in seconds after which a "
+                        "recording starts a new segment. Defaults to None "
+                        "(no limit)")
+    parser.add_argument('--no-export', action='store_true', help="If "
+                        "specified, the recording is not converted to an npz "
+                        "file at the end. Use pose_recorder.py to convert it "
+                        "later.")
     parser.add_argument('-b', '--bodies-to-record', nargs='*', help="<Optional>"
                         " Body IDs to record. Defaults to recording all")
     parser.add_argument('--producer', action='store_true', help="Defines that "
                         "this client is going to be a producer")
     parser.add_argument('-d', '--data', type=str, default=None,
                         help="<Optional> Path to a .npz file that contains the "
-                        "poses that should be broadcasted. Defaults to None")
+                        "poses that should be broadcasted, or to a .pose file "
+                        "created by convert_dataset.py. Defaults to None")
     parser.add_argument('-a', '--angle', type=float, default=-90,
                         help="<Optional> Angle (in deg) by which the global "
                         "orientation should be rotated around the x-Axis in "
@@ -326,21 +724,155 @@ if __name__ == '__main__':
                         "specifies that frames should be dropped in order to "
                         "match the target framerate. Requires that the "
                         "capturing framerate is known.")
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help="<Optional> Directory in which producers cache "
+                        "the transformed poses of a .npz file, so that later "
+                        "starts with the same file and transformation can "
+                        "map them from disk. Defaults to "
+                        "~/.cache/body_pose_frames")
+    parser.add_argument('--no-cache', action='store_true', help="If "
+                        "specified, the transformed poses are not cached.")
     parser.add_argument('--noloop', action='store_true', help="If specified, "
                         "the poses will only be broadcasted once.")
+    parser.add_argument('--unix-socket', type=str, default=None,
+                        help="<Optional> Path of a unix domain socket of the "
+                        "server to connect to instead of --host/--port. "
+                        "Defaults to None")
+    parser.add_argument('--shm-ring', type=str, default=None,
+                        help="<Optional> Name of the shared memory ring of a "
+                        "server on the same host. If specified, the client "
+                        "reads frames from the ring instead of connecting to "
+                        "the server. Only for consumers. Defaults to None")
+    parser.add_argument('--shm-poll-interval', type=float, default=0.001,
+                        help="<Optional> Time in seconds to sleep while the "
+                        "shared memory ring holds no new frames. 0 polls "
+                        "continuously. Defaults to 0.001")
+    parser.add_argument('--udp', type=str, default=None, metavar='HOST:PORT',
+                        help="<Optional> Multicast group to join, or local "
+                        "address to bind to, for receiving frames over UDP "
+                        "from a server started with --udp-targets. The TCP "
+                        "connection then only carries the initial "
+                        "transmissions. Only for consumers. Defaults to None")
+    parser.add_argument('--udp-interface', type=str, default='0.0.0.0',
+                        help="<Optional> Address of the local interface on "
+                        "which the multicast group is joined. Defaults to "
+                        "0.0.0.0 (chosen by the system)")
+    parser.add_argument('--encoding', type=str, default='raw',
+                        choices=list(ENCODINGS),
+                        help="<Optional> Encoding of the frames. Producers "
+                        "send their frames with it, consumers receive them "
+                        "with it if the server agrees. 'float16' and "
+                        "'quantized' halve the size of a frame, 'delta' "
+                        "sends differences to the previous frame and cuts "
+                        "it to about a quarter. Defaults to 'raw'")
+    parser.add_argument('--keyframe-interval', type=int, default=30,
+                        help="<Optional> Number of frames between two "
+                        "keyframes if a producer uses the 'delta' encoding. "
+                        "Defaults to 30")
+    parser.add_argument('-s', '--subscribe', nargs='+', type=int,
+                        default=None, metavar='BODY_ID',
+                        help="<Optional> Body IDs whose frames the server "
+                        "should send. Only for consumers. Defaults to all "
+                        "bodies")
+    parser.add_argument('--history', type=int, default=0, metavar='FRAMES',
+                        help="<Optional> Number of recent frames of every "
+                        "body to request from the server when connecting. "
+                        "Only for consumers. Defaults to 0")
+    parser.add_argument('--batched', action='store_true', help="If specified, "
+                        "the server sends all updates of one of its loop "
+                        "iterations as a single packet. Only for consumers.")
+    parser.add_argument('--resampled', action='store_true', help="If "
+                        "specified, the server sends the frames of all bodies "
+                        "at its fixed resampling rate (see --resample-fps of "
+                        "tcp_server.py) instead of as they arrive. Only for "
+                        "consumers.")
+    parser.add_argument('--profile-angle', type=float, default=None,
+                        help="<Optional> Angle (in deg) by which the server "
+                        "should rotate the global orientation of all frames "
+                        "around the x-Axis before sending them. Only for "
+                        "consumers. Defaults to None (no frame profile)")
+    parser.add_argument('--profile-swap-yz', action='store_true', help="If "
+                        "specified, the server swaps the y and z Axes of the "
+                        "translation of all frames before sending them. Only "
+                        "for consumers.")
+    parser.add_argument('--profile-offset', type=float, nargs=3, default=None,
+                        metavar=('X', 'Y', 'Z'), help="<Optional> Offset the "
+                        "server should add to the translation of all frames, "
+                        "after swapping its axes. Only for consumers. "
+                        "Defaults to None")
+    parser.add_argument('--framed', action='store_true', help="<Optional> If "
+                        "specified, a producer sends every frame in a message, "
+                        "so that no frame can be taken for a message. "
+                        "Requires a server that supports MSG_SET_FRAMED.")
+    parser.add_argument('--asyncio', action='store_true', help="If specified, "
+                        "the client runs on asyncio (on uvloop, if installed).")
     parser.add_argument('-v', '--verbosity', type=int, default=1,
                         help="<Optional> Verbosity setting. Defaults to 1")
     args = parser.parse_args()
+    udp_address = None
+    if args.udp is not None:
+        if args.asyncio:
+            parser.error("--udp can not be combined with --asyncio")
+        try:
+            udp_address = parse_address(args.udp)
+        except ValueError as e:
+            parser.error(str(e))
+    frame_profile = None
+    if args.profile_angle is not None or args.profile_swap_yz \
+            or args.profile_offset is not None:
+        try:
+            frame_profile = FrameProfile(
+                args.profile_angle or 0.0, args.profile_swap_yz,
+                args.profile_offset or (0.0, 0.0, 0.0)
+            )
+        except ValueError as e:
+            parser.error(str(e))
     bodies_to_record = None
     if args.bodies_to_record is not None:
         bodies_to_record = [int(x) for x in args.bodies_to_record]
 
-    client = BodyPoseTcpClient(args.host, args.port, args.record, args.output,
-                               bodies_to_record, args.producer, args.angle,
-                               args.keep_yz_axes, args.data, args.poses_field,
-                               args.transl_field, args.mocap_fps_field,
-                               args.fps, args.capture_fps, args.drop_frames,
-                               not args.noloop, args.verbosity
+    client = BodyPoseTcpClient(
+        host=args.host,
+        port=args.port,
+        record=args.record,
+        record_dir=args.output,
+        bodies_to_record=bodies_to_record,
+        is_producer=args.producer,
+        angle=args.angle,
+        keep_yz_axes=args.keep_yz_axes,
+        npz_file=args.data,
+        poses_attribute=args.poses_field,
+        transl_attribute=args.transl_field,
+        capture_fps_attribute=args.mocap_fps_field,
+        target_fps=args.fps,
+        capture_fps=args.capture_fps,
+        drop_frames=args.drop_frames,
+        loop=not args.noloop,
+        verbosity=args.verbosity,
+        batched=args.batched,
+        unix_socket_path=args.unix_socket,
+        shm_ring_name=args.shm_ring,
+        shm_poll_interval=args.shm_poll_interval,
+        udp_address=udp_address,
+        udp_interface=args.udp_interface,
+        encoding=ENCODINGS[args.encoding],
+        keyframe_interval=args.keyframe_interval,
+        subscriptions=args.subscribe,
+        record_chunk_frames=args.chunk_frames,
+        record_flush_interval=args.flush_interval,
+        record_rotate_bytes=int(args.rotate_size * 2 ** 20)
+        if args.rotate_size is not None else None,
+        record_rotate_seconds=args.rotate_time,
+        export_recording=not args.no_export,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        history_frames=args.history,
+        resampled=args.resampled,
+        frame_profile=frame_profile,
+        framed=args.framed
     )
-    client.connect()
-    client.run()
+    if args.asyncio:
+        from async_relay import AsyncBodyPoseTcpClient
+        AsyncBodyPoseTcpClient(client).run()
+    else:
+        client.connect()
+        client.run()
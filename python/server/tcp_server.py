@@ -1,27 +1,131 @@
 import socket
 import sys
 import selectors
+import signal
 import types
 import numpy as np
 import argparse
-from copy import deepcopy
+import multiprocessing
+import os
+import time
+from pose_protocol import (POSE_FRAME_SIZE, POSE_FRAME_VALUES,
+                           BODY_FRAME_SIZE, COUNT,
+                           FrameReassembler,
+                           MSG_FRAME, MSG_SET_BATCHED, MSG_SET_UDP_ONLY,
+                           MSG_SET_ENCODING, MSG_ENCODED_FRAME,
+                           MSG_SUBSCRIBE, MSG_UNSUBSCRIBE, MSG_SET_RESAMPLED,
+                           MSG_STREAM_FRAMES, MSG_END_STREAMS,
+                           MSG_STREAMS_STARTED,
+                           MSG_SET_FRAME_PROFILE, MSG_SET_FRAMED,
+                           MSG_REQUEST_HISTORY, HISTORY_REQUEST, HISTORY_LAST,
+                           HISTORY_SINCE, check_client_message,
+                           decode_body_ids, encode_body_ids,
+                           encode_batch_header, encode_history_header,
+                           encode_message)
+from frame_profile import FrameProfile
+from pose_codec import ENCODING_RAW, FORMAT_SIZES, PoseDecoder, PoseEncoder
+from pose_history import PoseHistory
+from pose_resampler import PoseResampler
+from relay_metrics import MetricsEndpoint, RelayMetrics
+from shared_pose_table import SharedPoseTable
+from shm_ring import PoseRingWriter
+from udp_broadcast import PoseDatagramSender, parse_address
+
+# Scatter-gather sends are not available on every platform (e.g. Windows)
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
 
 class BodyPoseTcpServer:
     """Loosely based on this article: https://realpython.com/python-sockets/"""
     def __init__(self, host, port, connections_to_accept,
-                 send_initial_transmissions):
+                 send_initial_transmissions, max_queued_frames=32,
+                 reuse_port=False, listening_socket=None,
+                 unix_socket_path=None, shm_ring_name=None,
+                 shm_ring_slots=1024, udp_targets=None, udp_ttl=1,
+                 keyframe_interval=30, history_frames=120, metrics_port=None,
+                 metrics_host='127.0.0.1', metrics_socket_path=None,
+                 resample_fps=None, resample_extrapolation=0.0,
+                 send_buffer_size=16 * 1024):
         self.host = host
         self.port = port
         self.connections_to_accept = connections_to_accept
         self.sel = selectors.DefaultSelector()
-        self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # A listening socket can be handed over, e.g. by a parent process that
+        # shares it between several server processes
+        self.lsock_listening = listening_socket is not None
+        if self.lsock_listening:
+            self.lsock = listening_socket
+        else:
+            self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Additional listening socket for clients on the same host
+        self.unix_socket_path = unix_socket_path
+        self.unix_lsock = None
+        # Every forwarded frame is also published to this shared memory ring
+        self.shm_ring_name = shm_ring_name
+        self.shm_ring_slots = shm_ring_slots
+        self.pose_ring = None
+        # Every forwarded frame is also sent once to each of these
+        # (host, port) UDP targets, e.g. a multicast group
+        self.udp_targets = udp_targets
+        self.udp_ttl = udp_ttl
+        self.udp_sender = None
+        # None blocks until a socket is ready
+        self.select_timeout = None
         self.consumers = []
+        # consumers that receive all updates of a loop iteration in one packet
+        self.batched_consumers = []
+        # consumers that receive frames over UDP, their connection only
+        # carries initial transmissions
+        self.udp_consumers = []
+        # consumers that asked for an encoding other than raw float32 or for
+        # a frame profile, their frames are converted in _send_frame
+        self.converted_consumers = []
+        # The lists above only hold consumers that receive all bodies.
+        # body ID -> consumers that subscribed to the body
+        self.subscribers = {}
+        # batched consumers that subscribed to some bodies
+        self.filtered_batched_consumers = []
+        # Frames per body between two keyframes for consumers that receive
+        # delta encoded frames
+        self.keyframe_interval = keyframe_interval
+        # The last history_frames frames of every body, which consumers can
+        # request to catch up after they joined
+        self.history = PoseHistory(history_frames) \
+            if history_frames > 0 else None
+        # Metrics are served on a local TCP port and/or a unix domain socket,
+        # see relay_metrics
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_socket_path = metrics_socket_path
+        self.metrics = RelayMetrics() if metrics_port is not None \
+            or metrics_socket_path is not None else None
+        self.metrics_endpoint = None
+        # Consumers can ask for frames of all bodies interpolated at
+        # resample_fps instead of the frames of the producers
+        self.resampler = PoseResampler(resample_extrapolation) \
+            if resample_fps is not None else None
+        self.resample_interval = 1 / resample_fps \
+            if resample_fps is not None else None
+        self.next_resample = time.monotonic()
+        # consumers that receive the frames of the resampler
+        self.resampled_consumers = []
         self.clients = {}
         self.body_poses = {}
+        # body ID -> newest frame, collected during a loop iteration for the
+        # batched consumers
+        self.batch_updates = {}
         self.send_initial_transmissions = send_initial_transmissions
         self.first_transmissions = {}
         self.next_free_body_id = 1
+        # Upper bound for the number of frames that are queued for a consumer
+        # that can not keep up. Only the newest frame of each body is queued.
+        self.max_queued_frames = max_queued_frames
+        # SO_SNDBUF of accepted connections, 0 or None keeps the system
+        # default. Without a cap, the kernel buffers seconds of frames for a
+        # slow consumer before any of them are queued and coalesced.
+        self.send_buffer_size = send_buffer_size
 
 
     def start_server(self, verbosity):
@@ -31,115 +135,1208 @@ class BodyPoseTcpServer:
             verbosity (int): Verbosity level. 0: No status messages.
                 1: Important status messages. 2: All messages.
         """
-        self.lsock.bind((self.host, self.port))
-        self.lsock.listen(self.connections_to_accept)
-        if verbosity > 0:
-            print(f"Listening on {(self.host, self.port)}")
+        if not self.lsock_listening:
+            self.lsock.bind((self.host, self.port))
+            self.lsock.listen(self.connections_to_accept)
+            if verbosity > 0:
+                print(f"Listening on {(self.host, self.port)}")
         self.lsock.setblocking(False)
         self.sel.register(
             fileobj=self.lsock,
             events=selectors.EVENT_READ,
             data=None
         )
+        if self.unix_socket_path is not None:
+            self._listen_unix(verbosity)
+        if self.shm_ring_name is not None:
+            self.pose_ring = PoseRingWriter(self.shm_ring_name,
+                                            self.shm_ring_slots)
+            if verbosity > 0:
+                print(f"Publishing frames to shared memory ring "
+                      f"{self.shm_ring_name}")
+        if self.udp_targets:
+            self.udp_sender = PoseDatagramSender(self.udp_targets,
+                                                 self.udp_ttl)
+            if verbosity > 0:
+                print(f"Sending frames over UDP to {self.udp_targets}")
+        if self.metrics is not None:
+            self.metrics_endpoint = MetricsEndpoint(
+                self, self.metrics_host, self.metrics_port,
+                self.metrics_socket_path
+            )
+            self.metrics_endpoint.register(self.sel)
+            if verbosity > 0:
+                print("Serving metrics on "
+                      f"{self.metrics_endpoint.addresses()}")
+        metrics = self.metrics
+        metrics_endpoint = self.metrics_endpoint
+        resampler = self.resampler
         try:
             while True:
-                events = self.sel.select(timeout=None)
+                timeout = self.select_timeout
+                if resampler is not None:
+                    until_resample = max(
+                        self.next_resample - time.monotonic(), 0.0
+                    )
+                    timeout = until_resample if timeout is None \
+                        else min(timeout, until_resample)
+                events = self.sel.select(timeout=timeout)
+                if metrics is not None:
+                    time_start = time.perf_counter()
                 for key, mask in events:
                     if key.data is None:
                         self._accept_wrapper(key.fileobj, verbosity)
-                    else:
+                    elif key.data is metrics_endpoint:
+                        metrics_endpoint.handle(key.fileobj, mask,
+                                                self.sel)
+                    elif key.fileobj in self.clients:
+                        # a consumer that was closed while handling an
+                        # earlier event of this batch is skipped
                         self._service_connection(key, mask, verbosity)
+                self._after_select(verbosity)
+                if metrics is not None:
+                    metrics.loop_seconds.observe(
+                        time.perf_counter() - time_start
+                    )
         except KeyboardInterrupt:
             if verbosity > 0:
                 print("Stopping server...")
         finally:
             self.sel.close()
-        
+            if self.unix_lsock is not None:
+                self.unix_lsock.close()
+                os.unlink(self.unix_socket_path)
+            if self.pose_ring is not None:
+                self.pose_ring.close()
+            if self.metrics_endpoint is not None:
+                self.metrics_endpoint.close()
+            if self.udp_sender is not None:
+                if verbosity > 0 and self.udp_sender.datagrams_dropped:
+                    print(f"Could not send "
+                          f"{self.udp_sender.datagrams_dropped} datagrams")
+                self.udp_sender.close()
+
+
+    def _listen_unix(self, verbosity):
+        if os.path.exists(self.unix_socket_path):
+            # left over from a server that did not shut down cleanly
+            os.unlink(self.unix_socket_path)
+        self.unix_lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.unix_lsock.bind(self.unix_socket_path)
+        self.unix_lsock.listen(self.connections_to_accept)
+        self.unix_lsock.setblocking(False)
+        self.sel.register(self.unix_lsock, selectors.EVENT_READ, data=None)
+        if verbosity > 0:
+            print(f"Listening on {self.unix_socket_path}")
+
+
+    def _after_select(self, verbosity):
+        """Called once per loop iteration, after all events were handled"""
+        if self.batch_updates:
+            self._update_batched_consumers(verbosity)
+        if self.resampler is not None:
+            now = time.monotonic()
+            if now >= self.next_resample:
+                self.next_resample += self.resample_interval
+                if self.next_resample <= now:
+                    # the loop fell behind, skip the missed ticks
+                    self.next_resample = now + self.resample_interval
+                if self.resampled_consumers:
+                    self._update_resampled_consumers(now, verbosity)
+
 
     def _accept_wrapper(self, sock, verbosity):
-        conn, addr = sock.accept()
+        try:
+            conn, addr = sock.accept()
+        except BlockingIOError:
+            # another process sharing the listening socket was faster
+            return
+        if not addr:
+            # clients of a unix domain socket are unnamed
+            addr = f"{sock.getsockname()}:{conn.fileno()}"
         if verbosity > 0:
             print(f"Accepted connection from {addr}")
         conn.setblocking(False)
+        if conn.family != socket.AF_UNIX:
+            # frames must not wait for the acknowledgement of the previous
+            # ones (Nagle's algorithm)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.send_buffer_size:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            self.send_buffer_size)
         self.clients[conn] = {'addr': addr, 'body_id': 0}
-        self.consumers.append(conn)
-        data = types.SimpleNamespace(addr=addr, producer=False,
-                                     recv_init_transm=not self.send_initial_transmissions)
+        data = types.SimpleNamespace(addr=addr, producer=False, batched=False,
+                                     udp_only=False,
+                                     # receives the frames of the resampler
+                                     resampled=False,
+                                     # body IDs the consumer subscribed to,
+                                     # None receives all bodies
+                                     subscriptions=None,
+                                     # bodies whose first transmission was
+                                     # sent to the consumer
+                                     initial_transmissions_sent=set(),
+                                     # PoseEncoder of consumers that asked
+                                     # for an encoding
+                                     encoder=None,
+                                     # PoseDecoder of producers that send
+                                     # encoded frames
+                                     decoder=None,
+                                     # FrameProfile of consumers that asked
+                                     # for another coordinate frame
+                                     profile=None,
+                                     frames=FrameReassembler(POSE_FRAME_SIZE),
+                                     events=selectors.EVENT_READ,
+                                     # bytes that have to be sent in order
+                                     out_pending=bytearray(),
+                                     # body ID -> newest frame not yet sent
+                                     out_queue={},
+                                     frames_dropped=0,
+                                     # stream index -> body ID of producers
+                                     # that send several streams
+                                     streams={},
+                                     # frames received from a producer
+                                     frames_in=0,
+                                     # body ID -> frames received in a stream
+                                     stream_frames_in={},
+                                     # frames and bytes sent to a consumer
+                                     frames_out=0,
+                                     bytes_out=0)
+        self.sel.register(conn, data.events, data=data)
+        self._add_consumer(conn, data)
         # Whenever a new client connects, we want to send the first transmissions
         # of all active producers to this client, so that the client can correctly
         # calculate the position difference that it has to apply to its base position
         if self.send_initial_transmissions:
-            events = selectors.EVENT_WRITE
-        else:
-            events = selectors.EVENT_READ
-        self.sel.register(conn, events, data=data)
+            self._send_initial_transmissions(conn, data,
+                                             list(self.first_transmissions))
+
+
+    def _send_initial_transmissions(self, sock, data, body_ids):
+        """Queues the first transmissions of the given bodies, if they are
+        active"""
+        for body_id in body_ids:
+            msg = self.first_transmissions.get(body_id)
+            if msg is None:
+                continue
+            if data.profile is not None:
+                msg = data.profile.apply_frame(msg)
+            data.out_pending += int(body_id).to_bytes(4, 'big') + msg
+            data.initial_transmissions_sent.add(body_id)
+        if data.out_pending:
+            self._set_events(sock, data,
+                             selectors.EVENT_READ | selectors.EVENT_WRITE)
 
 
     def _service_connection(self, key, mask, verbosity):
         sock = key.fileobj
         data = key.data
         if mask & selectors.EVENT_WRITE:
-            if not data.recv_init_transm and self.send_initial_transmissions:
-                self._send_initial_transmissions(sock)
-                data.recv_init_transm = True
-            else:
-                if verbosity > 0:
-                    print(
-                        "Received write event for client with recv_init_transm"
-                        f" = True. Client: {self.clients[sock]['addr']}"
-                    )
-            self.sel.modify(sock, selectors.EVENT_READ, data)
+            if not self._flush(sock, data):
+                self._close_connection(sock, data, verbosity)
+                return
         if mask & selectors.EVENT_READ:
-            recv_data = sock.recv(672)
-            if recv_data:
-                if not data.producer:
-                    # client is now a producer
-                    data.producer = True
+            try:
+                messages = data.frames.recv_messages(sock)
+            except ValueError as e:
+                if verbosity > 0:
+                    print(f"Invalid message from {data.addr}: {e}")
+                messages = None
+            if messages is None:
+                self._close_connection(sock, data, verbosity)
+                return
+            try:
+                for msg_type, payload in messages:
+                    if msg_type != MSG_FRAME:
+                        check_client_message(msg_type, payload)
+            except ValueError as e:
+                if verbosity > 0:
+                    print(f"Invalid message from {data.addr}: {e}")
+                self._close_connection(sock, data, verbosity)
+                return
+            frames = []
+            for msg_type, payload in messages:
+                if msg_type == MSG_FRAME:
+                    frames.append(payload)
+                elif msg_type == MSG_ENCODED_FRAME:
                     try:
-                        self.consumers.remove(sock)
-                    except ValueError:
-                        print(
-                            'Could not remove transmitting client from '
-                            'consumer list'
-                        )
-                    self.clients[sock]['body_id'] = self.next_free_body_id
-                    self.first_transmissions[self.next_free_body_id] = \
-                        deepcopy(recv_data)
-                    if verbosity > 0:
-                        print(f"Assigned body ID {self.next_free_body_id} to "
-                            f"{self.clients[sock]['addr']}"
-                        )
-                    self.next_free_body_id += 1
+                        frames.append(self._decode_frame(data, payload))
+                    except ValueError as e:
+                        if verbosity > 0:
+                            print(f"Invalid frame from {data.addr}: {e}")
+                        self._close_connection(sock, data, verbosity)
+                        return
+                elif msg_type == MSG_STREAM_FRAMES:
+                    if not self._forward_stream_frames(sock, data, payload,
+                                                       verbosity):
+                        self._close_connection(sock, data, verbosity)
+                        return
+                elif msg_type == MSG_END_STREAMS:
+                    self._end_streams(data, payload, verbosity)
+                elif self._handle_message(sock, data, msg_type, payload,
+                                          verbosity):
+                    # the remaining messages belong to a closed connection
+                    return
+            if frames:
+                if not data.producer:
+                    self._make_producer(sock, data)
+                if not self.clients[sock]['body_id']:
+                    self.clients[sock]['body_id'] = self._start_body(
+                        data, frames[0], verbosity
+                    )
                 curr_body_id = self.clients[sock]['body_id']
-                self.body_poses[curr_body_id] = recv_data
-                self._update_consumers(curr_body_id, verbosity)
-            else:
+                data.frames_in += len(frames)
+                # All frames that arrived with this read are forwarded in
+                # order. They are views into the receive buffer, so only the
+                # most recent one is copied to outlive the next read.
+                for frame in frames:
+                    self._update_consumers(curr_body_id, frame, verbosity)
+                self._store_pose(curr_body_id, bytes(frames[-1]))
+
+
+    def _make_producer(self, sock, data):
+        """Turns a client into a producer once it sends its first frame"""
+        data.producer = True
+        try:
+            self._remove_consumer(sock, data)
+        except (ValueError, KeyError):
+            print(
+                'Could not remove transmitting client from '
+                'consumer list'
+            )
+
+
+    def _start_body(self, data, first_frame, verbosity):
+        """Assigns a body ID to a new body of a producer.
+
+        Returns:
+            int: The body ID.
+        """
+        body_id = self._assign_body_id(first_frame)
+        if verbosity > 0:
+            print(f"Assigned body ID {body_id} to {data.addr}")
+        if self.send_initial_transmissions and self.udp_consumers:
+            # the first transmission must not get lost
+            body_id_bytes = int(body_id).to_bytes(4, 'big')
+            self._send_to_all(
+                [consumer for consumer in self.udp_consumers
+                 if self._is_subscribed(consumer, body_id)],
+                [body_id_bytes, first_frame],
+                ((body_id, body_id_bytes, first_frame),), verbosity
+            )
+        return body_id
+
+
+    def _forward_stream_frames(self, sock, data, payload, verbosity):
+        """Forwards the frames of a MSG_STREAM_FRAMES message, assigning a
+        body ID to every stream that was not seen before and telling the
+        producer about it.
+
+        Returns:
+            bool: False if the connection to the producer broke down.
+        """
+        num_records = COUNT.unpack_from(payload)[0]
+        if not data.producer:
+            self._make_producer(sock, data)
+        streams = data.streams
+        stream_frames_in = data.stream_frames_in
+        # stream index and body ID of every new stream
+        started = []
+        offset = COUNT.size
+        for _ in range(num_records):
+            stream = int.from_bytes(payload[offset:offset + 4], 'big')
+            frame = payload[offset + 4:offset + BODY_FRAME_SIZE]
+            offset += BODY_FRAME_SIZE
+            body_id = streams.get(stream)
+            if body_id is None:
+                body_id = streams[stream] = self._start_body(data, frame,
+                                                             verbosity)
+                stream_frames_in[body_id] = 0
+                started += (stream, body_id)
+            stream_frames_in[body_id] += 1
+            self._update_consumers(body_id, frame, verbosity)
+            self._store_pose(body_id, bytes(frame))
+        data.frames_in += num_records
+        if not started:
+            return True
+        return self._send_reply(sock, data, [encode_message(
+            MSG_STREAMS_STARTED, encode_body_ids(started)
+        )])
+
+
+    def _end_streams(self, data, payload, verbosity):
+        """Releases the bodies of the streams of a MSG_END_STREAMS message"""
+        for stream in decode_body_ids(payload):
+            body_id = data.streams.pop(stream, None)
+            if body_id is None:
+                continue
+            del data.stream_frames_in[body_id]
+            self._release_body_id(body_id)
+            if verbosity > 0:
+                print(f"Released body ID {body_id} of {data.addr}")
+
+
+    def _decode_frame(self, data, payload):
+        """Returns the raw frame of a MSG_ENCODED_FRAME sent by a producer"""
+        if data.decoder is None:
+            data.decoder = PoseDecoder()
+        # the body ID is assigned by the server, the one in the message is
+        # not used
+        return data.decoder.decode(0, payload[4:]).tobytes()
+
+
+    def _encode_frame(self, encoder, body_id, body_id_bytes, pose):
+        return encode_message(MSG_ENCODED_FRAME,
+                              body_id_bytes + encoder.encode(body_id, pose))
+
+
+    def _assign_body_id(self, first_frame):
+        body_id = self.next_free_body_id
+        self.first_transmissions[body_id] = bytes(first_frame)
+        self.next_free_body_id += 1
+        return body_id
+
+
+    def _release_body_id(self, body_id):
+        del self.first_transmissions[body_id]
+        if self.history is not None:
+            self.history.forget(body_id)
+        if self.udp_sender is not None:
+            self.udp_sender.forget(body_id)
+        if self.resampler is not None:
+            self.resampler.forget(body_id)
+        for key in self.sel.get_map().values():
+            # skip the listening sockets and the metrics endpoint
+            if key.fileobj in self.clients and key.data.encoder is not None:
+                key.data.encoder.forget(body_id)
+
+
+    def _store_pose(self, body_id, pose):
+        self.body_poses[body_id] = pose
+        if self.batched_consumers or self.filtered_batched_consumers:
+            self.batch_updates[body_id] = pose
+
+
+    def _handle_message(self, sock, data, msg_type, payload, verbosity):
+        """Handles a message that does not carry frames.
+
+        Returns:
+            bool: True if the connection to the client was closed.
+        """
+        if msg_type == MSG_SET_BATCHED:
+            if not data.batched and not data.producer and not data.udp_only \
+                    and data.encoder is None:
+                self._remove_consumer(sock, data)
+                data.batched = True
+                self._add_consumer(sock, data)
                 if verbosity > 0:
-                    print(f"Client at {data.addr} closed the connection.")
-                self.sel.unregister(sock)
-                try:
-                    self.consumers.remove(sock)
-                except ValueError:
-                    pass
-                if data.producer:
-                    del self.first_transmissions[self.clients[sock]['body_id']]
-                del self.clients[sock]
-                sock.close()
+                    print(f"Sending batched updates to {data.addr}")
+        elif msg_type == MSG_SET_UDP_ONLY:
+            if not data.udp_only and not data.producer:
+                self._remove_consumer(sock, data)
+                data.udp_only = True
+                self._add_consumer(sock, data)
+                if verbosity > 0:
+                    print(f"{data.addr} receives frames over UDP")
+        elif msg_type == MSG_SET_RESAMPLED:
+            if self.resampler is None:
+                if verbosity > 0:
+                    print(f"Ignoring request for resampled frames from "
+                          f"{data.addr}, resampling is disabled")
+            elif not data.resampled and not data.producer \
+                    and not data.udp_only:
+                self._remove_consumer(sock, data)
+                data.resampled = True
+                self._add_consumer(sock, data)
+                if verbosity > 0:
+                    print(f"Sending resampled frames to {data.addr}")
+        elif msg_type == MSG_SET_ENCODING:
+            if not self._set_encoding(sock, data, payload, verbosity):
+                self._close_connection(sock, data, verbosity)
+                return True
+        elif msg_type == MSG_SET_FRAME_PROFILE:
+            if not self._set_frame_profile(sock, data, payload, verbosity):
+                self._close_connection(sock, data, verbosity)
+                return True
+        elif msg_type in (MSG_SUBSCRIBE, MSG_UNSUBSCRIBE):
+            if data.producer:
+                return False
+            self._update_subscriptions(sock, data, msg_type == MSG_SUBSCRIBE,
+                                       decode_body_ids(payload), verbosity)
+        elif msg_type == MSG_REQUEST_HISTORY:
+            if data.producer:
+                return False
+            if not self._send_history(sock, data,
+                                      *HISTORY_REQUEST.unpack(payload)):
+                self._close_connection(sock, data, verbosity)
+                return True
+        elif msg_type == MSG_SET_FRAMED:
+            # data.frames already switched to framed mode
+            if verbosity > 1:
+                print(f"{data.addr} only sends messages")
+        elif verbosity > 0:
+            print(f"Ignoring message of unknown type {msg_type} from "
+                  f"{data.addr}")
+        return False
+
+
+    def _set_encoding(self, sock, data, payload, verbosity):
+        """Handles a MSG_SET_ENCODING message and tells the client which
+        encoding it got.
+
+        Producers may use any encoding, their frames carry their format.
+        Batched and UDP consumers always receive raw frames.
+
+        Returns:
+            bool: False if the connection to the client broke down.
+        """
+        encoding = COUNT.unpack(payload)[0]
+        if encoding not in FORMAT_SIZES or (not data.producer and (
+                data.batched or data.udp_only)):
+            accepted = ENCODING_RAW
+        else:
+            accepted = encoding
+        if not data.producer and not data.batched and not data.udp_only:
+            self._remove_consumer(sock, data)
+            data.encoder = None if accepted == ENCODING_RAW \
+                else PoseEncoder(accepted, self.keyframe_interval)
+            self._add_consumer(sock, data)
+        if verbosity > 0:
+            print(f"Using encoding {accepted} for {data.addr}")
+        return self._send_reply(
+            sock, data, [encode_message(MSG_SET_ENCODING, COUNT.pack(accepted))]
+        )
+
+
+    def _set_frame_profile(self, sock, data, payload, verbosity):
+        """Handles a MSG_SET_FRAME_PROFILE message and tells the client
+        whether it got the profile.
+
+        The first transmissions the consumer already received are sent
+        again in the new coordinate frame, so that it can compute position
+        differences from them.
+
+        Returns:
+            bool: False if the connection to the client broke down.
+        """
+        reason = None
+        if data.producer:
+            reason = "producers do not receive frames"
+        elif data.udp_only:
+            # datagrams are shared by all receivers
+            reason = "frames over UDP are not converted"
+        else:
+            try:
+                profile = FrameProfile.decode(payload)
+            except ValueError as e:
+                reason = str(e)
+        if reason is not None:
+            if verbosity > 0:
+                print(f"Rejecting frame profile of {data.addr}: {reason}")
+            return self._send_reply(sock, data,
+                                    [encode_message(MSG_SET_FRAME_PROFILE)])
+        self._remove_consumer(sock, data)
+        data.profile = None if profile.is_identity else profile
+        self._add_consumer(sock, data)
+        if verbosity > 0:
+            print(f"Using {profile} for {data.addr}")
+        if not self._send_reply(sock, data, [encode_message(
+                MSG_SET_FRAME_PROFILE, profile.encode())]):
+            return False
+        if self.send_initial_transmissions:
+            self._send_initial_transmissions(
+                sock, data, list(data.initial_transmissions_sent)
+            )
+        return True
+
+
+    def _send_history(self, sock, data, body_id, mode, value):
+        """Answers a MSG_REQUEST_HISTORY message with one MSG_HISTORY
+        message per requested body.
+
+        Args:
+            body_id (int): Body whose frames are requested, 0 for all active
+                bodies the consumer is subscribed to.
+            mode (int): HISTORY_LAST for the last value frames, HISTORY_SINCE
+                for the frames from sequence number value on.
+
+        Returns:
+            bool: False if the connection to the client broke down.
+        """
+        if body_id == 0:
+            body_ids = [active_id for active_id in self.first_transmissions
+                        if self._is_subscribed(sock, active_id)]
+        else:
+            body_ids = [body_id]
+        buffers = []
+        for body_id in body_ids:
+            if self.history is None or mode not in (HISTORY_LAST,
+                                                     HISTORY_SINCE):
+                first_seq, num_frames, times, frames = 0, 0, [], []
+            elif mode == HISTORY_LAST:
+                first_seq, num_frames, times, frames = \
+                    self.history.last(body_id, value)
+            else:
+                first_seq, num_frames, times, frames = \
+                    self.history.frames_since(body_id, value)
+            buffers.append(encode_history_header(body_id, first_seq,
+                                                 num_frames))
+            buffers += times
+            if data.profile is not None and frames:
+                frames = [
+                    data.profile.apply_body_frames(np.concatenate(frames))
+                ]
+            buffers += frames
+        if not buffers:
+            return True
+        return self._send_reply(sock, data, buffers)
+
+
+    def _send_reply(self, sock, data, buffers):
+        """Sends a message that must not be dropped like queued frames.
+
+        Returns:
+            bool: False if the connection to the client broke down.
+        """
+        if data.out_pending or data.out_queue:
+            data.out_pending += b''.join(buffers)
+            self._set_events(sock, data,
+                             selectors.EVENT_READ | selectors.EVENT_WRITE)
+            return True
+        return self._send_to_consumer(sock, data, buffers, ())
 
 
-    def _update_consumers(self, body_id, verbosity):
-        for sock in self.consumers:
-            data_to_transmit = int(body_id).to_bytes(4, 'big') \
-                + self.body_poses[body_id]
+    def _update_subscriptions(self, sock, data, subscribe, body_ids,
+                              verbosity):
+        """Adds bodies to or removes them from the subscriptions of a
+        consumer.
+
+        Subscribing to an active body sends its first transmission, unless
+        the consumer already received it. Consumers that did not subscribe
+        to any body keep receiving all bodies when they unsubscribe.
+        """
+        if data.subscriptions is None and not subscribe:
+            if verbosity > 0:
+                print(f"Ignoring unsubscribe of {data.addr}, it is not "
+                      f"subscribed to any body")
+            return
+        self._remove_consumer(sock, data)
+        if data.subscriptions is None:
+            data.subscriptions = set()
+        if subscribe:
+            data.subscriptions.update(body_ids)
+        else:
+            data.subscriptions.difference_update(body_ids)
+        self._add_consumer(sock, data)
+        if verbosity > 0:
+            print(f"{data.addr} subscribed to bodies "
+                  f"{sorted(data.subscriptions)}")
+        if subscribe and self.send_initial_transmissions:
+            self._send_initial_transmissions(
+                sock, data,
+                [body_id for body_id in body_ids
+                 if body_id not in data.initial_transmissions_sent]
+            )
+
+
+    def _close_connection(self, sock, data, verbosity):
+        if verbosity > 0:
+            print(f"Client at {data.addr} closed the connection.")
+        self.sel.unregister(sock)
+        if data.producer:
+            # producers that only send streams have no body of their own
+            if self.clients[sock]['body_id']:
+                self._release_body_id(self.clients[sock]['body_id'])
+            for body_id in data.streams.values():
+                self._release_body_id(body_id)
+        else:
+            self._remove_consumer(sock, data)
+            if verbosity > 0 and data.frames_dropped:
+                print(f"Dropped {data.frames_dropped} frames for slow client "
+                      f"{data.addr}")
+        del self.clients[sock]
+        sock.close()
+
+
+    def _add_consumer(self, sock, data):
+        """Adds a consumer to the lists that decide which frames it gets"""
+        if data.subscriptions is None or data.udp_only or data.resampled:
+            self._consumer_list(data).append(sock)
+        elif data.batched:
+            self.filtered_batched_consumers.append(sock)
+        else:
+            for body_id in data.subscriptions:
+                self.subscribers.setdefault(body_id, []).append(sock)
+
+
+    def _remove_consumer(self, sock, data):
+        if data.subscriptions is None or data.udp_only or data.resampled:
+            self._consumer_list(data).remove(sock)
+        elif data.batched:
+            self.filtered_batched_consumers.remove(sock)
+        else:
+            for body_id in data.subscriptions:
+                subscribers = self.subscribers[body_id]
+                subscribers.remove(sock)
+                if not subscribers:
+                    del self.subscribers[body_id]
+
+
+    def _is_subscribed(self, sock, body_id):
+        subscriptions = self.sel.get_key(sock).data.subscriptions
+        return subscriptions is None or body_id in subscriptions
+
+
+    def _consumer_list(self, data):
+        if data.udp_only:
+            return self.udp_consumers
+        if data.resampled:
+            return self.resampled_consumers
+        if data.batched:
+            return self.batched_consumers
+        if data.encoder is not None or data.profile is not None:
+            return self.converted_consumers
+        return self.consumers
+
+
+    def _update_consumers(self, body_id, pose, verbosity):
+        if self.metrics is not None:
+            time_start = time.perf_counter()
+        body_id_bytes = int(body_id).to_bytes(4, 'big')
+        if self.history is not None:
+            self.history.append(body_id, body_id_bytes, pose, time.time())
+        if self.pose_ring is not None:
+            self.pose_ring.write(body_id_bytes, pose)
+        if self.udp_sender is not None:
+            self.udp_sender.send(body_id, body_id_bytes, pose)
+        if self.resampler is not None:
+            self.resampler.add_frame(body_id, pose, time.monotonic())
+        records = ((body_id, body_id_bytes, pose),)
+        self._send_to_all(self.consumers, [body_id_bytes, pose], records,
+                          verbosity)
+        if self.converted_consumers:
+            self._send_frame(self.converted_consumers, body_id,
+                             body_id_bytes, pose, verbosity)
+        subscribers = self.subscribers.get(body_id)
+        if subscribers:
+            self._send_frame(subscribers, body_id, body_id_bytes, pose,
+                             verbosity)
+        if self.metrics is not None:
+            self.metrics.fanout_seconds.observe(
+                time.perf_counter() - time_start
+            )
+
+
+    def _send_frame(self, consumers, body_id, body_id_bytes, pose,
+                    verbosity):
+        """Sends a frame to consumers that may have asked for an encoding.
+
+        Stateless encodings are computed once and shared by all consumers
+        that use them. Delta frames depend on the frames a consumer received
+        before, so frames that wait in the queue of a slow consumer are only
+        encoded when they are actually sent.
+        """
+        records = ((body_id, body_id_bytes, pose),)
+        # profile -> converted frame
+        shared_poses = {None: pose}
+        shared_messages = {}
+        closed_connections = []
+        for sock in consumers:
+            data = self.sel.get_key(sock).data
+            if data.out_pending or data.out_queue:
+                self._queue_frame(data, body_id, body_id_bytes + pose)
+                continue
+            profile = data.profile
+            profile_pose = shared_poses.get(profile)
+            if profile_pose is None:
+                profile_pose = shared_poses[profile] = \
+                    profile.apply_frame(pose)
+            encoder = data.encoder
+            if encoder is None:
+                buffers = [body_id_bytes, profile_pose]
+            else:
+                message = shared_messages.get((encoder.encoding, profile)) \
+                    if encoder.stateless else None
+                if message is None:
+                    message = self._encode_frame(encoder, body_id,
+                                                 body_id_bytes, profile_pose)
+                    if encoder.stateless:
+                        shared_messages[encoder.encoding, profile] = message
+                buffers = [message]
+            if not self._send_to_consumer(sock, data, buffers, records):
+                closed_connections.append((sock, data))
+        for sock, data in closed_connections:
+            self._close_connection(sock, data, verbosity)
+
+
+    def _update_batched_consumers(self, verbosity):
+        """Sends the updates of the current loop iteration as one packet.
+
+        The packet is only assembled once and shared by all batched consumers.
+        """
+        records = tuple(
+            (body_id, int(body_id).to_bytes(4, 'big'), pose)
+            for body_id, pose in self.batch_updates.items()
+        )
+        self.batch_updates = {}
+        # profile -> records with converted frames
+        profile_records = {None: records}
+        for profile, consumers in self._group_by_profile(
+                self.batched_consumers):
+            self._send_to_all(consumers, self._batch_buffers(
+                self._profile_records(records, profile, profile_records)
+            ), records, verbosity)
+        # iterate over a copy, consumers whose connection broke down are
+        # removed from the list
+        for sock in list(self.filtered_batched_consumers):
+            data = self.sel.get_key(sock).data
+            converted = self._profile_records(records, data.profile,
+                                              profile_records)
+            subscribed = [i for i, record in enumerate(records)
+                          if record[0] in data.subscriptions]
+            if subscribed:
+                self._send_to_all(
+                    [sock],
+                    self._batch_buffers([converted[i] for i in subscribed]),
+                    tuple(records[i] for i in subscribed), verbosity
+                )
+
+
+    def _update_resampled_consumers(self, now, verbosity):
+        """Sends the frames of all bodies, interpolated at now, to the
+        consumers that asked for resampled frames"""
+        body_ids, frames = self.resampler.resample(now)
+        frames = memoryview(frames.tobytes())
+        records = tuple(
+            (body_id, int(body_id).to_bytes(4, 'big'),
+             frames[i * POSE_FRAME_SIZE:(i + 1) * POSE_FRAME_SIZE])
+            for i, body_id in enumerate(body_ids)
+        )
+        profile_records = {None: records}
+        # iterate over copies, consumers whose connection broke down are
+        # removed from the list
+        for sock in list(self.resampled_consumers):
+            data = self.sel.get_key(sock).data
+            if not data.batched:
+                continue
+            converted = self._profile_records(records, data.profile,
+                                              profile_records)
+            subscribed = range(len(records)) if data.subscriptions is None \
+                else [i for i, record in enumerate(records)
+                      if record[0] in data.subscriptions]
+            if subscribed:
+                self._send_to_all(
+                    [sock],
+                    self._batch_buffers([converted[i] for i in subscribed]),
+                    tuple(records[i] for i in subscribed), verbosity
+                )
+        for body_id, body_id_bytes, pose in records:
+            consumers = [
+                sock for sock in self.resampled_consumers
+                if not self.sel.get_key(sock).data.batched
+                and self._is_subscribed(sock, body_id)
+            ]
+            if consumers:
+                self._send_frame(consumers, body_id, body_id_bytes, pose,
+                                 verbosity)
+
+
+    def _group_by_profile(self, consumers):
+        """Returns (profile, consumers) pairs of the consumers that share a
+        frame profile"""
+        groups = {}
+        for sock in consumers:
+            groups.setdefault(self.sel.get_key(sock).data.profile,
+                              []).append(sock)
+        return groups.items()
+
+
+    def _profile_records(self, records, profile, profile_records):
+        """Returns the records with their frames converted to a profile.
+
+        The frames of all records are converted at once, and only once per
+        profile, the result is kept in the profile_records dict.
+        """
+        converted = profile_records.get(profile)
+        if converted is None:
+            frames = profile.apply(np.frombuffer(
+                b''.join(pose for _, _, pose in records), dtype=np.float32
+            ).reshape(len(records), POSE_FRAME_VALUES))
+            frames = memoryview(frames.tobytes())
+            converted = profile_records[profile] = tuple(
+                (body_id, body_id_bytes,
+                 frames[i * POSE_FRAME_SIZE:(i + 1) * POSE_FRAME_SIZE])
+                for i, (body_id, body_id_bytes, _) in enumerate(records)
+            )
+        return converted
+
+
+    def _batch_buffers(self, records):
+        buffers = [encode_batch_header(len(records))]
+        for _, body_id_bytes, pose in records:
+            buffers.append(body_id_bytes)
+            buffers.append(pose)
+        return buffers
+
+
+    def _send_to_all(self, consumers, buffers, records, verbosity):
+        closed_connections = []
+        for sock in consumers:
             if verbosity > 1:
                 print(f"Transmitting to {self.clients[sock]['addr']}")
-            sock.sendall(data_to_transmit)
+            data = self.sel.get_key(sock).data
+            if not self._send_to_consumer(sock, data, buffers, records):
+                closed_connections.append((sock, data))
+        for sock, data in closed_connections:
+            self._close_connection(sock, data, verbosity)
+
+
+    def _send_to_consumer(self, sock, data, buffers, records):
+        """Sends a message to a consumer without blocking.
 
+        If the consumer still has outstanding data, the frames of the message
+        are queued instead. The queue holds only the newest frame of each
+        body, older frames of the same body are dropped.
 
-    def _send_initial_transmissions(self, sock):
-        for body_id, msg in self.first_transmissions.items():
-            data_to_transmit = int(body_id).to_bytes(4, 'big') + msg
-            sock.sendall(data_to_transmit)
+        Args:
+            sock (socket.socket): Socket of the consumer.
+            data (types.SimpleNamespace): State of the consumer connection.
+            buffers (list): Bytes-like objects that make up the message.
+            records (tuple): (body ID, body ID bytes, frame) for every frame
+                contained in the message.
+
+        Returns:
+            bool: False if the connection to the consumer broke down.
+        """
+        if data.out_pending or data.out_queue:
+            for body_id, body_id_bytes, pose in records:
+                self._queue_frame(data, body_id, body_id_bytes + pose)
+            return True
+        try:
+            if HAS_SENDMSG:
+                num_sent = sock.sendmsg(buffers)
+            else:
+                num_sent = sock.send(b''.join(buffers))
+        except BlockingIOError:
+            num_sent = 0
+        except OSError:
+            return False
+        data.bytes_out += num_sent
+        data.frames_out += len(records)
+        if num_sent < sum(len(buffer) for buffer in buffers):
+            # the rest of a started message has to be sent in any case
+            data.out_pending += b''.join(buffers)[num_sent:]
+            self._set_events(sock, data,
+                             selectors.EVENT_READ | selectors.EVENT_WRITE)
+        return True
+
+
+    def _queue_frame(self, data, body_id, message):
+        dropped = data.out_queue.pop(body_id, None)
+        if dropped is None and len(data.out_queue) >= self.max_queued_frames:
+            # drop the frame that waited the longest
+            del data.out_queue[next(iter(data.out_queue))]
+            dropped = True
+        if dropped is not None:
+            data.frames_dropped += 1
+        data.out_queue[body_id] = message
+
+
+    def _flush(self, sock, data):
+        """Sends outstanding data to a consumer until the socket would block.
+
+        Returns:
+            bool: False if the connection to the consumer broke down.
+        """
+        while data.out_pending or data.out_queue:
+            if not data.out_pending:
+                if data.batched:
+                    data.out_pending += encode_batch_header(len(data.out_queue))
+                for body_id, message in data.out_queue.items():
+                    if data.profile is not None:
+                        message = message[:4] \
+                            + data.profile.apply_frame(message[4:])
+                    if data.encoder is not None:
+                        message = self._encode_frame(
+                            data.encoder, body_id, message[:4], message[4:]
+                        )
+                    data.out_pending += message
+                data.frames_out += len(data.out_queue)
+                data.out_queue.clear()
+            try:
+                num_sent = sock.send(data.out_pending)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+            data.bytes_out += num_sent
+            del data.out_pending[:num_sent]
+        self._set_events(sock, data, selectors.EVENT_READ)
+        return True
+
+
+    def _set_events(self, sock, data, events):
+        if data.events != events:
+            data.events = events
+            self.sel.modify(sock, events, data)
+
+
+    def connection_stats(self):
+        """Returns the state of the outbound buffers of all consumers.
+
+        Returns:
+            list: One dict per consumer with its address, the number of
+                frames waiting in its queue, the number of bytes of started
+                frames that still have to be sent and the number of frames
+                that were dropped because the consumer could not keep up, as
+                well as the number of frames and bytes sent to it.
+        """
+        stats = []
+        for sock in self.clients:
+            data = self.sel.get_key(sock).data
+            if data.producer:
+                continue
+            stats.append({
+                'addr': data.addr,
+                'batched': data.batched,
+                'udp_only': data.udp_only,
+                'subscriptions': sorted(data.subscriptions)
+                if data.subscriptions is not None else None,
+                'encoding': data.encoder.encoding
+                if data.encoder is not None else ENCODING_RAW,
+                'queue_depth': len(data.out_queue),
+                'pending_bytes': len(data.out_pending),
+                'frames_dropped': data.frames_dropped,
+                'frames_out': data.frames_out,
+                'bytes_out': data.bytes_out
+            })
+        return stats
+
+
+class ShardedBodyPoseTcpServer(BodyPoseTcpServer):
+    """Worker of a server that is spread over several processes.
+
+    All workers accept connections on the same port. Body IDs, first
+    transmissions and the latest frame of every body live in a
+    SharedPoseTable, so that the consumers of a worker also receive the
+    frames of producers that are connected to another worker.
+    """
+    def __init__(self, worker_index, pose_table, *args, poll_interval=0.001,
+                 wakeup_reader=None, wakeup_writers=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker_index = worker_index
+        self.pose_table = pose_table
+        # While other workers have active bodies, the table is polled for
+        # their frames at least this often. Otherwise the worker sleeps until
+        # one of its sockets is ready.
+        self.poll_interval = poll_interval
+        # Workers write a byte to the wakeup_writers of all other workers
+        # when they add or remove a body, and wait for their own
+        # wakeup_reader (multiprocessing.Pipe connections)
+        self.wakeup_reader = wakeup_reader
+        self.wakeup_writers = wakeup_writers
+        for conn in wakeup_writers:
+            os.set_blocking(conn.fileno(), False)
+        if wakeup_reader is not None:
+            os.set_blocking(wakeup_reader.fileno(), False)
+            # not a client, the server loop skips it, see _after_select
+            self.sel.register(wakeup_reader, selectors.EVENT_READ, data=self)
+        # body ID -> slot in the pose table, for local producers
+        self.body_slots = {}
+        self.seen_seqs = np.zeros_like(pose_table.seqs)
+        # slots of the bodies of other workers
+        self.remote_slots = np.empty(0, dtype=np.intp)
+        self._sync_first_transmissions()
+
+
+    def _assign_body_id(self, first_frame):
+        body_id, slot = self.pose_table.allocate(self.worker_index, first_frame)
+        self.body_slots[body_id] = slot
+        self.first_transmissions[body_id] = bytes(first_frame)
+        self._wake_workers()
+        return body_id
+
+
+    def _release_body_id(self, body_id):
+        super()._release_body_id(body_id)
+        self.pose_table.release(self.body_slots.pop(body_id))
+        self._wake_workers()
+
+
+    def _wake_workers(self):
+        """Tells the other workers that bodies were added or removed"""
+        for conn in self.wakeup_writers:
+            try:
+                os.write(conn.fileno(), b'\0')
+            except BlockingIOError:
+                # the worker did not handle the earlier wakeups yet
+                pass
+
+
+    def _store_pose(self, body_id, pose):
+        super()._store_pose(body_id, pose)
+        slot = self.body_slots.get(body_id)
+        if slot is not None:
+            self.pose_table.write_frame(slot, pose)
+
+
+    def _after_select(self, verbosity):
+        table = self.pose_table
+        if self.wakeup_reader is not None:
+            # before the generation is compared, so that a wakeup for a
+            # later change is kept
+            try:
+                while os.read(self.wakeup_reader.fileno(), 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        if table.generation != self.table_generation:
+            self._sync_first_transmissions()
+        slots = self.remote_slots
+        changed = slots[table.seqs[slots] != self.seen_seqs[slots]]
+        for slot in changed:
+            body_id = int(table.body_ids[slot])
+            if body_id == 0 or table.owners[slot] == self.worker_index:
+                # reallocated since the last sync, the next one drops it
+                continue
+            seq, frame = table.read_frame(slot)
+            self.seen_seqs[slot] = seq
+            self._update_consumers(body_id, frame, verbosity)
+            self._store_pose(body_id, frame)
+        super()._after_select(verbosity)
+
+
+    def _sync_first_transmissions(self):
+        """Adopts the bodies that were added or removed by other workers"""
+        self.table_generation = self.pose_table.generation
+        active_slots = self.pose_table.active_slots()
+        for body_id in list(self.first_transmissions.keys()):
+            if body_id not in active_slots:
+                # released by another worker, its slot is not ours
+                super()._release_body_id(body_id)
+                self.body_poses.pop(body_id, None)
+        for body_id, slot in active_slots.items():
+            if body_id not in self.first_transmissions:
+                self.first_transmissions[body_id] = \
+                    self.pose_table.first_frame(slot)
+        self.remote_slots = np.array(
+            [slot for slot in active_slots.values()
+             if self.pose_table.owners[slot] != self.worker_index],
+            dtype=np.intp
+        )
+        # without bodies of other workers, there is nothing to poll for
+        self.select_timeout = self.poll_interval \
+            if len(self.remote_slots) else None
+
+
+def _run_worker(worker_index, pose_table, listening_socket, wakeup_reader,
+                wakeup_writers, server_args, server_options, verbosity):
+    options = dict(server_options)
+    if worker_index > 0:
+        # the first worker also receives the frames of all other workers
+        # and publishes them on its own
+        options['udp_targets'] = None
+        options['shm_ring_name'] = None
+    if options.get('metrics_port') is not None:
+        options['metrics_port'] += worker_index
+    server = ShardedBodyPoseTcpServer(
+        worker_index, pose_table, *server_args,
+        reuse_port=listening_socket is None,
+        listening_socket=listening_socket, wakeup_reader=wakeup_reader,
+        wakeup_writers=wakeup_writers, **options
+    )
+    try:
+        server.start_server(verbosity)
+    finally:
+        pose_table.close()
+
+
+def _exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+
+def start_sharded_server(num_workers, host, port, connections_to_accept,
+                         send_initial_transmissions, max_bodies=256,
+                         reuse_port=False, verbosity=1, **server_options):
+    """Starts a server that serves its clients from several processes.
+
+    Args:
+        num_workers (int): Number of worker processes.
+        host (str): Host IPv4 address.
+        port (int): Port.
+        connections_to_accept (int): Backlog of the listening socket.
+        send_initial_transmissions (bool): Whether new clients receive the
+            first transmissions of all active producers.
+        max_bodies (int): Maximum number of simultaneously active bodies.
+        reuse_port (bool): If True, every worker binds its own listening
+            socket with SO_REUSEPORT and the kernel distributes the
+            connections. Otherwise, all workers accept connections from one
+            listening socket created by this process.
+        verbosity (int): Verbosity level.
+        **server_options: Further keyword arguments of BodyPoseTcpServer,
+            used by every worker. Every worker serves its metrics on
+            metrics_port plus its index. Only the first worker publishes
+            frames to udp_targets and shm_ring_name, it sees the newest
+            frames of the producers of all workers.
+
+    Raises:
+        ValueError: If unix_socket_path or metrics_socket_path is given,
+            they can not be shared by the workers.
+    """
+    for name in ('unix_socket_path', 'metrics_socket_path'):
+        if server_options.get(name) is not None:
+            raise ValueError(f"{name} is not supported by a sharded server")
+    pose_table = SharedPoseTable(max_bodies)
+    listening_socket = None
+    if not reuse_port:
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listening_socket.bind((host, port))
+        listening_socket.listen(connections_to_accept)
+        listening_socket.setblocking(False)
+    if verbosity > 0:
+        print(f"Listening on {(host, port)} with {num_workers} workers")
+    server_args = (host, port, connections_to_accept,
+                   send_initial_transmissions)
+    # (reader, writer) of every worker
+    wakeup_pipes = [multiprocessing.Pipe(duplex=False)
+                    for _ in range(num_workers)]
+    workers = [
+        multiprocessing.Process(
+            target=_run_worker,
+            args=(worker_index, pose_table, listening_socket,
+                  wakeup_pipes[worker_index][0],
+                  [writer for index, (_, writer) in enumerate(wakeup_pipes)
+                   if index != worker_index],
+                  server_args, server_options, verbosity)
+        )
+        for worker_index in range(num_workers)
+    ]
+    # SIGTERM ends this process through the finally clause below, so that
+    # the workers do not outlive it
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # workers in the same process group were interrupted as well, make
+        # sure that the others stop, too
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    finally:
+        for worker in workers:
+            if worker.pid is None:
+                # not started
+                continue
+            worker.terminate()
+            worker.join()
+        if listening_socket is not None:
+            listening_socket.close()
+        for reader, writer in wakeup_pipes:
+            reader.close()
+            writer.close()
+        pose_table.close()
+        pose_table.unlink()
 
 
 if __name__ == '__main__':
@@ -158,10 +1355,164 @@ if __name__ == '__main__':
     parser.add_argument('--no-initial-transmissions', action='store_true',
                         help="If specified, no recorded initial transmissions "
                         "will be transmitted on initial contact.")
+    parser.add_argument('--max-queued-frames', type=int, default=32,
+                        help="Maximum number of frames that are queued for a "
+                        "consumer that can not keep up. Only the newest frame "
+                        "of each body is kept. Optional, defaults to 32")
+    parser.add_argument('--send-buffer-size', type=int, default=16 * 1024,
+                        help="Size in bytes of the kernel send buffer of "
+                        "each connection. Frames that do not fit are queued "
+                        "as with --max-queued-frames, so a smaller buffer "
+                        "means less latency for slow consumers. 0 keeps the "
+                        "system default. Not used with --asyncio, see "
+                        "--write-buffer-high. Optional, defaults to 16384")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of worker processes that serve the "
+                        "clients. Optional, defaults to 1")
+    parser.add_argument('--reuse-port', action='store_true',
+                        help="If specified together with --workers, every "
+                        "worker listens on its own socket with SO_REUSEPORT "
+                        "instead of sharing one listening socket.")
+    parser.add_argument('--max-bodies', type=int, default=256,
+                        help="Maximum number of bodies that can be active at "
+                        "the same time if --workers is larger than 1. "
+                        "Optional, defaults to 256")
+    parser.add_argument('--unix-socket', type=str, default=None,
+                        help="Path of a unix domain socket on which the "
+                        "server accepts clients in addition to --host/--port. "
+                        "Optional, defaults to None")
+    parser.add_argument('--shm-ring', type=str, default=None,
+                        help="Name of a shared memory ring buffer to which "
+                        "every frame is published for consumers on the same "
+                        "host. With --workers, the first worker publishes the "
+                        "newest frames of all workers. Optional, defaults to "
+                        "None")
+    parser.add_argument('--shm-ring-slots', type=int, default=1024,
+                        help="Number of frames the shared memory ring buffer "
+                        "holds. Optional, defaults to 1024")
+    parser.add_argument('--udp-targets', nargs='+', default=None,
+                        metavar='HOST:PORT',
+                        help="Multicast groups or unicast receivers to which "
+                        "every frame is sent once over UDP, in addition to "
+                        "the TCP consumers. With --workers, the first worker "
+                        "sends the newest frames of all workers. Not "
+                        "supported with --asyncio. Optional, defaults to "
+                        "None")
+    parser.add_argument('--udp-ttl', type=int, default=1,
+                        help="Time to live of multicast datagrams. Optional, "
+                        "defaults to 1 (local network)")
+    parser.add_argument('--keyframe-interval', type=int, default=30,
+                        help="Number of frames per body between two "
+                        "keyframes for consumers that receive delta encoded "
+                        "frames. Optional, defaults to 30")
+    parser.add_argument('--history-frames', type=int, default=None,
+                        help="Number of recent frames per body that are kept "
+                        "for consumers that request them when they join. 0 "
+                        "disables the history. Not supported with --asyncio. "
+                        "Optional, defaults to 120")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Port on which metrics are served in the "
+                        "Prometheus text format at /metrics, see "
+                        "relay_metrics.py. With --workers, every worker uses "
+                        "this port plus its index. Not supported with "
+                        "--asyncio. Optional, defaults to None")
+    parser.add_argument('--metrics-host', type=str, default="127.0.0.1",
+                        help="Address on which the metrics are served. "
+                        "Optional, defaults to 127.0.0.1")
+    parser.add_argument('--stats-socket', type=str, default=None,
+                        help="Path of a unix domain socket on which the "
+                        "metrics are served like on --metrics-port. Not "
+                        "supported with --workers and --asyncio. Optional, "
+                        "defaults to None")
+    parser.add_argument('--resample-fps', type=float, default=None,
+                        help="Rate at which the frames of all bodies are "
+                        "interpolated and sent to consumers that ask for "
+                        "resampled frames. Not supported with --asyncio. "
+                        "Optional, defaults to None (no resampling)")
+    parser.add_argument('--extrapolation', type=float, default=0.0,
+                        help="Time in seconds for which the resampled motion "
+                        "of a body is extrapolated when its next frame is "
+                        "late, before it is held. Optional, defaults to 0")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="If specified, the asyncio based server "
+                        "implementation is used (on uvloop, if installed).")
+    parser.add_argument('--write-buffer-high', type=int, default=64 * 1024,
+                        help="High water mark in bytes of the write buffer of "
+                        "each consumer, only used with --asyncio. Above it, "
+                        "only the newest frame of each body is kept. "
+                        "Optional, defaults to 65536")
     parser.add_argument('-v', '--verbosity', type=int, default=1,
                         help="Verbosity level. Optional, defaults to 1")
     args = parser.parse_args()
-    server = BodyPoseTcpServer(args.host, args.port, args.connections,
-                               not args.no_initial_transmissions)
-    server.start_server(args.verbosity)
-    
\ No newline at end of file
+    if args.workers > 1 and args.unix_socket is not None:
+        parser.error("--unix-socket can not be combined with --workers")
+    if args.asyncio and args.shm_ring is not None:
+        parser.error("--shm-ring can not be combined with --asyncio")
+    if args.asyncio and (args.metrics_port is not None
+                         or args.stats_socket is not None):
+        parser.error("--metrics-port and --stats-socket can not be combined "
+                     "with --asyncio")
+    if args.workers > 1 and args.stats_socket is not None:
+        parser.error("--stats-socket can not be combined with --workers")
+    if args.history_frames is None:
+        args.history_frames = 120
+    elif args.asyncio and args.history_frames > 0:
+        parser.error("--history-frames can not be combined with --asyncio")
+    if args.resample_fps is not None:
+        if args.asyncio:
+            parser.error("--resample-fps can not be combined with --asyncio")
+        if args.resample_fps <= 0:
+            parser.error(f"Invalid resample fps: {args.resample_fps}")
+    if args.extrapolation < 0:
+        parser.error(f"Invalid extrapolation window: {args.extrapolation}")
+    udp_targets = None
+    if args.udp_targets is not None:
+        if args.asyncio:
+            parser.error("--udp-targets can not be combined with --asyncio")
+        try:
+            udp_targets = [parse_address(x) for x in args.udp_targets]
+        except ValueError as e:
+            parser.error(str(e))
+    if args.asyncio:
+        from async_relay import AsyncBodyPoseTcpServer
+        server = AsyncBodyPoseTcpServer(args.host, args.port,
+                                        args.connections,
+                                        not args.no_initial_transmissions,
+                                        args.write_buffer_high,
+                                        unix_socket_path=args.unix_socket)
+        server.start_server(args.verbosity)
+    elif args.workers > 1:
+        start_sharded_server(args.workers, args.host, args.port,
+                             args.connections,
+                             not args.no_initial_transmissions,
+                             args.max_bodies, args.reuse_port, args.verbosity,
+                             max_queued_frames=args.max_queued_frames,
+                             send_buffer_size=args.send_buffer_size,
+                             shm_ring_name=args.shm_ring,
+                             shm_ring_slots=args.shm_ring_slots,
+                             udp_targets=udp_targets,
+                             udp_ttl=args.udp_ttl,
+                             keyframe_interval=args.keyframe_interval,
+                             history_frames=args.history_frames,
+                             metrics_port=args.metrics_port,
+                             metrics_host=args.metrics_host,
+                             resample_fps=args.resample_fps,
+                             resample_extrapolation=args.extrapolation)
+    else:
+        server = BodyPoseTcpServer(args.host, args.port, args.connections,
+                                   not args.no_initial_transmissions,
+                                   args.max_queued_frames,
+                                   unix_socket_path=args.unix_socket,
+                                   shm_ring_name=args.shm_ring,
+                                   shm_ring_slots=args.shm_ring_slots,
+                                   udp_targets=udp_targets,
+                                   udp_ttl=args.udp_ttl,
+                                   keyframe_interval=args.keyframe_interval,
+                                   history_frames=args.history_frames,
+                                   metrics_port=args.metrics_port,
+                                   metrics_host=args.metrics_host,
+                                   metrics_socket_path=args.stats_socket,
+                                   resample_fps=args.resample_fps,
+                                   resample_extrapolation=args.extrapolation,
+                                   send_buffer_size=args.send_buffer_size)
+        server.start_server(args.verbosity)
@@ -0,0 +1,161 @@
+import asyncio
+import socket
+import numpy as np
+import pytest
+from async_relay import AsyncBodyPoseTcpClient, AsyncBodyPoseTcpServer
+from frame_profile import FrameProfile
+from pose_protocol import (BODY_FRAME_SIZE, HISTORY_LAST, HISTORY_REQUEST,
+                           MESSAGE_HEADER, MSG_BATCH, MSG_REQUEST_HISTORY,
+                           MSG_SET_BATCHED, MSG_SET_FRAME_PROFILE,
+                           MSG_SET_RESAMPLED, MSG_SET_UDP_ONLY,
+                           MSG_SUBSCRIBE, MSG_UNSUBSCRIBE, POSE_FRAME_VALUES,
+                           encode_message, encode_stream_frames_header)
+from tcp_client import BodyPoseTcpClient
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_with_server(test, send_initial_transmissions=False):
+    """Runs the coroutine function test with the port of a running
+    AsyncBodyPoseTcpServer"""
+    port = free_port()
+    server = AsyncBodyPoseTcpServer('127.0.0.1', port, 8,
+                                    send_initial_transmissions)
+
+    async def main():
+        task = asyncio.create_task(server.serve(0))
+        try:
+            await asyncio.sleep(0)
+            await asyncio.wait_for(test(port), 5.0)
+        finally:
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(main())
+    return server
+
+
+async def connect(port):
+    # the server task may not be listening yet
+    for _ in range(100):
+        try:
+            return await asyncio.open_connection('127.0.0.1', port)
+        except ConnectionRefusedError:
+            await asyncio.sleep(0.01)
+    return await asyncio.open_connection('127.0.0.1', port)
+
+
+async def read_message(reader):
+    _, msg_type, length = MESSAGE_HEADER.unpack(
+        await reader.readexactly(MESSAGE_HEADER.size)
+    )
+    return msg_type, await reader.readexactly(length)
+
+
+def make_frame(value):
+    return np.full(POSE_FRAME_VALUES, value, dtype=np.float32).tobytes()
+
+
+def test_forwards_frames():
+    async def test(port):
+        consumer_reader, _ = await connect(port)
+        producer_reader, producer = await connect(port)
+        # the consumer is registered before the producer sends
+        await asyncio.sleep(0.05)
+        producer.write(make_frame(1.0) + make_frame(2.0))
+        assert await consumer_reader.readexactly(2 * BODY_FRAME_SIZE) == \
+            (1).to_bytes(4, 'big') + make_frame(1.0) \
+            + (1).to_bytes(4, 'big') + make_frame(2.0)
+        producer.close()
+
+    run_with_server(test)
+
+
+def test_initial_transmissions():
+    async def test(port):
+        _, producer = await connect(port)
+        producer.write(make_frame(3.0) + make_frame(4.0))
+        await asyncio.sleep(0.05)
+        consumer_reader, _ = await connect(port)
+        assert await consumer_reader.readexactly(BODY_FRAME_SIZE) == \
+            (1).to_bytes(4, 'big') + make_frame(3.0)
+        producer.close()
+
+    run_with_server(test, send_initial_transmissions=True)
+
+
+def test_batched_consumer():
+    async def test(port):
+        consumer_reader, consumer = await connect(port)
+        consumer.write(encode_message(MSG_SET_BATCHED))
+        producers = [(await connect(port))[1] for _ in range(2)]
+        await asyncio.sleep(0.05)
+        producers[0].write(make_frame(1.0))
+        producers[1].write(make_frame(2.0))
+        body_frames = set()
+        while len(body_frames) < 2:
+            msg_type, payload = await read_message(consumer_reader)
+            assert msg_type == MSG_BATCH
+            num_records = int.from_bytes(payload[:4], 'big')
+            for i in range(num_records):
+                body_frames.add(payload[4 + i * BODY_FRAME_SIZE:
+                                        4 + (i + 1) * BODY_FRAME_SIZE])
+        assert body_frames == {(1).to_bytes(4, 'big') + make_frame(1.0),
+                               (2).to_bytes(4, 'big') + make_frame(2.0)}
+
+    run_with_server(test)
+
+
+def test_rejects_frame_profile():
+    async def test(port):
+        reader, writer = await connect(port)
+        writer.write(encode_message(MSG_SET_FRAME_PROFILE,
+                                    FrameProfile(angle=90).encode()))
+        assert await read_message(reader) == (MSG_SET_FRAME_PROFILE, b'')
+
+    run_with_server(test)
+
+
+@pytest.mark.parametrize('message', [
+    encode_message(MSG_SET_UDP_ONLY),
+    encode_message(MSG_SUBSCRIBE, (1).to_bytes(4, 'big')),
+    encode_message(MSG_UNSUBSCRIBE, (1).to_bytes(4, 'big')),
+    encode_message(MSG_REQUEST_HISTORY,
+                   HISTORY_REQUEST.pack(0, HISTORY_LAST, 10)),
+    encode_message(MSG_SET_RESAMPLED),
+    encode_stream_frames_header(1) + bytes(4) + make_frame(1.0),
+], ids=['udp', 'subscribe', 'unsubscribe', 'history', 'resampled',
+        'streams'])
+def test_closes_connection_on_unsupported_requests(message):
+    async def test(port):
+        reader, writer = await connect(port)
+        writer.write(message)
+        assert await reader.read() == b''
+
+    run_with_server(test)
+
+
+def test_async_client_producer():
+    frames = np.arange(3 * POSE_FRAME_VALUES, dtype=np.float32) \
+        .reshape(3, POSE_FRAME_VALUES)
+    client = BodyPoseTcpClient('127.0.0.1', 0, False, None, None, True, 0,
+                               False, target_fps=200, loop=False,
+                               verbosity=0, framed=True)
+    client.pose_frames = frames
+
+    async def test(port):
+        consumer_reader, _ = await connect(port)
+        await asyncio.sleep(0.05)
+        client.port = port
+        await AsyncBodyPoseTcpClient(client).run_async()
+        received = await consumer_reader.readexactly(3 * BODY_FRAME_SIZE)
+        assert received == np.hstack((
+            np.ones((3, 1), dtype='>u4').view(np.float32), frames
+        )).tobytes()
+
+    run_with_server(test)
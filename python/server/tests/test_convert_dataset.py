@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import pytest
+from convert_dataset import convert_directory, convert_file, find_npz_files
+from pose_dataset import open_packed, transform_frames
+
+CONVERT_ARGS = {'pose_attribute': 'poses', 'transl_attribute': 'trans',
+                'capture_fps_attribute': 'mocap_frame_rate', 'angle': -90,
+                'keep_yz_axes': False}
+
+
+def write_sequence(fpath, num_frames, capture_fps=120):
+    rng = np.random.default_rng(num_frames)
+    content = {'poses': rng.standard_normal((num_frames, 165)),
+               'trans': rng.standard_normal((num_frames, 3))}
+    if capture_fps is not None:
+        content['mocap_frame_rate'] = np.array(capture_fps)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    np.savez(fpath, **content)
+    return content
+
+
+def test_convert_file(tmp_path):
+    content = write_sequence(str(tmp_path / 'a.npz'), 12)
+    output_file = str(tmp_path / 'out' / 'a.pose')
+    assert convert_file(str(tmp_path / 'a.npz'), output_file, **CONVERT_ARGS,
+                        target_fps=30) == (3, 30)
+    frames, capture_fps = open_packed(output_file)
+    assert capture_fps == 30
+    # every fourth frame, transformed like BodyPoseTcpClient does
+    np.testing.assert_array_equal(frames, transform_frames(
+        content['poses'][::4], content['trans'][::4], -90, False
+    ))
+
+
+def test_convert_file_keeps_capture_fps(tmp_path):
+    write_sequence(str(tmp_path / 'a.npz'), 5)
+    assert convert_file(str(tmp_path / 'a.npz'), str(tmp_path / 'a.pose'),
+                        **CONVERT_ARGS) == (5, 120)
+
+
+def test_convert_file_errors(tmp_path):
+    write_sequence(str(tmp_path / 'no_fps.npz'), 5, capture_fps=None)
+    with pytest.raises(ValueError, match="Unknown capture fps"):
+        convert_file(str(tmp_path / 'no_fps.npz'), str(tmp_path / 'a.pose'),
+                     **CONVERT_ARGS, target_fps=30)
+    np.savez(str(tmp_path / 'no_poses.npz'), other=np.zeros(3))
+    with pytest.raises(ValueError, match="No 'poses'"):
+        convert_file(str(tmp_path / 'no_poses.npz'),
+                     str(tmp_path / 'b.pose'), **CONVERT_ARGS)
+
+
+def test_convert_directory(tmp_path):
+    input_dir = str(tmp_path / 'input')
+    output_dir = str(tmp_path / 'output')
+    write_sequence(os.path.join(input_dir, 'a.npz'), 4)
+    write_sequence(os.path.join(input_dir, 'subject', 'b.npz'), 6)
+    # truncated download
+    with open(os.path.join(input_dir, 'subject', 'broken.npz'), 'wb') as file:
+        file.write(b'PK\x03\x04')
+    assert find_npz_files(input_dir) == [
+        'a.npz', os.path.join('subject', 'b.npz'),
+        os.path.join('subject', 'broken.npz')
+    ]
+    assert convert_directory(input_dir, output_dir, workers=1, verbosity=0,
+                             **CONVERT_ARGS) == 1
+    assert len(open_packed(os.path.join(output_dir, 'a.pose'))[0]) == 4
+    assert len(open_packed(os.path.join(output_dir, 'subject',
+                                        'b.pose'))[0]) == 6
+    # converted files are skipped unless their npz file changed
+    output_file = os.path.join(output_dir, 'a.pose')
+    os.utime(output_file, (0, os.path.getmtime(output_file) + 10))
+    mtime = os.path.getmtime(output_file)
+    os.remove(os.path.join(input_dir, 'subject', 'broken.npz'))
+    assert convert_directory(input_dir, output_dir, workers=1, verbosity=0,
+                             **CONVERT_ARGS) == 0
+    assert os.path.getmtime(output_file) == mtime
+    convert_directory(input_dir, output_dir, workers=1, overwrite=True,
+                      verbosity=0, **CONVERT_ARGS)
+    assert os.path.getmtime(output_file) != mtime
@@ -0,0 +1,125 @@
+import socket
+import time
+import numpy as np
+import pytest
+from crowd_producer import STREAM_TIMEOUT, CrowdProducer, load_sequences
+from pose_dataset import write_packed
+from pose_protocol import BODY_FRAME_DTYPE, POSE_FRAME_VALUES
+from tcp_server import BodyPoseTcpServer
+
+
+def make_sequence(num_frames, first_value=0):
+    """Returns frames whose values are their index plus first_value"""
+    return np.repeat(
+        np.arange(first_value, first_value + num_frames, dtype=np.float32),
+        POSE_FRAME_VALUES
+    ).reshape(num_frames, POSE_FRAME_VALUES)
+
+
+@pytest.fixture
+def server():
+    lsock = socket.create_server(('127.0.0.1', 0))
+    server = BodyPoseTcpServer('127.0.0.1', 0, 8, False,
+                               listening_socket=lsock)
+    yield server
+    for sock in list(server.clients):
+        sock.close()
+    server.sel.close()
+    lsock.close()
+
+
+def service(server):
+    for key, mask in server.sel.select(timeout=1.0):
+        if key.fileobj in server.clients:
+            server._service_connection(key, mask, 0)
+
+
+def connect(server, producer):
+    producer.port = server.lsock.getsockname()[1]
+    producer.connect()
+    for _ in range(producer.num_connections):
+        server._accept_wrapper(server.lsock, 0)
+    producer.time_start = 0.0
+
+
+def receive(consumer, num_frames):
+    return np.frombuffer(
+        consumer.recv(num_frames * BODY_FRAME_DTYPE.itemsize,
+                      socket.MSG_WAITALL),
+        dtype=BODY_FRAME_DTYPE
+    )
+
+
+def test_invalid_streams():
+    with pytest.raises(ValueError):
+        CrowdProducer([])
+    with pytest.raises(ValueError):
+        CrowdProducer([(make_sequence(2), 0, 0)])
+    with pytest.raises(ValueError):
+        CrowdProducer([(make_sequence(0), 30, 0)])
+    with pytest.raises(ValueError):
+        CrowdProducer([(make_sequence(2), 30, 0)], num_connections=2)
+
+
+def test_load_sequences_shares_frames(tmp_path):
+    fpath = str(tmp_path / 'a.pose')
+    write_packed(fpath, make_sequence(3), capture_fps=60)
+    sequences = load_sequences([fpath, fpath], verbosity=0)
+    assert list(sequences) == [fpath]
+    frames, capture_fps = sequences[fpath]
+    assert capture_fps == 60
+    np.testing.assert_array_equal(frames, make_sequence(3))
+    with pytest.raises(ValueError):
+        load_sequences([str(tmp_path / 'missing.npz')], cache_dir=None,
+                       verbosity=0)
+
+
+def wait_for_confirmations(producer):
+    for _ in range(100):
+        if producer.body_ids.all():
+            return
+        producer._wait(time.perf_counter() + 0.01)
+
+
+def test_streams_through_server(server):
+    consumer = socket.create_connection(server.lsock.getsockname())
+    consumer.settimeout(1.0)
+    server._accept_wrapper(server.lsock, 0)
+    sequence = make_sequence(10)
+    producer = CrowdProducer([(sequence, 10, 0), (sequence, 20, 0.1),
+                              (make_sequence(3, 100), 10, 0)],
+                             num_connections=2, loop=False, verbosity=0)
+    connect(server, producer)
+    try:
+        producer._tick(0.0)
+        service(server)
+        # stream 1 starts 2 frames into its sequence
+        assert sorted(receive(consumer, 3)['pose'][:, 0]) == [0, 2, 100]
+        wait_for_confirmations(producer)
+        assert sorted(producer.body_ids.tolist()) == [1, 2, 3]
+        producer._check_streams(STREAM_TIMEOUT + 1.0)
+        # streams that fell behind skip to their newest frame, stream 2
+        # reached the end of its sequence and its body is released
+        producer._tick(0.32)
+        service(server)
+        assert sorted(receive(consumer, 2)['pose'][:, 0]) == [3, 8]
+        assert producer.frames_skipped == 2 + 5 + 2
+        assert producer.active.tolist() == [True, True, False]
+        assert sorted(server.first_transmissions) == \
+            sorted(producer.body_ids[:2].tolist())
+    finally:
+        producer.close()
+        consumer.close()
+
+
+def test_unconfirmed_streams(server):
+    producer = CrowdProducer([(make_sequence(2), 30, 0)], verbosity=0)
+    connect(server, producer)
+    try:
+        producer._tick(0.0)
+        # the server did not handle the frames yet
+        producer._check_streams(STREAM_TIMEOUT / 2)
+        with pytest.raises(RuntimeError):
+            producer._check_streams(STREAM_TIMEOUT)
+    finally:
+        producer.close()
@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+import frame_pacer
+from frame_pacer import FramePacer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+
+    def perf_counter(self):
+        return self.now
+
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(frame_pacer.time, 'perf_counter', clock.perf_counter)
+    monkeypatch.setattr(frame_pacer.time, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.mark.parametrize('fps', [None, 0, -30])
+def test_invalid_fps(fps):
+    with pytest.raises(ValueError):
+        FramePacer(fps)
+
+
+def test_deadlines_do_not_drift(clock):
+    pacer = FramePacer(10, spin_time=0)
+    times = []
+    for _ in range(5):
+        assert pacer.wait() == 1
+        times.append(clock.now)
+        # time spent sending does not delay the following deadlines
+        clock.now += 0.03
+    assert times == pytest.approx([100.0, 100.1, 100.2, 100.3, 100.4])
+    assert pacer.stats()['max_ms'] == pytest.approx(0.0)
+
+
+def test_late_frames_are_caught_up(clock):
+    pacer = FramePacer(10, spin_time=0)
+    pacer.wait()
+    clock.now += 0.35
+    # the frames of 100.1, 100.2 and 100.3 are sent back to back
+    assert [pacer.wait() for _ in range(4)] == [1, 1, 1, 1]
+    assert clock.now == pytest.approx(100.4)
+    assert pacer.frames_skipped == 0
+    assert pacer.stats()['max_ms'] == pytest.approx(250.0)
+
+
+def test_late_frames_are_dropped(clock):
+    pacer = FramePacer(10, drop_frames=True, spin_time=0)
+    pacer.wait()
+    clock.now += 0.35
+    # the frames of 100.1 and 100.2 are skipped
+    assert pacer.wait() == 3
+    assert pacer.wait() == 1
+    assert clock.now == pytest.approx(100.4)
+    assert pacer.frames_skipped == 2
+
+
+def test_schedule_restarts_after_long_stall(clock):
+    pacer = FramePacer(10, spin_time=0, max_catch_up=0.25)
+    pacer.wait()
+    clock.now += 2.0
+    assert pacer.wait() == 1
+    assert clock.now == pytest.approx(102.0)
+    pacer.wait()
+    assert clock.now == pytest.approx(102.1)
+    assert pacer.resyncs == 1
+
+
+def test_wait_async(clock, monkeypatch):
+    async def sleep(seconds):
+        clock.sleep(seconds)
+
+    monkeypatch.setattr(frame_pacer.asyncio, 'sleep', sleep)
+    pacer = FramePacer(20)
+
+    async def main():
+        for _ in range(3):
+            await pacer.wait_async()
+
+    asyncio.run(main())
+    assert clock.now == pytest.approx(100.1)
+    assert pacer.stats()['frames'] == 3
+
+
+def test_stats_without_frames():
+    stats = FramePacer(30).stats()
+    assert stats['frames'] == 0
+    assert stats['p99_ms'] == 0.0
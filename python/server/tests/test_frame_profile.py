@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from frame_profile import FrameProfile
+from pose_protocol import POSE_FRAME_VALUES
+
+
+def test_encode_decode_round_trip():
+    profile = FrameProfile(angle=-90.1, swap_yz=True, offset=(0.1, 0.2, 0.3))
+    decoded = FrameProfile.decode(profile.encode())
+    assert decoded == profile
+    assert hash(decoded) == hash(profile)
+    assert not decoded.is_identity
+    assert FrameProfile().is_identity
+
+
+def test_decode_rejects_wrong_size():
+    with pytest.raises(ValueError):
+        FrameProfile.decode(bytes(3))
+
+
+def test_invalid_values():
+    with pytest.raises(ValueError):
+        FrameProfile(angle=float('nan'))
+    with pytest.raises(ValueError):
+        FrameProfile(offset=(0.0, 0.0))
+
+
+def test_apply():
+    frames = np.zeros((2, POSE_FRAME_VALUES), dtype=np.float32)
+    frames[:, :3] = [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]
+    frames[:, 6:9] = 0.25
+    converted = FrameProfile(angle=90, swap_yz=True,
+                             offset=(10.0, 0.0, 0.0)).apply(frames)
+    assert converted.dtype == np.float32
+    np.testing.assert_allclose(converted[:, :3],
+                               [[11.0, 3.0, 2.0], [14.0, 6.0, 5.0]])
+    # a global orientation of zero rotated around the x-axis
+    np.testing.assert_allclose(converted[:, 3:6],
+                               [[np.pi / 2, 0.0, 0.0]] * 2, atol=1e-6)
+    # the other joints are relative to their parents and stay the same
+    np.testing.assert_array_equal(converted[:, 6:], frames[:, 6:])
+
+
+def test_apply_body_frames_keeps_body_ids():
+    frame = np.arange(POSE_FRAME_VALUES, dtype=np.float32)
+    body_frames = (7).to_bytes(4, 'big') + frame.tobytes()
+    converted = FrameProfile(offset=(1.0, 1.0, 1.0)) \
+        .apply_body_frames(body_frames)
+    assert converted[:4] == body_frames[:4]
+    values = np.frombuffer(converted[4:], dtype=np.float32)
+    np.testing.assert_array_equal(values[:3], frame[:3] + 1)
+    np.testing.assert_array_equal(values[3:], frame[3:])
+    assert FrameProfile(offset=(1.0, 1.0, 1.0)).apply_frame(frame.tobytes()) \
+        == converted[4:]
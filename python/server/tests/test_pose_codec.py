@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from pose_codec import (ENCODING_DELTA, ENCODING_FLOAT16, ENCODING_QUANTIZED,
+                        ENCODING_RAW, FORMAT_SIZES, PoseDecoder, PoseEncoder,
+                        decode_frames, encode_frames)
+from pose_protocol import POSE_FRAME_VALUES
+
+
+def random_frames(num_frames, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-2.0, 2.0, (num_frames, POSE_FRAME_VALUES)) \
+        .astype(np.float32)
+
+
+@pytest.mark.parametrize('encoding, tolerance', [
+    (ENCODING_RAW, 0.0),
+    (ENCODING_FLOAT16, 2 ** -10),
+    (ENCODING_QUANTIZED, 2 ** -13),
+])
+def test_stateless_round_trip(encoding, tolerance):
+    frames = random_frames(4)
+    encoder = PoseEncoder(encoding)
+    decoder = PoseDecoder()
+    for frame in frames:
+        data = encoder.encode(1, frame)
+        assert data[0] == encoding
+        assert len(data) == 1 + FORMAT_SIZES[encoding]
+        np.testing.assert_allclose(decoder.decode(1, data), frame,
+                                   rtol=0, atol=tolerance)
+
+
+def test_quantized_keeps_translation():
+    frames = random_frames(2) * 100
+    decoded = decode_frames(encode_frames(frames, ENCODING_QUANTIZED),
+                            ENCODING_QUANTIZED)
+    np.testing.assert_array_equal(decoded[:, :3], frames[:, :3])
+
+
+def test_delta_round_trip():
+    frames = np.cumsum(random_frames(20) * 0.01, axis=0, dtype=np.float32)
+    encoder = PoseEncoder(ENCODING_DELTA, keyframe_interval=8)
+    decoder = PoseDecoder()
+    formats = []
+    for frame in frames:
+        data = encoder.encode(5, frame)
+        formats.append(data[0])
+        # the error does not accumulate from frame to frame
+        np.testing.assert_allclose(decoder.decode(5, data), frame,
+                                   rtol=0, atol=2 ** -10)
+    assert formats == [ENCODING_RAW if i % 8 == 0 else ENCODING_DELTA
+                       for i in range(20)]
+
+
+def test_delta_sends_keyframe_for_large_change():
+    frame = random_frames(1)[0]
+    encoder = PoseEncoder(ENCODING_DELTA)
+    decoder = PoseDecoder()
+    decoder.decode(1, encoder.encode(1, frame))
+    jumped = frame.copy()
+    jumped[10] += 1.0
+    data = encoder.encode(1, jumped)
+    assert data[0] == ENCODING_RAW
+    np.testing.assert_array_equal(decoder.decode(1, data), jumped)
+
+
+def test_delta_without_keyframe():
+    encoder = PoseEncoder(ENCODING_DELTA)
+    frame = random_frames(1)[0]
+    encoder.encode(1, frame)
+    data = encoder.encode(1, frame)
+    assert data[0] == ENCODING_DELTA
+    with pytest.raises(ValueError, match="without keyframe"):
+        PoseDecoder().decode(1, data)
+
+
+@pytest.mark.parametrize('data', [b'', b'\x09' + bytes(10), b'\x01' + bytes(10)])
+def test_decode_rejects_malformed_frames(data):
+    with pytest.raises(ValueError):
+        PoseDecoder().decode(1, data)
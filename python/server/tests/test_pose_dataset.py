@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from pose_dataset import (PACKED_HEADER, PACKED_HEADER_SIZE, open_packed,
+                          read_packed_header, write_packed)
+from pose_protocol import POSE_FRAME_VALUES
+
+
+def test_packed_round_trip(tmp_path):
+    fpath = str(tmp_path / 'sequence.pose')
+    frames = np.random.default_rng(0).standard_normal(
+        (5, POSE_FRAME_VALUES)).astype(np.float32)
+    write_packed(fpath, frames, capture_fps=30.0)
+    with open(fpath, 'rb') as file:
+        assert read_packed_header(file) == (30.0, 5)
+    packed, capture_fps = open_packed(fpath)
+    assert capture_fps == 30.0
+    assert packed.shape == (5, POSE_FRAME_VALUES)
+    np.testing.assert_array_equal(packed, frames)
+    assert not packed.flags.writeable
+
+
+def test_packed_unknown_fps_and_no_frames(tmp_path):
+    fpath = str(tmp_path / 'empty.pose')
+    write_packed(fpath, np.empty((0, POSE_FRAME_VALUES)))
+    packed, capture_fps = open_packed(fpath)
+    assert capture_fps is None
+    assert packed.shape == (0, POSE_FRAME_VALUES)
+
+
+@pytest.mark.parametrize('header, match', [
+    (b'POSEPACK', "Truncated"),
+    (PACKED_HEADER.pack(b'NOTAPOSE', 1, 30.0, 0), "Not a packed"),
+    (PACKED_HEADER.pack(b'POSEPACK', 2, 30.0, 0), "Unsupported version"),
+])
+def test_invalid_header(tmp_path, header, match):
+    fpath = tmp_path / 'invalid.pose'
+    if len(header) == PACKED_HEADER.size:
+        header = header.ljust(PACKED_HEADER_SIZE, b'\0')
+    fpath.write_bytes(header)
+    with pytest.raises(ValueError, match=match):
+        open_packed(str(fpath))
+
+
+def test_truncated_frames(tmp_path):
+    fpath = tmp_path / 'truncated.pose'
+    write_packed(str(fpath), np.zeros((3, POSE_FRAME_VALUES)))
+    fpath.write_bytes(fpath.read_bytes()[:-4])
+    with pytest.raises(ValueError, match="expected 3 frames"):
+        open_packed(str(fpath))
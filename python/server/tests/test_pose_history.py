@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from pose_history import PoseHistory
+from pose_protocol import BODY_FRAME_SIZE, POSE_FRAME_SIZE
+
+
+def append_frames(history, body_id, num_frames):
+    body_id_bytes = body_id.to_bytes(4, 'big')
+    for i in range(num_frames):
+        history.append(body_id, body_id_bytes, bytes((i,)) * POSE_FRAME_SIZE,
+                       float(i))
+
+
+def frame_values(frames):
+    """Returns the first pose byte of each body frame"""
+    return list(np.concatenate(frames).reshape(-1, BODY_FRAME_SIZE)[:, 4])
+
+
+def times(time_slices):
+    return list(np.concatenate(time_slices).view('>f8'))
+
+
+def test_last_frames_wrap_around():
+    history = PoseHistory(3)
+    append_frames(history, 7, 5)
+    first_seq, num_frames, time_slices, frames = history.last(7, 10)
+    assert (first_seq, num_frames) == (2, 3)
+    # the ring wrapped, the frames come in two slices
+    assert len(frames) == 2
+    assert frame_values(frames) == [2, 3, 4]
+    assert times(time_slices) == [2.0, 3.0, 4.0]
+    assert bytes(frames[0][:4]) == (7).to_bytes(4, 'big')
+
+
+def test_frames_since():
+    history = PoseHistory(4)
+    append_frames(history, 1, 6)
+    first_seq, num_frames, _, frames = history.frames_since(1, 4)
+    assert (first_seq, num_frames) == (4, 2)
+    assert frame_values(frames) == [4, 5]
+    # overwritten frames are left out
+    assert history.frames_since(1, 0)[:2] == (2, 4)
+    # nothing new
+    assert history.frames_since(1, 6) == (6, 0, [], [])
+
+
+def test_unknown_and_forgotten_bodies():
+    history = PoseHistory(2)
+    assert history.last(3, 1) == (0, 0, [], [])
+    append_frames(history, 3, 1)
+    assert history.body_ids() == [3]
+    history.forget(3)
+    assert history.body_ids() == []
+    assert history.frames_since(3, 0) == (0, 0, [], [])
+
+
+def test_invalid_capacity():
+    with pytest.raises(ValueError):
+        PoseHistory(0)
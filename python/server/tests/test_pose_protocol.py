@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+from pose_protocol import (BODY_FRAME_DTYPE, BODY_FRAME_SIZE, COUNT,
+                           MAX_MESSAGE_SIZE, MESSAGE_HEADER, MESSAGE_MARKER,
+                           MSG_ENCODED_FRAME, MSG_FRAME, MSG_SET_BATCHED,
+                           MSG_SET_ENCODING, MSG_SET_FRAMED, MSG_SUBSCRIBE,
+                           POSE_FRAME_SIZE, FrameReassembler,
+                           check_client_message, encode_message)
+
+
+def feed(frames, data, chunk_size=None):
+    """Passes data to a FrameReassembler as if it was received in chunks of
+    chunk_size bytes and returns the completed messages as bytes"""
+    messages = []
+    offset = 0
+    while offset < len(data):
+        buffer = frames.get_buffer()
+        size = len(buffer)
+        if chunk_size is not None:
+            size = min(size, chunk_size)
+        chunk = data[offset:offset + size]
+        buffer[:len(chunk)] = chunk
+        messages += [(msg_type, bytes(payload)) for msg_type, payload
+                     in frames.buffer_updated(len(chunk))]
+        offset += len(chunk)
+    return messages
+
+
+def make_frame(value):
+    return np.full(POSE_FRAME_SIZE // 4, value, dtype=np.float32).tobytes()
+
+
+def test_split_reads():
+    frame = make_frame(1.5)
+    frames = FrameReassembler(POSE_FRAME_SIZE)
+    assert feed(frames, frame[:100]) == []
+    assert feed(frames, frame[100:]) == [(MSG_FRAME, frame)]
+
+
+def test_split_reads_byte_by_byte():
+    frame = make_frame(2.0)
+    message = encode_message(MSG_SET_BATCHED)
+    frames = FrameReassembler(POSE_FRAME_SIZE)
+    assert feed(frames, frame + message + frame, chunk_size=1) == [
+        (MSG_FRAME, frame), (MSG_SET_BATCHED, b''), (MSG_FRAME, frame)
+    ]
+
+
+def test_coalesced_reads():
+    data = [make_frame(i) for i in range(3)]
+    message = encode_message(MSG_SET_ENCODING, COUNT.pack(1))
+    frames = FrameReassembler(POSE_FRAME_SIZE)
+    assert feed(frames, data[0] + message + data[1] + data[2]) == [
+        (MSG_FRAME, data[0]), (MSG_SET_ENCODING, COUNT.pack(1)),
+        (MSG_FRAME, data[1]), (MSG_FRAME, data[2])
+    ]
+
+
+def test_message_larger_than_buffer():
+    payload = bytes(range(256)) * 40
+    frames = FrameReassembler(POSE_FRAME_SIZE, max_frames=2)
+    assert feed(frames, encode_message(MSG_SUBSCRIBE, payload)) \
+        == [(MSG_SUBSCRIBE, payload)]
+
+
+def test_frame_dtype_reports_runs_of_frames():
+    body_frames = np.zeros(3, dtype=BODY_FRAME_DTYPE)
+    body_frames['body_id'] = [1, 2, 3]
+    message = encode_message(MSG_SET_BATCHED)
+    frames = FrameReassembler(BODY_FRAME_SIZE, frame_dtype=BODY_FRAME_DTYPE)
+    buffer = frames.get_buffer()
+    data = body_frames[:2].tobytes() + message + body_frames[2:].tobytes()
+    buffer[:len(data)] = data
+    messages = frames.buffer_updated(len(data))
+    assert [msg_type for msg_type, _ in messages] \
+        == [MSG_FRAME, MSG_SET_BATCHED, MSG_FRAME]
+    assert list(messages[0][1]['body_id']) == [1, 2]
+    assert list(messages[2][1]['body_id']) == [3]
+
+
+def test_oversized_message():
+    header = MESSAGE_HEADER.pack(MESSAGE_MARKER, MSG_SUBSCRIBE,
+                                 MAX_MESSAGE_SIZE + 1)
+    frames = FrameReassembler(POSE_FRAME_SIZE)
+    with pytest.raises(ValueError, match="exceeds"):
+        feed(frames, header)
+
+
+def test_marker_colliding_frame_is_rejected():
+    # a plain frame that starts with the marker reads as a message header,
+    # here one of type MSG_FRAME
+    frame = MESSAGE_MARKER + bytes(POSE_FRAME_SIZE - len(MESSAGE_MARKER))
+    frames = FrameReassembler(POSE_FRAME_SIZE)
+    with pytest.raises(ValueError, match="MSG_FRAME"):
+        feed(frames, frame)
+
+
+def test_marker_colliding_frame_on_framed_connection():
+    frame = MESSAGE_MARKER + bytes(POSE_FRAME_SIZE - len(MESSAGE_MARKER))
+    encoded = bytes(4) + bytes((0,)) + frame
+    frames = FrameReassembler(POSE_FRAME_SIZE)
+    assert feed(frames, encode_message(MSG_SET_FRAMED)
+                + encode_message(MSG_ENCODED_FRAME, encoded)) \
+        == [(MSG_SET_FRAMED, b''), (MSG_ENCODED_FRAME, encoded)]
+    assert frames.framed
+
+
+def test_framed_connection_rejects_plain_frames():
+    frames = FrameReassembler(POSE_FRAME_SIZE)
+    # in the same read as the message that sets framed mode
+    with pytest.raises(ValueError, match="framed"):
+        feed(frames, encode_message(MSG_SET_FRAMED) + make_frame(1.0))
+
+
+@pytest.mark.parametrize('msg_type, payload', [
+    (MSG_SET_BATCHED, b'\0'),
+    (MSG_SET_ENCODING, b'\0\0'),
+    (MSG_SUBSCRIBE, b'\0\0\0'),
+    (MSG_ENCODED_FRAME, b'\0\0\0\0'),
+])
+def test_check_client_message_rejects(msg_type, payload):
+    with pytest.raises(ValueError):
+        check_client_message(msg_type, payload)
+
+
+@pytest.mark.parametrize('msg_type, payload', [
+    (MSG_SET_BATCHED, b''),
+    (MSG_SET_ENCODING, COUNT.pack(2)),
+    (MSG_SUBSCRIBE, COUNT.pack(1) + COUNT.pack(2)),
+    (MSG_ENCODED_FRAME, bytes(5)),
+])
+def test_check_client_message_accepts(msg_type, payload):
+    check_client_message(msg_type, payload)
@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pytest
+from pose_protocol import POSE_FRAME_VALUES
+from pose_recorder import (RECORD_DTYPE, PoseRecorder,
+                           create_unique_directory, export_npz,
+                           load_recording)
+
+
+def make_frame(value):
+    return np.full(POSE_FRAME_VALUES, value, dtype=np.float32).tobytes()
+
+
+def test_chunks_and_trimming(tmp_path):
+    directory = str(tmp_path / 'recording')
+    recorder = PoseRecorder(directory, chunk_frames=4)
+    for i in range(6):
+        recorder.append(1, make_frame(i), time_received=1000.0 + i)
+    recorder.append(2, make_frame(-1), time_received=1000.5)
+    recorder.close()
+    assert sorted(os.listdir(tmp_path / 'recording' / '0000')) == \
+        ['1_000000.npy', '1_000001.npy', '2_000000.npy']
+    # the last chunk of every body only holds the written rows
+    assert len(np.load(tmp_path / 'recording' / '0000' / '1_000001.npy')) == 2
+    recording = load_recording(directory)
+    assert recording[1]['time'].tolist() == [1000.0 + i for i in range(6)]
+    assert recording[1]['pose'][:, 0].tolist() == list(range(6))
+    assert recording[1]['transl'][:, 0].tolist() == list(range(6))
+    assert len(recording[2]) == 1
+
+
+def test_interrupted_recording_is_readable(tmp_path):
+    directory = str(tmp_path / 'recording')
+    recorder = PoseRecorder(directory, chunk_frames=8)
+    for i in range(3):
+        recorder.append(1, make_frame(i), time_received=1000.0 + i)
+    # a crash leaves the preallocated chunk without trimming it
+    recorder.flush()
+    rows = np.load(tmp_path / 'recording' / '0000' / '1_000000.npy')
+    assert rows.dtype == RECORD_DTYPE and len(rows) == 8
+    assert len(load_recording(directory)[1]) == 3
+    recorder.close()
+
+
+def test_rotation_by_size(tmp_path):
+    directory = str(tmp_path / 'recording')
+    recorder = PoseRecorder(directory, chunk_frames=16,
+                            rotate_bytes=2 * RECORD_DTYPE.itemsize)
+    for i in range(5):
+        recorder.append(1, make_frame(i), time_received=1000.0 + i)
+    recorder.close()
+    assert sorted(os.listdir(directory)) == ['0000', '0001', '0002']
+    assert load_recording(directory, segments=[1])[1]['pose'][:, 0] \
+        .tolist() == [2, 3]
+    assert len(load_recording(directory)[1]) == 5
+
+
+def test_rejects_invalid_input(tmp_path):
+    with pytest.raises(ValueError):
+        PoseRecorder(str(tmp_path / 'a'), chunk_frames=0)
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'file').touch()
+    with pytest.raises(ValueError):
+        PoseRecorder(str(tmp_path / 'b'))
+    recorder = PoseRecorder(str(tmp_path / 'c'))
+    with pytest.raises(ValueError):
+        recorder.append(1, make_frame(0)[:-4])
+    recorder.close()
+
+
+def test_export_npz(tmp_path):
+    directory = str(tmp_path / 'recording')
+    recorder = PoseRecorder(directory, chunk_frames=4)
+    for i in range(11):
+        recorder.append(3, make_frame(i), time_received=1000.0 + i / 10)
+    recorder.close()
+    fpath = str(tmp_path / 'recording.npz')
+    export_npz(directory, fpath, include_times=True)
+    with np.load(fpath) as npz:
+        assert sorted(npz.files) == ['3_frame_rate', '3_poses', '3_times',
+                                     '3_transl']
+        assert npz['3_poses'].shape == (11, POSE_FRAME_VALUES - 3)
+        assert npz['3_transl'][:, 0].tolist() == list(range(11))
+        assert int(npz['3_frame_rate']) == 11
+
+
+def test_create_unique_directory(tmp_path):
+    parent = str(tmp_path / 'recordings')
+    paths = [create_unique_directory(parent, 'run') for _ in range(3)]
+    assert [os.path.basename(path) for path in paths] == \
+        ['run', 'run_1', 'run_2']
+    assert all(os.path.isdir(path) for path in paths)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from pose_protocol import POSE_FRAME_VALUES
+from pose_resampler import PoseResampler
+
+
+def make_frame(transl, rotation):
+    """Returns a frame whose first joint is rotated by rotation radians
+    around the x-axis"""
+    values = np.zeros(POSE_FRAME_VALUES, dtype=np.float32)
+    values[:3] = transl
+    values[3] = rotation
+    return values.tobytes()
+
+
+def test_interpolates_between_last_two_frames():
+    resampler = PoseResampler()
+    resampler.add_frame(4, make_frame((0.0, 0.0, 0.0), 0.0), 10.0)
+    resampler.add_frame(4, make_frame((1.0, 2.0, 3.0), 0.4), 10.1)
+    # one interval behind the newest frame
+    body_ids, frames = resampler.resample(10.15)
+    assert body_ids == [4]
+    assert frames.shape == (1, POSE_FRAME_VALUES)
+    assert frames.dtype == np.float32
+    np.testing.assert_allclose(frames[0, :3], (0.5, 1.0, 1.5), atol=1e-5)
+    np.testing.assert_allclose(frames[0, 3:6], (0.2, 0.0, 0.0), atol=1e-5)
+    # the previous frame right after the newest one arrived
+    _, frames = resampler.resample(10.1)
+    np.testing.assert_allclose(frames[0, :3], 0.0, atol=1e-6)
+
+
+def test_holds_single_frame():
+    resampler = PoseResampler(extrapolation=1.0)
+    frame = make_frame((1.0, 2.0, 3.0), 0.3)
+    resampler.add_frame(1, frame, 0.0)
+    _, frames = resampler.resample(5.0)
+    np.testing.assert_allclose(frames[0],
+                               np.frombuffer(frame, dtype=np.float32),
+                               atol=1e-6)
+
+
+def test_extrapolation_is_limited():
+    resampler = PoseResampler(extrapolation=0.5)
+    resampler.add_frame(1, make_frame((0.0, 0.0, 0.0), 0.0), 0.0)
+    resampler.add_frame(1, make_frame((1.0, 0.0, 0.0), 0.0), 1.0)
+    _, frames = resampler.resample(2.25)
+    np.testing.assert_allclose(frames[0, 0], 1.25, atol=1e-6)
+    _, frames = resampler.resample(10.0)
+    np.testing.assert_allclose(frames[0, 0], 1.5, atol=1e-6)
+
+
+def test_forget_moves_last_body():
+    resampler = PoseResampler(capacity=1)
+    for body_id in (1, 2, 3):
+        resampler.add_frame(body_id, make_frame((body_id, 0.0, 0.0), 0.0),
+                            0.0)
+    resampler.forget(1)
+    body_ids, frames = resampler.resample(0.0)
+    assert body_ids == [3, 2]
+    np.testing.assert_allclose(frames[:, 0], (3.0, 2.0))
+    resampler.forget(2)
+    resampler.forget(3)
+    body_ids, frames = resampler.resample(0.0)
+    assert body_ids == [] and frames.shape == (0, POSE_FRAME_VALUES)
+
+
+def test_invalid_extrapolation():
+    with pytest.raises(ValueError):
+        PoseResampler(extrapolation=-1.0)
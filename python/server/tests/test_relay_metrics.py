@@ -0,0 +1,124 @@
+import socket
+import numpy as np
+import pytest
+from pose_protocol import POSE_FRAME_SIZE
+from relay_metrics import Histogram, MetricsEndpoint, render_metrics
+from tcp_server import BodyPoseTcpServer
+
+
+@pytest.fixture
+def server():
+    lsock = socket.create_server(('127.0.0.1', 0))
+    server = BodyPoseTcpServer('127.0.0.1', 0, 8, False,
+                               listening_socket=lsock, metrics_port=0)
+    yield server
+    for sock in list(server.clients):
+        sock.close()
+    server.sel.close()
+    lsock.close()
+
+
+def connect(server):
+    client = socket.create_connection(server.lsock.getsockname())
+    client.settimeout(1.0)
+    server._accept_wrapper(server.lsock, 0)
+    return client
+
+
+def run_once(server, endpoint=None, timeout=1.0):
+    """Handles the events of one iteration of the server loop"""
+    for key, mask in server.sel.select(timeout=timeout):
+        if key.fileobj in server.clients:
+            server._service_connection(key, mask, 0)
+        elif endpoint is not None and key.data is endpoint:
+            endpoint.handle(key.fileobj, mask, server.sel)
+
+
+def parse(text):
+    """Returns the samples of the Prometheus text format as a dict"""
+    samples = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.001, 0.01))
+    for value in (0.0005, 0.001, 0.005, 0.5):
+        histogram.observe(value)
+    lines = []
+    histogram.render('latency', lines)
+    assert lines == [
+        'latency_bucket{le="0.001"} 2',
+        'latency_bucket{le="0.01"} 3',
+        'latency_bucket{le="+Inf"} 4',
+        'latency_sum 0.5065',
+        'latency_count 4',
+    ]
+
+
+def test_render_metrics(server):
+    consumer = connect(server)
+    producer = connect(server)
+    frame = np.ones(POSE_FRAME_SIZE // 4, dtype=np.float32).tobytes()
+    producer.sendall(2 * frame)
+    run_once(server)
+    consumer.recv(2 * (4 + POSE_FRAME_SIZE), socket.MSG_WAITALL)
+    samples = parse(render_metrics(server))
+    producer_labels = f'addr="{producer.getsockname()}",role="producer"'
+    consumer_labels = f'addr="{consumer.getsockname()}",role="consumer"'
+    assert samples['pose_server_connections'] == 2
+    assert samples['pose_server_bodies'] == 1
+    assert samples['pose_server_connection_frames_in_total{'
+                   f'{producer_labels}}}'] == 2
+    assert samples['pose_server_connection_bytes_in_total{'
+                   f'{producer_labels}}}'] == 2 * POSE_FRAME_SIZE
+    assert samples['pose_server_connection_frames_out_total{'
+                   f'{consumer_labels}}}'] == 2
+    assert samples['pose_server_connection_bytes_out_total{'
+                   f'{consumer_labels}}}'] == 2 * (4 + POSE_FRAME_SIZE)
+    assert samples['pose_server_body_frames_in_total{body="1"}'] == 2
+    assert samples['pose_server_fanout_seconds_count'] == 2
+    consumer.close()
+    producer.close()
+
+
+def request(server, endpoint, path):
+    client = socket.create_connection(endpoint.addresses()[0])
+    client.sendall(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    client.setblocking(False)
+    response = b''
+    while True:
+        run_once(server, endpoint, timeout=0.01)
+        try:
+            chunk = client.recv(65536)
+        except BlockingIOError:
+            continue
+        if not chunk:
+            break
+        response += chunk
+    client.close()
+    header, _, body = response.partition(b'\r\n\r\n')
+    return header.split(b'\r\n')[0].decode(), body.decode()
+
+
+def test_endpoint(server):
+    endpoint = MetricsEndpoint(server, port=0)
+    endpoint.register(server.sel)
+    try:
+        status, body = request(server, endpoint, '/metrics')
+        assert status == 'HTTP/1.0 200 OK'
+        assert parse(body)['pose_server_connections'] == 0
+        status, _ = request(server, endpoint, '/other')
+        assert status == 'HTTP/1.0 404 Not Found'
+        assert request(server, endpoint, '/profiler/start') == \
+            ('HTTP/1.0 200 OK', 'Profiler started\n')
+        status, _ = request(server, endpoint, '/profiler/stop')
+        assert status == 'HTTP/1.0 200 OK'
+        assert not endpoint.profiler.running
+        # every connection was closed after its response
+        assert endpoint.requests == {} and endpoint.responses == {}
+    finally:
+        endpoint.close()
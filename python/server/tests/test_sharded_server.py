@@ -0,0 +1,93 @@
+import multiprocessing
+import socket
+import numpy as np
+import pytest
+from pose_protocol import POSE_FRAME_SIZE
+from shared_pose_table import SharedPoseTable
+from tcp_server import ShardedBodyPoseTcpServer
+
+
+@pytest.fixture
+def workers():
+    """Two workers of a sharded server in this process"""
+    table = SharedPoseTable(8)
+    pipes = [multiprocessing.Pipe(duplex=False) for _ in range(2)]
+    workers = []
+    for index in range(2):
+        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lsock.bind(('127.0.0.1', 0))
+        lsock.listen()
+        workers.append(ShardedBodyPoseTcpServer(
+            index, table, '127.0.0.1', 0, 8, True, listening_socket=lsock,
+            wakeup_reader=pipes[index][0],
+            wakeup_writers=[pipes[1 - index][1]]
+        ))
+    yield workers
+    for worker in workers:
+        for sock in list(worker.clients):
+            sock.close()
+        worker.sel.close()
+        worker.lsock.close()
+    for reader, writer in pipes:
+        reader.close()
+        writer.close()
+    table.close()
+    table.unlink()
+
+
+def connect(server):
+    client = socket.create_connection(server.lsock.getsockname())
+    client.settimeout(1.0)
+    server._accept_wrapper(server.lsock, 0)
+    return client
+
+
+def service(server, timeout):
+    """Runs one iteration of the server loop"""
+    for key, mask in server.sel.select(timeout=timeout):
+        if key.fileobj in server.clients:
+            server._service_connection(key, mask, 0)
+    server._after_select(0)
+
+
+def make_frame(value):
+    return np.full(POSE_FRAME_SIZE // 4, value, dtype=np.float32).tobytes()
+
+
+def test_frames_of_other_workers(workers):
+    producer_worker, consumer_worker = workers
+    consumer = connect(consumer_worker)
+    producer = connect(producer_worker)
+    producer.sendall(make_frame(1.0))
+    service(producer_worker, 1.0)
+    # woken up by the producer's worker, the first transmission follows
+    # from the table
+    service(consumer_worker, 1.0)
+    assert consumer_worker.first_transmissions == {1: make_frame(1.0)}
+    assert consumer.recv(4 + POSE_FRAME_SIZE, socket.MSG_WAITALL) \
+        == (1).to_bytes(4, 'big') + make_frame(1.0)
+    producer.sendall(make_frame(2.0))
+    service(producer_worker, 1.0)
+    service(consumer_worker, 0.0)
+    assert consumer.recv(4 + POSE_FRAME_SIZE, socket.MSG_WAITALL) \
+        == (1).to_bytes(4, 'big') + make_frame(2.0)
+    consumer.close()
+    producer.close()
+
+
+def test_idle_workers_block(workers):
+    producer_worker, consumer_worker = workers
+    assert consumer_worker.select_timeout is None
+    producer = connect(producer_worker)
+    producer.sendall(make_frame(1.0))
+    service(producer_worker, 1.0)
+    # the table is only polled while other workers have bodies
+    assert producer_worker.select_timeout is None
+    service(consumer_worker, 1.0)
+    assert consumer_worker.select_timeout == consumer_worker.poll_interval
+    producer.close()
+    service(producer_worker, 1.0)
+    assert producer_worker.clients == {}
+    service(consumer_worker, 1.0)
+    assert consumer_worker.select_timeout is None
+    assert consumer_worker.first_transmissions == {}
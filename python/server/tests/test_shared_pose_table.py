@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from pose_protocol import POSE_FRAME_SIZE
+from shared_pose_table import SharedPoseTable
+
+
+@pytest.fixture
+def table():
+    table = SharedPoseTable(4)
+    yield table
+    table.close()
+    table.unlink()
+
+
+def make_frame(value):
+    return np.full(POSE_FRAME_SIZE // 4, value, dtype=np.float32).tobytes()
+
+
+def test_allocate_and_release(table):
+    generation = table.generation
+    body_id, slot = table.allocate(1, make_frame(1.0))
+    assert body_id == 1
+    assert table.generation == generation + 1
+    assert table.active_slots() == {body_id: slot}
+    assert table.owners[slot] == 1
+    assert table.first_frame(slot) == make_frame(1.0)
+    table.release(slot)
+    assert table.active_slots() == {}
+    assert table.generation == generation + 2
+    # body IDs are never handed out twice
+    assert table.allocate(0, make_frame(2.0))[0] == 2
+
+
+def test_frames(table):
+    _, slot = table.allocate(0, make_frame(1.0))
+    seq, frame = table.read_frame(slot)
+    assert frame == make_frame(1.0)
+    table.write_frame(slot, make_frame(2.0))
+    new_seq, frame = table.read_frame(slot)
+    assert new_seq > seq and new_seq % 2 == 0
+    assert frame == make_frame(2.0)
+    # the first frame is kept
+    assert table.first_frame(slot) == make_frame(1.0)
+
+
+def test_full_table(table):
+    for _ in range(4):
+        table.allocate(0, make_frame(0.0))
+    with pytest.raises(RuntimeError):
+        table.allocate(0, make_frame(0.0))
+
+
+def test_attach_by_name(table):
+    attached = SharedPoseTable(table.capacity, table.lock, table.shm.name)
+    try:
+        body_id, slot = table.allocate(0, make_frame(3.0))
+        assert attached.active_slots() == {body_id: slot}
+        assert attached.read_frame(slot)[1] == make_frame(3.0)
+    finally:
+        attached.close()
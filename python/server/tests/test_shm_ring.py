@@ -0,0 +1,137 @@
+import os
+import socket
+import sys
+from multiprocessing import resource_tracker
+import numpy as np
+import pytest
+from pose_protocol import BODY_FRAME_SIZE, POSE_FRAME_SIZE
+from shm_ring import PoseRingReader, PoseRingWriter
+from tcp_server import BodyPoseTcpServer
+
+
+@pytest.fixture
+def ring_name():
+    return f"test_pose_ring_{os.getpid()}"
+
+
+def attach(name):
+    """Attaches a PoseRingReader in the process of the writer"""
+    try:
+        return PoseRingReader(name)
+    finally:
+        if sys.version_info < (3, 13) and os.name == 'posix':
+            # the reader unregistered the block from the resource tracker
+            # that the writer of this process shares, unlinking it would warn
+            resource_tracker.register(f"/{name}", 'shared_memory')
+
+
+def make_frame(value):
+    return np.full(POSE_FRAME_SIZE // 4, value, dtype=np.float32).tobytes()
+
+
+def body_frame(body_id, value):
+    return int(body_id).to_bytes(4, 'big') + make_frame(value)
+
+
+def test_reader_receives_frames_written_after_attaching(ring_name):
+    writer = PoseRingWriter(ring_name, num_slots=8)
+    try:
+        writer.write((1).to_bytes(4, 'big'), make_frame(0.0))
+        reader = attach(ring_name)
+        try:
+            assert reader.num_slots == 8
+            assert reader.read_frames() == []
+            writer.write((1).to_bytes(4, 'big'), make_frame(1.0))
+            writer.write((2).to_bytes(4, 'big'), make_frame(2.0))
+            assert reader.read_frames() == [body_frame(1, 1.0),
+                                            body_frame(2, 2.0)]
+            assert reader.read_frames() == []
+            assert reader.frames_lost == 0
+        finally:
+            reader.close()
+    finally:
+        writer.close()
+
+
+def test_max_frames(ring_name):
+    writer = PoseRingWriter(ring_name, num_slots=8)
+    reader = attach(ring_name)
+    try:
+        for i in range(5):
+            writer.write((1).to_bytes(4, 'big'), make_frame(i))
+        assert reader.read_frames(max_frames=3) == \
+            [body_frame(1, i) for i in range(3)]
+        assert reader.read_frames() == [body_frame(1, i) for i in (3, 4)]
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_lapped_reader_counts_lost_frames(ring_name):
+    writer = PoseRingWriter(ring_name, num_slots=4)
+    reader = attach(ring_name)
+    try:
+        for i in range(10):
+            writer.write((1).to_bytes(4, 'big'), make_frame(i))
+        # only the last full ring is still available
+        assert reader.read_frames() == [body_frame(1, i) for i in range(6, 10)]
+        assert reader.frames_lost == 6
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_slot_overwritten_while_reading_is_lost(ring_name):
+    writer = PoseRingWriter(ring_name, num_slots=4)
+    reader = attach(ring_name)
+    try:
+        writer.write((1).to_bytes(4, 'big'), make_frame(1.0))
+        # the writer starts overwriting the slot between the reader's check
+        # of the write counter and its copy of the slot
+        writer.seqs[0] = 9
+        assert reader.read_frames() == []
+        assert reader.frames_lost == 1
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_rejects_ring_of_other_frame_size(ring_name):
+    writer = PoseRingWriter(ring_name, num_slots=4)
+    try:
+        writer.header[1] = BODY_FRAME_SIZE + 4
+        with pytest.raises(ValueError):
+            attach(ring_name)
+    finally:
+        writer.close()
+
+
+def test_server_publishes_frames(ring_name, tmp_path):
+    server = BodyPoseTcpServer('127.0.0.1', 0, 8, False,
+                               listening_socket=socket.create_server(
+                                   ('127.0.0.1', 0)),
+                               unix_socket_path=str(tmp_path / 'relay.sock'))
+    server.pose_ring = PoseRingWriter(ring_name, num_slots=8)
+    server._listen_unix(0)
+    reader = attach(ring_name)
+    producer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        producer.connect(server.unix_socket_path)
+        server._accept_wrapper(server.unix_lsock, 0)
+        producer.sendall(make_frame(1.0) + make_frame(2.0))
+        received = []
+        while len(received) < 2:
+            for key, mask in server.sel.select(timeout=1.0):
+                if key.fileobj in server.clients:
+                    server._service_connection(key, mask, 0)
+            received += reader.read_frames()
+        assert received == [body_frame(1, 1.0), body_frame(1, 2.0)]
+    finally:
+        producer.close()
+        reader.close()
+        server.pose_ring.close()
+        for sock in list(server.clients):
+            sock.close()
+        server.unix_lsock.close()
+        server.lsock.close()
+        server.sel.close()
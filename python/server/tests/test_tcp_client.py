@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from pose_codec import ENCODING_FLOAT16, ENCODING_RAW, PoseDecoder
+from pose_protocol import (MSG_ENCODED_FRAME, MSG_SET_FRAMED, MSG_SUBSCRIBE,
+                           MSG_UNSUBSCRIBE, POSE_FRAME_SIZE,
+                           POSE_FRAME_VALUES, FrameReassembler,
+                           encode_message)
+from tcp_client import BodyPoseTcpClient
+
+
+def make_producer(**kwargs):
+    return BodyPoseTcpClient('localhost', 7777, False, None, None, True, 0,
+                             False, target_fps=30, verbosity=0, **kwargs)
+
+
+def received(buffers):
+    """Returns the messages a framed server reads from the buffers"""
+    frames = FrameReassembler(POSE_FRAME_SIZE)
+    data = encode_message(MSG_SET_FRAMED) + b''.join(buffers)
+    buffer = frames.get_buffer()
+    buffer[:len(data)] = data
+    return [(msg_type, bytes(payload)) for msg_type, payload
+            in frames.buffer_updated(len(data))][1:]
+
+
+@pytest.fixture
+def frame():
+    return np.arange(POSE_FRAME_VALUES, dtype=np.float32)
+
+
+def test_raw_frames_are_sent_without_copy(frame):
+    buffers = make_producer()._encode_transmission(frame)
+    assert len(buffers) == 1
+    assert np.shares_memory(np.frombuffer(buffers[0], dtype=np.float32),
+                            frame)
+    assert bytes(buffers[0]) == frame.tobytes()
+
+
+def test_framed_raw_frames(frame):
+    buffers = make_producer(framed=True)._encode_transmission(frame)
+    assert np.shares_memory(np.frombuffer(buffers[-1], dtype=np.float32),
+                            frame)
+    [(msg_type, payload)] = received(buffers)
+    assert msg_type == MSG_ENCODED_FRAME
+    assert payload[4] == ENCODING_RAW
+    np.testing.assert_array_equal(PoseDecoder().decode(0, payload[4:]), frame)
+
+
+def test_encoded_frames(frame):
+    buffers = make_producer(encoding=ENCODING_FLOAT16)._encode_transmission(
+        frame
+    )
+    [(msg_type, payload)] = received(buffers)
+    assert msg_type == MSG_ENCODED_FRAME
+    assert payload[4] == ENCODING_FLOAT16
+    np.testing.assert_allclose(PoseDecoder().decode(0, payload[4:]), frame,
+                               rtol=1e-3)
+
+
+def test_unsubscribe_without_subscriptions(monkeypatch):
+    client = BodyPoseTcpClient('localhost', 7777, False, None, None, False, 0,
+                               False, verbosity=0)
+    messages = []
+    monkeypatch.setattr(client, 'send_message',
+                        lambda *message: messages.append(message))
+    client.unsubscribe([1])
+    # the client keeps receiving all bodies
+    assert client.subscriptions is None
+    assert messages == []
+    client.subscribe([1, 2])
+    client.unsubscribe([1])
+    assert client.subscriptions == {2}
+    assert [msg_type for msg_type, _ in messages] == [MSG_SUBSCRIBE,
+                                                     MSG_UNSUBSCRIBE]
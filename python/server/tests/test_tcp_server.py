@@ -0,0 +1,300 @@
+import select
+import selectors
+import socket
+import struct
+import numpy as np
+import pytest
+from pose_codec import ENCODING_FLOAT16
+from pose_protocol import (COUNT, MAX_MESSAGE_SIZE, MESSAGE_HEADER,
+                           MESSAGE_MARKER, MSG_ENCODED_FRAME, MSG_FRAME,
+                           MSG_END_STREAMS, MSG_SET_ENCODING, MSG_SET_FRAMED,
+                           MSG_STREAM_FRAMES, MSG_STREAMS_STARTED,
+                           MSG_SUBSCRIBE, MSG_UNSUBSCRIBE, POSE_FRAME_SIZE,
+                           encode_body_ids, encode_message,
+                           encode_stream_frames_header)
+from tcp_server import BodyPoseTcpServer
+
+
+@pytest.fixture
+def make_server():
+    servers = []
+
+    def make_server(**kwargs):
+        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lsock.bind(('127.0.0.1', 0))
+        lsock.listen()
+        server = BodyPoseTcpServer('127.0.0.1', 0, 8, False,
+                                   listening_socket=lsock, **kwargs)
+        servers.append(server)
+        return server
+
+    yield make_server
+    for server in servers:
+        for sock in list(server.clients):
+            sock.close()
+        server.sel.close()
+        server.lsock.close()
+
+
+def connect(server, receive_buffer_size=None):
+    """Connects a client and lets the server accept it.
+
+    Returns:
+        tuple: The client socket and the socket of the server.
+    """
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if receive_buffer_size is not None:
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                          receive_buffer_size)
+    client.connect(server.lsock.getsockname())
+    client.settimeout(1.0)
+    server._accept_wrapper(server.lsock, 0)
+    return client, list(server.clients)[-1]
+
+
+def service(server, timeout=1.0):
+    """Runs one iteration of the server loop for its connections"""
+    events = server.sel.select(timeout=timeout)
+    for key, mask in events:
+        if key.fileobj in server.clients:
+            server._service_connection(key, mask, 0)
+    return len(events)
+
+
+def make_frame(value):
+    return np.full(POSE_FRAME_SIZE // 4, value, dtype=np.float32).tobytes()
+
+
+def test_consumer_closed_earlier_in_batch(make_server, monkeypatch):
+    server = make_server()
+    consumer, consumer_conn = connect(server)
+    producer, producer_conn = connect(server)
+    # the consumer resets its connection and the producer sends a frame, so
+    # that sending the frame fails and the consumer is closed before its own
+    # event of the same batch is handled
+    consumer.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                        struct.pack('ii', 1, 0))
+    consumer.close()
+    producer.sendall(make_frame(1.0))
+    select.select([producer_conn], [], [], 1.0)
+    events = [(server.sel.get_key(producer_conn), selectors.EVENT_READ),
+              (server.sel.get_key(consumer_conn), selectors.EVENT_READ)]
+
+    def select_events(timeout=None):
+        if not events:
+            raise KeyboardInterrupt
+        batch = events[:]
+        del events[:]
+        return batch
+
+    monkeypatch.setattr(server.sel, 'select', select_events)
+    server.start_server(0)
+    assert list(server.clients) == [producer_conn]
+    producer.close()
+
+
+def test_queue_keeps_newest_frame_per_body(make_server):
+    server = make_server(max_queued_frames=2)
+    _, conn = connect(server)
+    data = server.sel.get_key(conn).data
+    server._queue_frame(data, 1, b'a')
+    server._queue_frame(data, 2, b'b')
+    server._queue_frame(data, 1, b'c')
+    # the newer frame of body 1 replaced the older one and moved to the end
+    assert list(data.out_queue.items()) == [(2, b'b'), (1, b'c')]
+    assert data.frames_dropped == 1
+
+
+def test_queue_drops_longest_waiting_frame(make_server):
+    server = make_server(max_queued_frames=2)
+    _, conn = connect(server)
+    data = server.sel.get_key(conn).data
+    for body_id in (1, 2, 3):
+        server._queue_frame(data, body_id, bytes((body_id,)))
+    assert list(data.out_queue) == [2, 3]
+    assert data.frames_dropped == 1
+
+
+def test_stalled_consumer_drops_frames(make_server):
+    server = make_server(send_buffer_size=4096)
+    consumer, consumer_conn = connect(server, receive_buffer_size=4096)
+    producer, _ = connect(server)
+    frame = make_frame(0.5)
+    # far more than the send buffer holds, the consumer never reads
+    for _ in range(50):
+        producer.sendall(frame * 10)
+        while service(server, timeout=0.01):
+            pass
+    data = server.sel.get_key(consumer_conn).data
+    assert data.frames_dropped > 400
+    # only the newest frame of the single body waits
+    assert len(data.out_queue) == 1
+    consumer.close()
+    producer.close()
+
+
+@pytest.mark.parametrize('message', [
+    # would be indistinguishable from a plain frame
+    MESSAGE_HEADER.pack(MESSAGE_MARKER, MSG_FRAME, 0),
+    MESSAGE_HEADER.pack(MESSAGE_MARKER, MSG_SUBSCRIBE, MAX_MESSAGE_SIZE + 1),
+    encode_message(MSG_SET_ENCODING, b'\0'),
+    encode_message(MSG_SUBSCRIBE, b'\0\0\0\0\0'),
+    encode_message(MSG_ENCODED_FRAME, b'\0\0\0\0'),
+    encode_message(MSG_STREAM_FRAMES, b'\0\0\0\x02'),
+    encode_message(MSG_SET_FRAMED) + make_frame(1.0),
+])
+def test_malformed_message_closes_connection(make_server, message):
+    server = make_server()
+    client, _ = connect(server)
+    client.sendall(message)
+    service(server)
+    assert server.clients == {}
+    assert server.consumers == []
+    assert client.recv(1) == b''
+    client.close()
+
+
+def test_valid_message_keeps_connection(make_server):
+    server = make_server()
+    client, _ = connect(server)
+    client.sendall(encode_message(MSG_SUBSCRIBE, encode_body_ids([7])))
+    service(server)
+    assert len(server.clients) == 1
+    assert server.subscribers.keys() == {7}
+    client.close()
+
+
+def test_messages_after_closing_the_connection_are_skipped(make_server):
+    server = make_server()
+    client, _ = connect(server)
+    # the first reply reaches the closed client, the second one fails and
+    # closes the connection before the remaining messages are handled
+    set_encoding = encode_message(MSG_SET_ENCODING,
+                                  COUNT.pack(ENCODING_FLOAT16))
+    client.sendall(3 * set_encoding
+                   + encode_message(MSG_SUBSCRIBE, encode_body_ids([1])))
+    client.close()
+    service(server)
+    assert server.clients == {}
+    assert server.consumers == []
+    assert server.subscribers == {}
+
+
+def received_body_ids(consumer):
+    """Returns the body IDs of all frames waiting for the consumer"""
+    body_ids = []
+    consumer.setblocking(False)
+    try:
+        while True:
+            body_frame = consumer.recv(4 + POSE_FRAME_SIZE, socket.MSG_WAITALL)
+            body_ids.append(int.from_bytes(body_frame[:4], 'big'))
+    except BlockingIOError:
+        pass
+    consumer.setblocking(True)
+    return body_ids
+
+
+def send_from_all(server, producers):
+    for i, producer in enumerate(producers):
+        producer.sendall(make_frame(i))
+        service(server)
+
+
+@pytest.fixture
+def subscription_setup(make_server):
+    """Returns a server, three consumers and the producers of bodies 1 to 3.
+    The first consumer subscribed to body 2, the second one to bodies 1 and
+    3, the third one receives all bodies."""
+    server = make_server()
+    consumers = [connect(server)[0] for _ in range(3)]
+    producers = [connect(server)[0] for _ in range(3)]
+    send_from_all(server, producers)
+    consumers[0].sendall(encode_message(MSG_SUBSCRIBE, encode_body_ids([2])))
+    consumers[1].sendall(encode_message(MSG_SUBSCRIBE,
+                                        encode_body_ids([1, 3])))
+    service(server)
+    for consumer in consumers:
+        received_body_ids(consumer)
+    yield server, consumers, producers
+    for sock in consumers + producers:
+        sock.close()
+
+
+def test_subscriptions_select_bodies(subscription_setup):
+    server, consumers, producers = subscription_setup
+    send_from_all(server, producers)
+    assert received_body_ids(consumers[0]) == [2]
+    assert received_body_ids(consumers[1]) == [1, 3]
+    assert received_body_ids(consumers[2]) == [1, 2, 3]
+
+
+def test_unsubscribe(subscription_setup):
+    server, consumers, producers = subscription_setup
+    consumers[0].sendall(encode_message(MSG_UNSUBSCRIBE, encode_body_ids([2])))
+    consumers[1].sendall(encode_message(MSG_UNSUBSCRIBE, encode_body_ids([1])))
+    service(server)
+    send_from_all(server, producers)
+    # unsubscribing from the last body does not fall back to all bodies
+    assert received_body_ids(consumers[0]) == []
+    assert received_body_ids(consumers[1]) == [3]
+    assert list(server.subscribers) == [3]
+
+
+def test_unsubscribe_without_subscriptions(subscription_setup):
+    server, consumers, producers = subscription_setup
+    consumers[2].sendall(encode_message(MSG_UNSUBSCRIBE, encode_body_ids([1])))
+    service(server)
+    send_from_all(server, producers)
+    assert received_body_ids(consumers[2]) == [1, 2, 3]
+
+
+def read_message(sock):
+    _, msg_type, length = MESSAGE_HEADER.unpack(
+        sock.recv(MESSAGE_HEADER.size, socket.MSG_WAITALL)
+    )
+    return msg_type, sock.recv(length, socket.MSG_WAITALL)
+
+
+def test_streams(make_server):
+    server = make_server()
+    consumer, _ = connect(server)
+    producer, _ = connect(server)
+    records = b''.join(int(stream).to_bytes(4, 'big') + make_frame(value)
+                       for stream, value in ((4, 1.0), (7, 2.0)))
+    producer.sendall(encode_message(MSG_SET_FRAMED)
+                     + encode_stream_frames_header(2) + records)
+    service(server)
+    # stream index and body ID of every new stream
+    assert read_message(producer) == (MSG_STREAMS_STARTED,
+                                      encode_body_ids([4, 1, 7, 2]))
+    assert consumer.recv(2 * (4 + POSE_FRAME_SIZE), socket.MSG_WAITALL) == \
+        (1).to_bytes(4, 'big') + make_frame(1.0) \
+        + (2).to_bytes(4, 'big') + make_frame(2.0)
+    producer.sendall(encode_stream_frames_header(2) + records
+                     + encode_message(MSG_END_STREAMS, encode_body_ids([4])))
+    service(server)
+    assert received_body_ids(consumer) == [1, 2]
+    # known streams are not confirmed again
+    producer.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        producer.recv(1)
+    assert list(server.first_transmissions) == [2]
+    producer.close()
+    service(server)
+    assert server.first_transmissions == {}
+    consumer.close()
+
+
+def test_framed_producer(make_server):
+    server = make_server()
+    consumer, _ = connect(server)
+    producer, _ = connect(server)
+    frame = make_frame(2.0)
+    producer.sendall(encode_message(MSG_SET_FRAMED) + encode_message(
+        MSG_ENCODED_FRAME, bytes(4) + b'\0' + frame
+    ))
+    service(server)
+    assert consumer.recv(4 + POSE_FRAME_SIZE, socket.MSG_WAITALL) \
+        == (1).to_bytes(4, 'big') + frame
+    consumer.close()
+    producer.close()
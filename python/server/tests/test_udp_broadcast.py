@@ -0,0 +1,67 @@
+import select
+import socket
+import pytest
+from pose_protocol import DATAGRAM_HEADER, POSE_FRAME_SIZE
+from udp_broadcast import PoseDatagramReceiver, parse_address
+
+
+@pytest.fixture
+def receiver():
+    receiver = PoseDatagramReceiver('127.0.0.1', 0)
+    yield receiver
+    receiver.close()
+
+
+@pytest.fixture
+def sender():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    yield sock
+    sock.close()
+
+
+def send(sender, receiver, body_id, seqs):
+    """Sends frames with the given sequence numbers and returns the ones the
+    receiver kept"""
+    address = receiver.sock.getsockname()
+    for seq in seqs:
+        sender.sendto(DATAGRAM_HEADER.pack(seq) + body_id.to_bytes(4, 'big')
+                      + seq.to_bytes(4, 'big') * (POSE_FRAME_SIZE // 4),
+                      address)
+    frames = []
+    while select.select([receiver], [], [], 0.5)[0]:
+        frames += receiver.read_frames()
+    return [int.from_bytes(frame[4:8], 'big') for frame in frames]
+
+
+def test_sequence_number_wrap(receiver, sender):
+    seqs = [2 ** 32 - 2, 2 ** 32 - 1, 0, 1]
+    assert send(sender, receiver, 3, seqs) == seqs
+    assert receiver.frames_lost == 0
+    assert receiver.frames_stale == 0
+
+
+def test_lost_frames_across_wrap(receiver, sender):
+    assert send(sender, receiver, 3, [2 ** 32 - 1, 2]) == [2 ** 32 - 1, 2]
+    assert receiver.frames_lost == 2
+
+
+def test_stale_frames(receiver, sender):
+    assert send(sender, receiver, 3, [0, 5, 4, 5, 6]) == [0, 5, 6]
+    assert receiver.frames_stale == 2
+    assert receiver.frames_lost == 4
+
+
+def test_restarted_sender(receiver, sender):
+    # far older than the reorder window, the sender started counting anew
+    assert send(sender, receiver, 3, [100000, 0, 1]) == [100000, 0, 1]
+    assert receiver.frames_stale == 0
+
+
+def test_invalid_datagrams(receiver, sender):
+    sender.sendto(b'\0' * 10, receiver.sock.getsockname())
+    assert send(sender, receiver, 1, [0]) == [0]
+    assert receiver.datagrams_invalid == 1
+
+
+def test_parse_address():
+    assert parse_address('239.0.0.1:9000') == ('239.0.0.1', 9000)
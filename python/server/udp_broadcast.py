@@ -0,0 +1,163 @@
+"""Distribution of body frames over UDP, to a multicast group or a list of
+unicast receivers.
+
+Every body frame is sent once per target, no matter how many consumers listen,
+so the cost of the server does not grow with the number of consumers. UDP does
+not guarantee delivery or order. Each datagram therefore carries a sequence
+number that is counted per body, which lets receivers detect lost frames and
+drop frames that arrive after a newer frame of the same body.
+"""
+import ipaddress
+import socket
+from pose_protocol import DATAGRAM_HEADER, DATAGRAM_SIZE
+
+_SEQ_MODULO = 1 << 32
+# A frame that is at most this many frames older than the newest frame of its
+# body is stale. Anything older means that the sender started counting anew,
+# e.g. because the server was restarted.
+_REORDER_WINDOW = 1024
+
+
+def parse_address(address):
+    """Splits 'host:port' into a (host, port) tuple"""
+    host, sep, port = address.rpartition(':')
+    if not sep or not host:
+        raise ValueError(f"Expected an address of the form host:port, got "
+                         f"{address}")
+    return host, int(port)
+
+
+def _is_multicast(host):
+    try:
+        return ipaddress.ip_address(host).is_multicast
+    except ValueError:
+        # host name
+        return False
+
+
+class PoseDatagramSender:
+    def __init__(self, targets, ttl=1):
+        """Creates the sending socket.
+
+        Args:
+            targets (list): (host, port) tuples of multicast groups or unicast
+                receivers.
+            ttl (int): Number of hops multicast datagrams may take. 1 keeps
+                them in the local network.
+        """
+        self.targets = [
+            socket.getaddrinfo(host, port, socket.AF_INET,
+                               socket.SOCK_DGRAM)[0][4]
+            for host, port in targets
+        ]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setblocking(False)
+        # body ID -> sequence number of the next frame
+        self.seqs = {}
+        # datagrams that could not be sent
+        self.datagrams_dropped = 0
+
+
+    def send(self, body_id, body_id_bytes, pose):
+        """Sends a body frame to all targets"""
+        seq = self.seqs.get(body_id, 0)
+        self.seqs[body_id] = (seq + 1) % _SEQ_MODULO
+        datagram = DATAGRAM_HEADER.pack(seq) + body_id_bytes + pose
+        for target in self.targets:
+            try:
+                self.sock.sendto(datagram, target)
+            except OSError:
+                # full send buffer, or e.g. an ICMP port unreachable reported
+                # for an earlier datagram to a receiver that is not running
+                self.datagrams_dropped += 1
+
+
+    def forget(self, body_id):
+        """Drops the sequence counter of a body that left"""
+        self.seqs.pop(body_id, None)
+
+
+    def close(self):
+        self.sock.close()
+
+
+class PoseDatagramReceiver:
+    def __init__(self, host, port, interface='0.0.0.0'):
+        """Binds the receiving socket.
+
+        Args:
+            host (str): Multicast group to join or local address to bind to
+                for unicast datagrams.
+            port (int): Port the datagrams are sent to.
+            interface (str): Address of the local interface on which the
+                multicast group is joined.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if _is_multicast(host):
+            # several receivers on the same host may join the group
+            self.sock.bind(('', port))
+            membership = socket.inet_aton(host) + socket.inet_aton(interface)
+            self.sock.setsockopt(socket.IPPROTO_IP,
+                                 socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        # one spare byte to notice datagrams that are too long
+        self.buffer = bytearray(DATAGRAM_SIZE + 1)
+        self.view = memoryview(self.buffer)
+        # body ID -> sequence number of the newest frame received
+        self.last_seqs = {}
+        # frames that never arrived
+        self.frames_lost = 0
+        # frames that arrived after a newer frame of the same body
+        self.frames_stale = 0
+        # datagrams that were not body frames
+        self.datagrams_invalid = 0
+
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+    def read_frames(self, max_frames=256):
+        """Reads all datagrams that are available without blocking.
+
+        Args:
+            max_frames (int): Maximum number of frames to return.
+
+        Returns:
+            list: Body frames as bytes, in the order of arrival. Stale and
+                duplicate frames are left out.
+        """
+        frames = []
+        while len(frames) < max_frames:
+            try:
+                num_bytes = self.sock.recv_into(self.buffer)
+            except BlockingIOError:
+                break
+            if num_bytes != DATAGRAM_SIZE:
+                self.datagrams_invalid += 1
+                continue
+            seq = DATAGRAM_HEADER.unpack_from(self.buffer)[0]
+            body_frame = self.view[DATAGRAM_HEADER.size:DATAGRAM_SIZE]
+            body_id = int.from_bytes(body_frame[:4], 'big')
+            last_seq = self.last_seqs.get(body_id)
+            if last_seq is not None:
+                # modular arithmetic, so that the wrap around of the counter
+                # is not taken for reordering
+                age = (last_seq - seq) % _SEQ_MODULO
+                if age <= _REORDER_WINDOW:
+                    self.frames_stale += 1
+                    continue
+                distance = (seq - last_seq) % _SEQ_MODULO
+                if distance <= _SEQ_MODULO // 2:
+                    self.frames_lost += distance - 1
+            self.last_seqs[body_id] = seq
+            frames.append(body_frame.tobytes())
+        return frames
+
+
+    def close(self):
+        self.sock.close()